@@ -0,0 +1,100 @@
+'''
+Small in-process caches for lookups that are repeated for many harvest
+objects of the same job, eg the groups and organizations of the datasets.
+
+Each cache keeps up to a number of entries for a limited time, dropping the
+least recently used ones first, and counts its hits and misses.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+from pylons import config
+
+# can be set with ckanext.harvest.cache_size and ckanext.harvest.cache_ttl
+DEFAULT_SIZE = 1000
+DEFAULT_TTL = 300
+
+_missing = object()
+
+
+class LRUCache(object):
+    '''
+    Least recently used cache, whose entries expire after ttl seconds.
+    '''
+    def __init__(self, max_size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, _missing)
+            if entry is not _missing:
+                value, expires = entry
+                if expires > time.time():
+                    # Move it to the end, as the most recently used
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name):
+    '''
+    Returns the cache with the given name, creating it with the configured
+    size and ttl the first time.
+    '''
+    with _caches_lock:
+        cache = _caches.get(name)
+        if cache is None:
+            cache = _caches[name] = LRUCache(
+                int(config.get('ckanext.harvest.cache_size', DEFAULT_SIZE)),
+                int(config.get('ckanext.harvest.cache_ttl', DEFAULT_TTL)))
+        return cache
+
+
+def get_stats():
+    '''
+    Returns the stats of each cache, keyed by its name.
+    '''
+    with _caches_lock:
+        return dict((name, cache.stats()) for name, cache in _caches.items())
+
+
+def clear_all():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.clear()
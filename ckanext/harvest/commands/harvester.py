@@ -1,4 +1,9 @@
+import errno
+import os
+import signal
 import sys
+import time
+import traceback
 from pprint import pprint
 
 from ckan import model
@@ -39,12 +44,48 @@ class Harvester(CkanCommand):
       harvester gather_consumer
         - starts the consumer for the gathering queue
 
-      harvester fetch_consumer
+      harvester [--batch-size={n}] [--workers={n}] [--max-messages={n}] fetch_consumer
         - starts the consumer for the fetching queue
 
+          The --batch-size flag makes the consumer take up to n harvest
+          objects from the queue at a time, loading and acknowledging them
+          together. Harvesters that support it (like the CKAN harvester)
+          also create or update the datasets of each batch in a single
+          transaction.
+
+          The --workers flag forks n consumer processes sharing the loaded
+          configuration and plugins, each with its own database and queue
+          connections.
+
+          The --max-messages flag makes a consumer exit after handling n
+          messages. Workers are then replaced by a new one, which bounds
+          the memory used by long running consumers.
+
+          The consumers log how many broker and HTTP connections they have
+          opened and reused, and the hit rates of their caches, every
+          ckan.harvest.stats_interval seconds (300) and when they exit.
+
+          On SIGTERM, consumers finish the messages they are handling
+          before exiting.
+
+      harvester [--batch-size={n}] [--workers={n}] [--max-messages={n}] import_consumer
+        - starts the consumer for the import queue, which runs the import
+          stage of the fetched objects if ckan.harvest.mq.import_queue is
+          enabled. The flags work as for fetch_consumer.
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
+      harvester dead_letters [fetch|import]
+        - lists the ids of the harvest objects in the dead letter queue of
+          the fetch (default) or import queue, ie the ones that failed
+          ckan.harvest.mq.max_retries times
+
+      harvester replay_dead_letters [fetch|import] [{id} ...]
+        - sends the harvest objects in the dead letter queue back to the
+          fetch (default) or import queue, with their retries reset. If ids
+          are given, only those harvest objects are sent.
+
       harvester [-j] [-o] [--segments={segments}] import [{source-id}]
         - perform the import stage with the last fetched objects, for a certain
           source or a single harvest object. Please note that no objects will
@@ -75,7 +116,7 @@ class Harvester(CkanCommand):
 
     summary = __doc__.split('\n')[0]
     usage = __doc__
-    max_args = 9
+    max_args = None
     min_args = 0
 
     def __init__(self,name):
@@ -91,6 +132,15 @@ class Harvester(CkanCommand):
         self.parser.add_option('-p', '--package-id', dest='package_id',
             default=False, help='Id of the package whose harvest object to perfom the import stage for')
 
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+            default=1, help='Number of harvest objects the fetch and import consumers take from the queue at a time')
+
+        self.parser.add_option('--workers', dest='workers', type='int',
+            default=1, help='Number of consumer processes to fork')
+
+        self.parser.add_option('--max-messages', dest='max_messages', type='int',
+            default=0, help='Number of messages a consumer handles before exiting')
+
         self.parser.add_option('--segments', dest='segments',
             default=False, help=
 '''A string containing hex digits that represent which of
@@ -131,19 +181,31 @@ class Harvester(CkanCommand):
                 gather_callback, get_gather_queue_name)
             logging.getLogger('amqplib').setLevel(logging.INFO)
             consumer = get_gather_consumer()
+            self.stats_logged = time.time()
             for method, header, body in consumer.consume(queue=get_gather_queue_name()):
                 gather_callback(consumer, method, header, body)
+                self.log_stats()
         elif cmd == 'fetch_consumer':
             import logging
             logging.getLogger('amqplib').setLevel(logging.INFO)
-            from ckanext.harvest.queue import (get_fetch_consumer, fetch_callback,
-                get_fetch_queue_name)
-            consumer = get_fetch_consumer()
-            for method, header, body in consumer.consume(queue=get_fetch_queue_name()):
-               fetch_callback(consumer, method, header, body)
+            if self.options.workers > 1:
+                self.run_workers(self.options.workers, self.fetch_consumer)
+            else:
+                self.fetch_consumer()
+        elif cmd == 'import_consumer':
+            import logging
+            logging.getLogger('amqplib').setLevel(logging.INFO)
+            if self.options.workers > 1:
+                self.run_workers(self.options.workers, self.import_consumer)
+            else:
+                self.import_consumer()
         elif cmd == 'purge_queues':
             from ckanext.harvest.queue import purge_queues
             purge_queues()
+        elif cmd == 'dead_letters':
+            self.list_dead_letters()
+        elif cmd == 'replay_dead_letters':
+            self.replay_dead_letters()
         elif cmd == 'initdb':
             self.initdb()
         elif cmd == 'import':
@@ -168,6 +230,124 @@ class Harvester(CkanCommand):
 
         print 'DB tables created'
 
+    def fetch_consumer(self):
+        from ckanext.harvest.queue import (get_fetch_consumer, fetch_callback,
+            get_fetch_queue_name, fetch_batch_callback)
+        self.run_consumer(get_fetch_consumer(), get_fetch_queue_name(),
+                          fetch_callback, fetch_batch_callback)
+
+    def import_consumer(self):
+        from ckanext.harvest.queue import (get_import_consumer,
+            import_callback, get_import_queue_name, import_batch_callback)
+        self.run_consumer(get_import_consumer(), get_import_queue_name(),
+                          import_callback, import_batch_callback)
+
+    def run_consumer(self, consumer, queue_name, callback, batch_callback=None):
+        from ckanext.harvest.queue import consume_batches
+
+        # Finish the messages being handled before exiting on SIGTERM
+        self.busy = False
+        self.stopping = False
+        def stop(signum, frame):
+            if not self.busy:
+                sys.exit(0)
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+
+        batch_size = self.options.batch_size if batch_callback else 1
+        if batch_size > 1:
+            batches = consume_batches(consumer, queue_name, batch_size)
+        else:
+            batches = ([message] for message in consumer.consume(queue=queue_name))
+
+        handled = 0
+        self.stats_logged = time.time()
+        try:
+            for messages in batches:
+                self.busy = True
+                if batch_size > 1:
+                    batch_callback(consumer, messages)
+                else:
+                    method, header, body = messages[0]
+                    callback(consumer, method, header, body)
+                self.busy = False
+
+                handled += len(messages)
+                self.log_stats()
+                if self.stopping:
+                    break
+                if self.options.max_messages and handled >= self.options.max_messages:
+                    print 'Handled %s messages, exiting' % handled
+                    break
+        finally:
+            self.log_stats(force=True)
+
+    def log_stats(self, force=False):
+        '''
+        Logs the connection and cache stats of this consumer, at most once
+        every ckan.harvest.stats_interval seconds unless force is set.
+        '''
+        from ckanext.harvest.queue import log_stats, get_stats_interval
+        now = time.time()
+        if force or now - self.stats_logged >= get_stats_interval():
+            log_stats()
+            self.stats_logged = now
+
+    def run_workers(self, count, target):
+        '''
+        Forks count worker processes running target, and replaces the ones
+        that exit until a SIGTERM is received, which is passed on to the
+        workers.
+        '''
+        # Make sure no database connection is shared with the workers, each
+        # one opens its own after the fork
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        workers = set()
+        self.stopping = False
+        def stop(signum, frame):
+            self.stopping = True
+            for pid in list(workers):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        signal.signal(signal.SIGTERM, stop)
+
+        while True:
+            while not self.stopping and len(workers) < count:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    exit_code = 0
+                    try:
+                        target()
+                    except SystemExit, e:
+                        exit_code = e.code or 0
+                    except:
+                        traceback.print_exc()
+                        exit_code = 1
+                    finally:
+                        sys.stdout.flush()
+                        os._exit(exit_code)
+                workers.add(pid)
+                print 'Started worker %s' % pid
+
+            if not workers:
+                break
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            workers.discard(pid)
+            print 'Worker %s exited with status %s' % (pid, status)
+            if status and not self.stopping:
+                # Avoid forking in a tight loop if the workers keep failing
+                time.sleep(1)
+
     def create_harvest_source(self):
 
         if len(self.args) >= 2:
@@ -245,6 +425,28 @@ class Harvester(CkanCommand):
            print str(e.error_dict)
            raise e
 
+    def _get_dead_letter_routing_key(self):
+        queue = self.args[1] if len(self.args) >= 2 else 'fetch'
+        if queue == 'fetch':
+            return 'harvest_object_id'
+        elif queue == 'import':
+            return 'harvest_import_object_id'
+        print 'Unknown queue: %s (it must be fetch or import)' % queue
+        sys.exit(1)
+
+    def list_dead_letters(self):
+        from ckanext.harvest.queue import get_dead_letters
+        ids = get_dead_letters(self._get_dead_letter_routing_key())
+        for id in ids:
+            print id
+        self.print_there_are('dead lettered harvest object', ids)
+
+    def replay_dead_letters(self):
+        from ckanext.harvest.queue import replay_dead_letters
+        ids = [unicode(id) for id in self.args[2:]] or None
+        count = replay_dead_letters(self._get_dead_letter_routing_key(), ids)
+        print 'Replayed %s dead lettered harvest objects' % count
+
     def remove_harvest_source(self):
         if len(self.args) >= 2:
             source_id = unicode(self.args[1])
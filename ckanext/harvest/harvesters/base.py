@@ -1,6 +1,11 @@
+import itertools
+import json
 import logging
 import re
+import threading
+import urlparse
 import uuid
+from multiprocessing.pool import ThreadPool
 
 from sqlalchemy.sql import update,and_, bindparam
 from sqlalchemy.exc import InvalidRequestError
@@ -16,7 +21,9 @@ from ckan.lib.navl.validators import ignore_missing,ignore
 from ckan.lib.munge import munge_title_to_name,substitute_ascii_equivalents
 
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+                                    HarvestObjectError, HarvestSource, \
+                                    harvest_object_table, make_content_hash
+from ckanext.harvest.cache import get_cache
 from sqlalchemy.exc import IntegrityError
 
 from ckan.plugins.core import SingletonPlugin, implements
@@ -25,6 +32,58 @@ from ckanext.harvest.interfaces import IHarvester
 
 log = logging.getLogger(__name__)
 
+# Maximum number of concurrent requests made by _fetch_concurrently, in
+# total and to a single host
+FETCH_CONCURRENCY = 10
+FETCH_CONCURRENCY_PER_HOST = 4
+
+# Harvest objects committed at a time by _create_harvest_objects_iter
+GATHER_CHUNK_SIZE = 1000
+
+# Packages created or updated in a single transaction by
+# _create_or_update_packages
+IMPORT_CHUNK_SIZE = 100
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+class HarvestSourceContext(object):
+    '''
+    The details of a harvest source needed by the harvest stages: its
+    parsed config, the organization of the harvest source dataset, title,
+    url and the name of the user performing the harvesting actions.
+
+    The fingerprint is what ``get_source_fingerprint`` returned when it was
+    created, to tell when the source has been edited since.
+    '''
+    def __init__(self, job_id, source, owner_org, user_name, fingerprint=None):
+        self.job_id = job_id
+        self.fingerprint = fingerprint
+        self.source_id = source.id
+        self.type = source.type
+        self.title = source.title
+        self.url = source.url
+        self.config = json.loads(source.config) if source.config else {}
+        self.owner_org = owner_org
+        self.user_name = user_name
+
+
+def get_source_fingerprint(harvest_job_id):
+    '''
+    Returns the title, url and config of the source of a job, and the
+    metadata_modified of its dataset, which changes whenever the source is
+    edited, eg its organization. It is a single query, cheaper than loading
+    the source and showing its dataset.
+    '''
+    return tuple(Session.query(HarvestSource.title, HarvestSource.url,
+                               HarvestSource.config,
+                               Package.metadata_modified)
+                 .join(HarvestJob, HarvestJob.source_id == HarvestSource.id)
+                 .outerjoin(Package, Package.id == HarvestSource.id)
+                 .filter(HarvestJob.id == harvest_job_id)
+                 .first() or ())
+
 
 def munge_tag(tag):
     tag = substitute_ascii_equivalents(tag)
@@ -89,6 +148,43 @@ class HarvesterBase(SingletonPlugin):
                         line) if line else message.encode('utf-8')
             log.debug(log_message)
 
+    def _fetch_concurrently(self, get_content, urls):
+        '''
+        Calls get_content for each of the urls from a pool of threads,
+        keeping at most ``ckanext.harvest.fetch_concurrency`` requests in
+        flight, and ``ckanext.harvest.fetch_concurrency_per_host`` to the
+        same host.
+
+        Returns a list with a (content, exception) tuple for each url, in
+        the same order. get_content must not use the database session, as
+        it is not shared between threads.
+        '''
+        if not urls:
+            return []
+        concurrency = int(config.get('ckanext.harvest.fetch_concurrency',
+                                     FETCH_CONCURRENCY))
+        per_host = int(config.get('ckanext.harvest.fetch_concurrency_per_host',
+                                  FETCH_CONCURRENCY_PER_HOST))
+
+        def get(url):
+            host = urlparse.urlparse(url).netloc
+            with _host_semaphores_lock:
+                if host not in _host_semaphores:
+                    _host_semaphores[host] = threading.BoundedSemaphore(per_host)
+                semaphore = _host_semaphores[host]
+            with semaphore:
+                try:
+                    return get_content(url), None
+                except Exception, e:
+                    return None, e
+
+        pool = ThreadPool(min(concurrency, len(urls)))
+        try:
+            return pool.map(get, urls)
+        finally:
+            pool.close()
+            pool.join()
+
     def _get_user_name(self):
         '''
         Returns the name of the user that will perform the harvesting actions
@@ -130,6 +226,53 @@ class HarvesterBase(SingletonPlugin):
 
         return self._user_name
 
+    def _get_source_context(self, harvest_job_id):
+        '''
+        Returns the HarvestSourceContext of the source of a job.
+
+        It is cached per job, so the source and its dataset are not looked
+        up again for each harvest object. As the source may be edited from
+        another process while the job runs, its fingerprint is checked on
+        each lookup, and the context created again if it has changed.
+        '''
+        source_contexts = get_cache('source_contexts')
+        source_context = source_contexts.get(harvest_job_id)
+        fingerprint = get_source_fingerprint(harvest_job_id)
+        if source_context is None or source_context.fingerprint != fingerprint:
+            source = HarvestJob.get(harvest_job_id).source
+            user_name = self._get_user_name()
+            context = {'model': model, 'session': Session, 'user': user_name}
+            source_dataset = get_action('package_show')(context, {'id': source.id})
+            source_context = HarvestSourceContext(
+                harvest_job_id, source, source_dataset.get('owner_org'),
+                user_name, fingerprint)
+            source_contexts.set(harvest_job_id, source_context)
+        return source_context
+
+    def _check_unchanged(self, harvest_object):
+        '''
+        Stores the content hash of the harvest object, and checks if it is
+        the same as the one of the current object with the same guid, in
+        which case there is no need to import it again.
+
+        The source config is part of the hash, so changing it makes all the
+        objects be imported again. Unchanged objects are linked to the
+        package of the current object, which stays current, and get the
+        'unchanged' report status.
+        '''
+        harvest_object.content_hash = make_content_hash(
+            harvest_object.content, json.dumps(self.config, sort_keys=True))
+        if getattr(self, 'force_import', False):
+            return False
+        current_object = harvest_object.get_current_object()
+        if current_object and \
+                current_object.content_hash == harvest_object.content_hash:
+            log.info('Harvest object %s has not changed, skipping import' % harvest_object.id)
+            harvest_object.package_id = current_object.package_id
+            harvest_object.report_status = 'unchanged'
+            return True
+        return False
+
     def _create_harvest_objects(self, remote_ids, harvest_job):
         '''
         Given a list of remote ids and a Harvest Job, create as many Harvest Objects and
@@ -138,20 +281,32 @@ class HarvesterBase(SingletonPlugin):
         TODO: Not sure it is worth keeping this function
         '''
         try:
-            object_ids = []
             if len(remote_ids):
-                for remote_id in remote_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid = remote_id, job = harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-                return object_ids
+                return HarvestObject.bulk_create(harvest_job, remote_ids)
             else:
                self._save_gather_error('No remote datasets could be identified', harvest_job)
         except Exception, e:
             self._save_gather_error('%r' % e.message, harvest_job)
 
 
+    def _create_harvest_objects_iter(self, remote_ids, harvest_job,
+                                     chunk_size=GATHER_CHUNK_SIZE):
+        '''
+        Given an iterable of remote ids and a Harvest Job, creates a Harvest
+        Object for each of them, committing them in chunks, and yields their
+        ids.
+
+        A gather stage can return this generator, so the objects are sent to
+        the fetch queue while the remote ids are still being listed.
+        '''
+        remote_ids = iter(remote_ids)
+        while True:
+            chunk = list(itertools.islice(remote_ids, chunk_size))
+            if not chunk:
+                break
+            for object_id in HarvestObject.bulk_create(harvest_job, chunk):
+                yield object_id
+
     def _remove_package(self, package_dict):
         '''
         Removes the given package id, when access denied for a given ID is returned
@@ -159,6 +314,7 @@ class HarvesterBase(SingletonPlugin):
         context = {
             'model': model,
             'session': Session,
+            'user': self._get_user_name(),
         }
         get_action('package_delete')(context, package_dict)
 
@@ -183,35 +339,8 @@ class HarvesterBase(SingletonPlugin):
         for rest api based dicts
         '''
         try:
-            # Change default schema
-            schema = default_create_package_schema()
-            schema['id'] = [ignore_missing, unicode]
-            schema['__junk'] = [ignore]
-
-            # Check API version
-            if self.config:
-                try:
-                    api_version = int(self.config.get('api_version', 2))
-                except ValueError:
-                    raise ValueError('api_version must be an integer')
-            else:
-                api_version = 2
-
-            user_name = self._get_user_name()
-            context = {
-                'model': model,
-                'session': Session,
-                'user': user_name,
-                'api_version': api_version,
-                'schema': schema,
-                'ignore_auth': True,
-            }
-
-            if self.config and self.config.get('clean_tags', False):
-                tags = package_dict.get('tags', [])
-                tags = [munge_tag(t) for t in tags if munge_tag(t) != '']
-                tags = list(set(tags))
-                package_dict['tags'] = tags
+            context = self._get_package_context()
+            self._clean_tags(package_dict)
 
             # Check if package exists
             data_dict = {}
@@ -237,7 +366,6 @@ class HarvesterBase(SingletonPlugin):
                     return
 
                 # Flag the other objects linking to this package as not current anymore
-                from ckanext.harvest.model import harvest_object_table
                 conn = Session.connection()
                 u = update(harvest_object_table) \
                         .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
@@ -304,3 +432,175 @@ class HarvesterBase(SingletonPlugin):
             self._save_object_error('%r'%e,harvest_object,'Import')
 
         return None
+
+    def _create_or_update_packages(self, items, chunk_size=IMPORT_CHUNK_SIZE):
+        '''
+        Batch version of _create_or_update_package, taking a list of
+        (package_dict, harvest_object) tuples.
+
+        For each chunk of items, the existing packages are looked up with a
+        single query and all the packages are created or updated in a
+        single transaction, each of them in its own savepoint so the
+        errors of one don't affect the rest. The other harvest objects
+        linking to the updated packages are flagged as not current with a
+        single statement.
+
+        Returns a list with the result _create_or_update_package would
+        have returned for each item.
+        '''
+        results = []
+        for i in range(0, len(items), chunk_size):
+            results.extend(
+                self._create_or_update_packages_chunk(items[i:i + chunk_size]))
+        return results
+
+    def _create_or_update_packages_chunk(self, items):
+        context = self._get_package_context()
+        # Commit all the packages at once at the end
+        context['defer_commit'] = True
+
+        package_ids = [package_dict['id'] for package_dict, harvest_object in items]
+        existing_packages = {}
+        for id, name, metadata_modified in Session.query(
+                Package.id, Package.name, Package.metadata_modified) \
+                .filter(Package.id.in_(package_ids)):
+            existing_packages[id] = (name, metadata_modified.isoformat()
+                                     if metadata_modified else None)
+
+        # Defer constraints so the harvest objects can link to the new
+        # packages before they are created (see _create_or_update_package)
+        Session.execute('SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED')
+
+        results = []
+        errors = []
+        updated_package_ids = set()
+        current_objects = {}
+        for package_dict, harvest_object in items:
+            # The actions add their own keys to the context
+            package_context = dict(context)
+            savepoint = Session.begin_nested()
+            try:
+                self._clean_tags(package_dict)
+                existing_package = existing_packages.get(package_dict['id'])
+                if existing_package:
+                    name, metadata_modified = existing_package
+                    # In case name has been modified when first importing. See issue #101.
+                    package_dict['name'] = name
+
+                    if 'metadata_modified' in package_dict and \
+                       not package_dict['metadata_modified'] > metadata_modified:
+                        log.info('Package with GUID %s not updated, skipping...' % harvest_object.guid)
+                        savepoint.commit()
+                        results.append(None)
+                        continue
+
+                    log.info('Package with GUID %s exists and needs to be updated' % harvest_object.guid)
+                    package_context['id'] = package_dict['id']
+                    new_package = get_action('package_update_rest')(package_context, package_dict)
+                    updated_package_ids.add(new_package['id'])
+                else:
+                    # Set name for new package to prevent name conflict, see issue #117
+                    package_dict['name'] = self._gen_new_name(
+                        package_dict.get('name') or package_dict['title'])
+                    log.info('Package with GUID %s does not exist, let\'s create it' % harvest_object.guid)
+                    self._create_package_in_savepoint(package_context, package_dict,
+                                                      harvest_object)
+                    new_package = package_dict
+
+                harvest_object.package_id = new_package['id']
+                harvest_object.current = True
+                harvest_object.add()
+                savepoint.commit()
+            except ValidationError, e:
+                savepoint.rollback()
+                log.exception(e)
+                errors.append(('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
+                               harvest_object))
+                results.append(None)
+                continue
+            except Exception, e:
+                savepoint.rollback()
+                log.exception(e)
+                errors.append(('%r' % e, harvest_object))
+                results.append(None)
+                continue
+
+            # Only the last harvest object of a package is the current one
+            previous = current_objects.get(harvest_object.package_id)
+            if previous:
+                previous.current = False
+            current_objects[harvest_object.package_id] = harvest_object
+            results.append(True)
+
+        Session.flush()
+        if updated_package_ids:
+            # Flag the other objects linking to these packages as not current anymore
+            current_ids = [obj.id for obj in current_objects.values()]
+            Session.connection().execute(
+                update(harvest_object_table)
+                .where(harvest_object_table.c.package_id.in_(updated_package_ids))
+                .where(~harvest_object_table.c.id.in_(current_ids))
+                .values(current=False))
+        Session.commit()
+
+        for message, harvest_object in errors:
+            self._save_object_error(message, harvest_object, 'Import')
+
+        return results
+
+    def _create_package_in_savepoint(self, context, package_dict, harvest_object):
+        '''
+        Creates a package from within a savepoint, retrying with a unique
+        suffix in the name if there is a name clash.
+        '''
+        harvest_object.package_id = package_dict['id']
+        harvest_object.current = True
+        harvest_object.add()
+        # Flush so the dataset can be indexed with the harvest object id
+        Session.flush()
+
+        savepoint = Session.begin_nested()
+        try:
+            get_action('package_create_rest')(dict(context), package_dict)
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            log.debug('Attempting adding unique Identifier to name %s' % package_dict['name'])
+            package_dict['name'] = '%s-%s' % (package_dict['name'], str(uuid.uuid4())[:5])
+            get_action('package_create_rest')(dict(context), package_dict)
+
+    def _get_package_context(self):
+        '''
+        Returns the context for the package actions called by
+        _create_or_update_package.
+        '''
+        # Change default schema
+        schema = default_create_package_schema()
+        schema['id'] = [ignore_missing, unicode]
+        schema['__junk'] = [ignore]
+
+        # Check API version
+        if self.config:
+            try:
+                api_version = int(self.config.get('api_version', 2))
+            except ValueError:
+                raise ValueError('api_version must be an integer')
+        else:
+            api_version = 2
+
+        user_name = self._get_user_name()
+        return {
+            'model': model,
+            'session': Session,
+            'user': user_name,
+            'api_version': api_version,
+            'schema': schema,
+            'ignore_auth': True,
+        }
+
+    def _clean_tags(self, package_dict):
+        if self.config and self.config.get('clean_tags', False):
+            tags = package_dict.get('tags', [])
+            tags = [munge_tag(t) for t in tags if munge_tag(t) != '']
+            tags = list(set(tags))
+            package_dict['tags'] = tags
@@ -1,5 +1,9 @@
+import urllib
 import urllib2
 import ast
+import copy
+import itertools
+import time
 
 from ckan.lib.base import c
 from ckan import model
@@ -9,18 +13,31 @@ from ckan.lib.helpers import json
 from ckan.lib.munge import munge_name
 
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+                                    HarvestObjectError, HarvestSystemInfo
+from ckanext.harvest import httpclient
+from ckanext.harvest.cache import get_cache
+from ckanext.harvest.interfaces import RetryLater
 
 import logging
 log = logging.getLogger(__name__)
 
 from base import HarvesterBase
 
+# Packages requested per package_search call when gathering with search
+SEARCH_ROWS = 1000
+
+_not_cached = object()
+
+# Seconds between writes of the limiter state of a source
+LIMITER_STATE_INTERVAL = 60
+_limiter_state_stored = {}
+
 class CKANHarvester(HarvesterBase):
     '''
     A Harvester for CKAN instances
     '''
     config = None
+    source_context = None
 
     api_version = 3
     action_api_version = 3
@@ -34,47 +51,96 @@ class CKANHarvester(HarvesterBase):
     def _get_rest_api_offset(self):
         return '/api/2/rest'
 
-    def _get_content(self, url):
-        http_request = urllib2.Request(
-            url = url,
-        )
-
-	http_request.add_header("User-Agent", "ckanext_harvest")
+    def _get_content(self, url, cache=False):
+        headers = {'User-Agent': 'ckanext_harvest'}
 
         api_key = self.config.get('api_key',None)
         if api_key:
-            http_request.add_header('Authorization',api_key)
+            headers['Authorization'] = api_key
 
+        # Connections to the remote host are kept open and reused, and the
+        # responses cached if cache is set and ckanext.harvest.http_cache_path
+        # is configured
+        stats_key = self.source_context.job_id if self.source_context else None
         try:
-            http_response = urllib2.urlopen(http_request)
+            return httpclient.get(url, headers=headers, stats_key=stats_key,
+                                  use_cache=cache)
         except urllib2.URLError, e:
-            if e.code == 403:
+            code = getattr(e, 'code', None)
+            if code == 403:
                 raise ContentNotFoundError('Package is no longer publicly available, HTTP 403 response for %s' % url)
             else:
+                # Connection errors and overloaded servers are worth
+                # trying again later
+                if code is None:
+                    transient = isinstance(e.reason, Exception)
+                else:
+                    transient = code == 429 or code >= 500
                 raise ContentFetchError(
                     'Could not fetch url: %s, error: %s' %
-                    (url, str(e))
+                    (url, str(e)), transient=transient, code=code
                 )
-        return http_response.read()
 
     def _get_group(self, base_url, group_name):
         url = base_url + self._get_action_api_offset() + '/group_show?id=' + munge_name(group_name)
-        try:
-            content = self._get_content(url)
-            return json.loads(content)
-        except (ContentFetchError, ValueError):
+        remote_groups = get_cache('remote_groups')
+        group = remote_groups.get(url, _not_cached)
+        if group is _not_cached:
+            try:
+                content = self._get_content(url)
+                group = json.loads(content)
+            except (ContentFetchError, ValueError):
+                group = None
+            # Failures are cached too, not to request them again
+            remote_groups.set(url, group)
+        if group is None:
             log.debug('Could not fetch/decode remote group');
             raise RemoteResourceError('Could not fetch/decode remote group')
+        # The callers modify it
+        return copy.deepcopy(group)
 
     def _get_organization(self, base_url, org_name):
         url = base_url + self._get_action_api_offset() + '/organization_show?id=' + org_name
-        try:
-            content = self._get_content(url)
-            content_dict = json.loads(content)
-            return content_dict['result']
-        except (ContentFetchError, ValueError, KeyError):
+        remote_orgs = get_cache('remote_organizations')
+        org = remote_orgs.get(url, _not_cached)
+        if org is _not_cached:
+            try:
+                content = self._get_content(url)
+                content_dict = json.loads(content)
+                org = content_dict['result']
+            except (ContentFetchError, ValueError, KeyError):
+                org = None
+            remote_orgs.set(url, org)
+        if org is None:
             log.debug('Could not fetch/decode remote group');
             raise RemoteResourceError('Could not fetch/decode remote organization')
+        return copy.deepcopy(org)
+
+    def _get_local_group(self, context, group_name):
+        '''
+        Returns the id and name of a local group, raising NotFound if it
+        does not exist. Found groups are cached.
+        '''
+        local_groups = get_cache('local_groups')
+        group = local_groups.get(group_name)
+        if group is None:
+            group = get_action('group_show')(context, {'id': group_name})
+            group = {'id': group['id'], 'name': group['name']}
+            local_groups.set(group_name, group)
+        return group
+
+    def _get_local_organization(self, context, org_name):
+        '''
+        Returns the id and name of a local organization, raising NotFound
+        if it does not exist. Found organizations are cached.
+        '''
+        local_orgs = get_cache('local_organizations')
+        org = local_orgs.get(org_name)
+        if org is None:
+            org = get_action('organization_show')(context, {'id': org_name})
+            org = {'id': org['id'], 'name': org['name']}
+            local_orgs.set(org_name, org)
+        return org
 
     def _set_config(self,config_str):
         if config_str:
@@ -86,6 +152,16 @@ class CKANHarvester(HarvesterBase):
         else:
             self.config = {}
 
+    def _set_source_context(self, harvest_job_id):
+        '''
+        Sets the config and source details of the job, created once per job
+        (see HarvesterBase._get_source_context).
+        '''
+        self.source_context = self._get_source_context(harvest_job_id)
+        self.config = self.source_context.config
+        self.api_version = int(self.config.get('api_version',
+                                               CKANHarvester.api_version))
+
     def info(self):
         return {
             'name': 'ckan',
@@ -119,7 +195,7 @@ class CKANHarvester(HarvesterBase):
                 context = {'model':model,'user':c.user}
                 for group_name in config_obj['default_groups']:
                     try:
-                        group = get_action('group_show')(context,{'id':group_name})
+                        group = self._get_local_group(context, group_name)
                     except NotFound,e:
                         raise ValueError('Default group not found')
 
@@ -135,7 +211,13 @@ class CKANHarvester(HarvesterBase):
                 except NotFound,e:
                     raise ValueError('User not found')
 
-            for key in ('read_only','force_all'):
+            if 'search_rows' in config_obj:
+                try:
+                    int(config_obj['search_rows'])
+                except ValueError:
+                    raise ValueError('search_rows must be an integer')
+
+            for key in ('read_only','force_all','gather_with_search'):
                 if key in config_obj:
                     if not isinstance(config_obj[key],bool):
                         raise ValueError('%s must be boolean' % key)
@@ -151,7 +233,7 @@ class CKANHarvester(HarvesterBase):
         get_all_packages = True
         package_ids = []
 
-        self._set_config(harvest_job.source.config)
+        self._set_source_context(harvest_job.id)
         # Check if this source has been harvested before, and when
         previous_jobs = Session.query(HarvestJob) \
                         .filter(HarvestJob.source==harvest_job.source) \
@@ -175,7 +257,23 @@ class CKANHarvester(HarvesterBase):
         if (previous_job):
             if not self.config.get('force_all',False):
                 get_all_packages = False
-                # Request only the packages modified since last harvest job
+                # Request only the packages modified since the last one
+                # harvested, or else since the last harvest job
+                last_modified = HarvestSystemInfo.get_value(
+                    self._get_last_modified_key(harvest_job.source)) or \
+                    previous_job.gather_finished.isoformat()
+                log.debug('Searching package updates since %s' % last_modified)
+                try:
+                    object_ids = self._start_gather(self._gather_with_search(
+                        harvest_job, base_package_list_url, since=last_modified))
+                except (ContentFetchError, ContentNotFoundError, ValueError, KeyError),e:
+                    log.info('CKAN instance %s does not support searching by modification date, using the revision API: %s' % (base_url, str(e)))
+                else:
+                    if object_ids is None:
+                        log.info('No packages have been updated on the remote CKAN instance since the last harvest job')
+                    return self._stream_gather(harvest_job, base_package_list_url,
+                                               object_ids or [], check_deleted=True)
+
                 last_time = previous_job.gather_finished.isoformat()
                 url = base_search_url + '/revision?since_time=%s' % last_time
                 log.debug('Getting package updates since %s' % last_time)
@@ -184,6 +282,7 @@ class CKANHarvester(HarvesterBase):
 
                     revision_ids = json.loads(content)
                     if len(revision_ids):
+                        seen_package_ids = set()
                         for revision_id in revision_ids:
                             url = base_rest_url + '/revision/%s' % revision_id
                             try:
@@ -194,7 +293,8 @@ class CKANHarvester(HarvesterBase):
 
                             revision = json.loads(content)
                             for package_id in revision['packages']:
-                                if not package_id in package_ids:
+                                if not package_id in seen_package_ids:
+                                    seen_package_ids.add(package_id)
                                     package_ids.append(package_id)
                     else:
                         log.info('No packages have been updated on the remote CKAN instance since the last harvest job')
@@ -208,7 +308,20 @@ class CKANHarvester(HarvesterBase):
                         self._save_gather_error('Unable to get content for URL: %s: %s' % (url, str(e)),harvest_job)
                         return None
 
-
+        if get_all_packages and self.config.get('gather_with_search', False):
+            # Get the full packages, so there is nothing left to fetch
+            try:
+                object_ids = self._start_gather(self._gather_with_search(
+                    harvest_job, base_package_list_url))
+            except (ContentFetchError, ContentNotFoundError, ValueError, KeyError),e:
+                self._save_gather_error('Unable to search packages on %s: %s' % (base_url, str(e)),harvest_job)
+                return None
+            if object_ids is None:
+                self._save_gather_error('No packages received from %s' % base_url,
+                        harvest_job)
+                return None
+            return self._stream_gather(harvest_job, base_package_list_url,
+                                       object_ids)
 
         if get_all_packages:
             # Request all remote packages
@@ -222,15 +335,9 @@ class CKANHarvester(HarvesterBase):
             package_ids = json.loads(content)['result']
 
         try:
-            object_ids = []
             if len(package_ids):
-                for package_id in package_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid = package_id, job = harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-
-                return object_ids
+                # Create a new HarvestObject for each identifier
+                return HarvestObject.bulk_create(harvest_job, package_ids)
 
             else:
                self._save_gather_error('No packages received for URL: %s' % url,
@@ -240,33 +347,291 @@ class CKANHarvester(HarvesterBase):
             self._save_gather_error('%r'%e.message,harvest_job)
 
 
+    def _get_last_modified_key(self, source):
+        return 'ckan_harvester_last_modified:%s' % source.id
+
+    def _gather_deleted(self, harvest_job, base_url):
+        '''
+        Searching by modification date does not return the packages deleted
+        or made private on the remote instance, so the names of all the
+        remote packages are compared with the guids and names of the current
+        local ones. A harvest object is created for each one missing, which
+        the fetch stage removes if the remote instance confirms it is gone.
+
+        Returns the ids of the new harvest objects.
+        '''
+        url = base_url + '/package_list'
+        try:
+            remote_names = set(json.loads(self._get_content(url))['result'])
+        except (ContentFetchError, ContentNotFoundError, ValueError, KeyError), e:
+            log.warning('Unable to check for deleted packages on %s: %s' % (url, e))
+            return []
+        local_packages = Session.query(HarvestObject.guid, Package.name) \
+            .join(Package, Package.id == HarvestObject.package_id) \
+            .filter(Package.state == u'active') \
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id) \
+            .filter(HarvestObject.current == True)
+        # The guids of packages harvested with the revision API are ids, so
+        # their local name, taken from the remote one, is checked too. These
+        # are only candidates to be checked, as it may have been renamed
+        missing = [{'guid': guid, 'extras': {'status': 'check_deleted'}}
+                   for guid, name in local_packages
+                   if guid not in remote_names and name not in remote_names]
+        if missing:
+            log.info('%s packages may have been deleted from %s' % (len(missing), url))
+        return HarvestObject.bulk_create(harvest_job, missing)
+
+    def _start_gather(self, object_ids):
+        '''
+        Runs a generator of harvest object ids up to its first id, so the
+        errors of the first requests are raised here, before any object has
+        been sent to the fetch queue.
+
+        Returns an iterator of all the ids, or None if there are none.
+        '''
+        object_ids = iter(object_ids)
+        for object_id in object_ids:
+            return itertools.chain([object_id], object_ids)
+        return None
+
+    def _stream_gather(self, harvest_job, base_url, object_ids,
+                       check_deleted=False):
+        '''
+        Yields the ids of the harvest objects created by
+        _gather_with_search, so they are sent to the fetch queue while the
+        search goes on. An error on a later page is saved as a gather error,
+        keeping the objects already created, which may have been fetched
+        by then.
+        Then, if check_deleted is set, the ids of the packages that may have
+        been deleted are yielded (see _gather_deleted).
+        '''
+        try:
+            for object_id in object_ids:
+                yield object_id
+        except (ContentFetchError, ContentNotFoundError, ValueError, KeyError),e:
+            self._save_gather_error('Unable to search packages on %s: %s' % (base_url, str(e)),harvest_job)
+            return
+        if check_deleted:
+            # The search does not return the deleted packages
+            for object_id in self._gather_deleted(harvest_job, base_url):
+                yield object_id
+
+    def _gather_with_search(self, harvest_job, base_url, since=None):
+        '''
+        Gathers the remote packages, or only the ones modified since the
+        given date, with paged package_search requests. Each package dict is
+        stored as the content of its harvest object, so they don't need to
+        be requested again on the fetch stage. The objects of each page are
+        created and their ids yielded before the next page is requested.
+
+        Pages are walked by metadata_modified rather than by offset, so
+        packages modified while paging are not missed. The last
+        metadata_modified seen is stored for the next incremental harvest.
+
+        Errors are raised, keeping the objects already created, as their
+        ids have been yielded.
+        '''
+        # name -> [object id, metadata_modified]
+        objects = {}
+        last_modified = since
+
+        try:
+            for packages in self._search_packages(base_url, since):
+                # The objects to create for this page, and by name
+                pending = []
+                items = {}
+                for package_dict in packages:
+                    name = package_dict['name']
+                    modified = package_dict.get('metadata_modified')
+                    if modified > last_modified:
+                        last_modified = modified
+                    if name in items:
+                        items[name]['content'] = json.dumps(package_dict)
+                    elif name in objects:
+                        # It was modified while paging, keep the latest version
+                        entry = objects[name]
+                        if modified > entry[1]:
+                            entry[1] = modified
+                            Session.query(HarvestObject) \
+                                .filter(HarvestObject.id==entry[0]) \
+                                .update({'content': json.dumps(package_dict)},
+                                        synchronize_session=False)
+                            Session.commit()
+                    else:
+                        items[name] = {'guid': name,
+                                       'content': json.dumps(package_dict)}
+                        pending.append(items[name])
+                        objects[name] = [None, modified]
+                ids = HarvestObject.bulk_create(harvest_job, pending)
+                for item, obj_id in zip(pending, ids):
+                    objects[item['guid']][0] = obj_id
+                for obj_id in ids:
+                    yield obj_id
+        except:
+            Session.rollback()
+            raise
+
+        if last_modified and last_modified != since:
+            HarvestSystemInfo.set_value(
+                self._get_last_modified_key(harvest_job.source), last_modified)
+
+    def _search_packages(self, base_url, since=None):
+        '''
+        Yields the pages of remote packages (modified since the given date)
+        sorted by metadata_modified, requesting them search_rows at a time.
+
+        The remote instance may return fewer rows than requested (CKAN caps
+        them with search.rows_max), so paging only stops when the count of
+        matching packages has been reached, or on an empty page.
+        '''
+        rows = int(self.config.get('search_rows', SEARCH_ROWS))
+        cursor = since
+        # Packages with the same metadata_modified as the cursor already seen
+        offset = 0
+        while True:
+            url = base_url + '/package_search?q=*:*&sort=metadata_modified+asc&rows=%d&start=%d' % (rows, offset)
+            if cursor:
+                if not cursor.endswith('Z'):
+                    cursor += 'Z'
+                url += '&fq=' + urllib.quote('metadata_modified:[%s TO *]' % cursor)
+            content = self._get_content(url)
+            result = json.loads(content)['result']
+            packages = result['results']
+
+            if not packages:
+                break
+            yield packages
+
+            if 'count' in result and offset + len(packages) >= result['count']:
+                break
+            last = packages[-1]['metadata_modified'] + 'Z'
+            if last == cursor:
+                offset += len(packages)
+            else:
+                cursor = last
+                offset = len([p for p in packages
+                              if p['metadata_modified'] + 'Z' == last])
+
     def fetch_stage(self,harvest_object):
         log.debug('In CKANHarvester fetch_stage')
 
-        self._set_config(harvest_object.job.source.config)
+        if harvest_object.content:
+            # Already stored by the gather stage
+            return True
 
-        # Get source URL
-        url = harvest_object.source.url.rstrip('/')
-        url = url + self._get_action_api_offset() + '/package_show?id=' + harvest_object.guid
+        self._set_source_context(harvest_object.harvest_job_id)
+
+        url = self._get_package_show_url(harvest_object)
 
         # Get contents
         try:
-            content = self._get_content(url)
-        except ContentNotFoundError,e:
+            content = self._get_content(url, cache=True)
+        except (ContentFetchError, ContentNotFoundError),e:
+            if getattr(e, 'transient', False):
+                raise RetryLater('Unable to get content for package: %s: %s' % (url, e))
+            return self._save_fetched_content(harvest_object, url, None, e)
+
+        success = self._save_fetched_content(harvest_object, url, content)
+        harvest_object.save()
+        self._store_limiter_state()
+        return success
+
+    def fetch_stage_batch(self, harvest_objects):
+        '''
+        Fetches the contents of several harvest objects concurrently, and
+        saves them in a single commit.
+
+        Returns a dict with the fetch_stage result for each harvest object
+        id, or a RetryLater for the ones that failed with a transient error.
+        '''
+        log.debug('In CKANHarvester fetch_stage_batch: %s objects' % len(harvest_objects))
+
+        results = {}
+        objects_by_job = {}
+        for harvest_object in harvest_objects:
+            if harvest_object.content:
+                # Already stored by the gather stage
+                results[harvest_object.id] = True
+                continue
+            objects_by_job.setdefault(harvest_object.harvest_job_id, []) \
+                .append(harvest_object)
+
+        for job_id, source_objects in objects_by_job.items():
+            # The config (eg the API key) is per source
+            self._set_source_context(job_id)
+            urls = [self._get_package_show_url(harvest_object)
+                    for harvest_object in source_objects]
+            responses = self._fetch_concurrently(
+                lambda url: self._get_content(url, cache=True), urls)
+            for harvest_object, url, (content, error) in \
+                    zip(source_objects, urls, responses):
+                if getattr(error, 'transient', False):
+                    results[harvest_object.id] = RetryLater(
+                        'Unable to get content for package: %s: %s' % (url, error))
+                    continue
+                results[harvest_object.id] = self._save_fetched_content(
+                    harvest_object, url, content, error)
+                harvest_object.add()
+
+        Session.commit()
+        if objects_by_job:
+            self._store_limiter_state()
+        return results
+
+    def _store_limiter_state(self):
+        '''
+        Stores the state of the limiter of the requests to the source host,
+        to be shown in the source status, and logs the response cache stats
+        of the job. It is done at most once every LIMITER_STATE_INTERVAL
+        seconds per source.
+        '''
+        source_id = self.source_context.source_id
+        now = time.time()
+        if now - _limiter_state_stored.get(source_id, 0) < LIMITER_STATE_INTERVAL:
+            return
+        _limiter_state_stored[source_id] = now
+        HarvestSystemInfo.set_value(
+            httpclient.get_limiter_state_key(source_id),
+            json.dumps(httpclient.get_limiter_state(self.source_context.url)))
+        if httpclient.get_response_cache():
+            log.info('HTTP cache stats for job %s: %r', self.source_context.job_id,
+                     httpclient.get_cache_stats(self.source_context.job_id))
+
+    def _get_package_show_url(self, harvest_object):
+        url = self.source_context.url.rstrip('/')
+        return url + self._get_action_api_offset() + '/package_show?id=' + harvest_object.guid
+
+    def _save_fetched_content(self, harvest_object, url, content, error=None):
+        '''
+        Stores the package_show response in the harvest object, or handles
+        the error raised when requesting it. The harvest object is not
+        saved if the content is stored.
+        '''
+        if isinstance(error, ContentFetchError) and error.code == 404 and \
+                self._is_deletion_candidate(harvest_object):
+            # Purged from the remote instance
+            error = ContentNotFoundError(str(error))
+        if isinstance(error, ContentNotFoundError):
             # Remove package, as it no longer exists in the source:
-            self._remove_package({"id": harvest_object.guid})
+            current = harvest_object.get_current_object()
+            self._remove_package({"id": current[2] if current else harvest_object.guid})
             harvest_object.report_status = 'deleted'
             harvest_object.save()
             return True
-        except ContentFetchError,e:
+        if error:
             self._save_object_error('Unable to get content for package: %s: %r' % \
-                                        (url, e),harvest_object)
+                                        (url, error),harvest_object)
             return None
         # Save the fetched contents in the HarvestObject
         harvest_object.content = json.dumps(json.loads(content)['result'])
-        harvest_object.save()
+        # Unchanged objects are skipped by the import stage
+        self._check_unchanged(harvest_object)
         return True
 
+    def _is_deletion_candidate(self, harvest_object):
+        return any(extra.key == 'status' and extra.value == 'check_deleted'
+                   for extra in harvest_object.extras)
+
     def import_stage(self,harvest_object):
         log.debug('In CKANHarvester import_stage: %s' % harvest_object.id)
 
@@ -274,7 +639,10 @@ class CKANHarvester(HarvesterBase):
             log.debug('Dataset removed as expected, ignoring import for %s' % harvest_object.id)
             return True
 
-        context = {'model': model, 'session': Session, 'user': self._get_user_name()}
+        if harvest_object.report_status == 'unchanged':
+            log.debug('Dataset not changed since the last import, ignoring import for %s' % harvest_object.id)
+            return True
+
         if not harvest_object:
             log.error('No harvest object received')
             return False
@@ -284,7 +652,13 @@ class CKANHarvester(HarvesterBase):
                     harvest_object, 'Import')
             return False
 
-        self._set_config(harvest_object.job.source.config)
+        self._set_source_context(harvest_object.harvest_job_id)
+        context = {'model': model, 'session': Session, 'user': self.source_context.user_name}
+
+        # Not checked yet if the content was stored by the gather stage
+        if harvest_object.content_hash is None and \
+                self._check_unchanged(harvest_object):
+            return True
 
         try:
             package_dict = json.loads(harvest_object.content)
@@ -293,219 +667,299 @@ class CKANHarvester(HarvesterBase):
                 log.warn('Remote dataset is a harvest source, ignoring...')
                 return True
 
-            # Set default tags if needed
-            default_tags = self.config.get('default_tags',[])
-            if default_tags:
-                if not 'tags' in package_dict:
-                    package_dict['tags'] = []
-                package_dict['tags'].extend([t for t in default_tags if t not in package_dict['tags']])
-                for extra_key in package_dict['extras']:
-                    if extra_key['key'] == 'tags':
-                        extra_key['value'].extend([t for t in default_tags if t not in package_dict['tags']])
+            self._prepare_package_dict(harvest_object, package_dict, context)
 
-            remote_groups = self.config.get('remote_groups', None)
+            result = self._create_or_update_package(package_dict,harvest_object)
 
-            log.debug('Default tags setup for: %s' % harvest_object.id)
+            if result and self.config.get('read_only',False) == True:
+                self._set_read_only(package_dict)
 
-            if not remote_groups in ('only_local', 'create'):
-                # Ignore remote groups
-                package_dict.pop('groups', None)
-            else:
-                if not 'groups' in package_dict:
-                    package_dict['groups'] = []
+            log.debug('Import complete for: %s' % harvest_object.id)
 
-                # check if remote groups exist locally, otherwise remove
-                validated_groups = []
+            return True
+        except ValidationError,e:
+            self._save_object_error('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
+                    harvest_object, 'Import')
+        except Exception, e:
+            self._save_object_error('%r'%e,harvest_object,'Import')
+            log.debug('ImportError %r' % e)
 
-                for group_name in package_dict['groups']:
-                    try:
-                        data_dict = {'id': group_name}
-                        group = get_action('group_show')(context, data_dict)
+    def _prepare_package_dict(self, harvest_object, package_dict, context):
+        '''
+        Turns the remote package dict of a harvest object into the one to
+        create or update locally, applying the source config.
+        '''
+        source_context = self.source_context
+
+        # Set default tags if needed
+        default_tags = self.config.get('default_tags',[])
+        if default_tags:
+            if not 'tags' in package_dict:
+                package_dict['tags'] = []
+            package_dict['tags'].extend([t for t in default_tags if t not in package_dict['tags']])
+            for extra_key in package_dict['extras']:
+                if extra_key['key'] == 'tags':
+                    extra_key['value'].extend([t for t in default_tags if t not in package_dict['tags']])
+
+        remote_groups = self.config.get('remote_groups', None)
+
+        log.debug('Default tags setup for: %s' % harvest_object.id)
+
+        if not remote_groups in ('only_local', 'create'):
+            # Ignore remote groups
+            package_dict.pop('groups', None)
+        else:
+            if not 'groups' in package_dict:
+                package_dict['groups'] = []
+
+            # check if remote groups exist locally, otherwise remove
+            validated_groups = []
+
+            for group_name in package_dict['groups']:
+                try:
+                    group = self._get_local_group(context, group_name)
+                    if self.api_version == 1:
+                        validated_groups.append(group['name'])
+                    else:
+                        validated_groups.append(group['id'])
+                except NotFound, e:
+                    log.info('Group %s is not available' % group_name)
+                    if remote_groups == 'create':
+                        try:
+                            group = self._get_group(source_context.url, group_name)
+                        except RemoteResourceError:
+                            log.error('Could not get remote group %s' % group_name)
+                            continue
+
+                        for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
+                            group.pop(key, None)
+
+                        get_action('group_create')(context, group)
+                        log.info('Group %s has been newly created' % group_name)
+                        get_cache('local_groups').set(group_name,
+                            {'id': group['id'], 'name': group['name']})
                         if self.api_version == 1:
                             validated_groups.append(group['name'])
                         else:
                             validated_groups.append(group['id'])
-                    except NotFound, e:
-                        log.info('Group %s is not available' % group_name)
-                        if remote_groups == 'create':
-                            try:
-                                group = self._get_group(harvest_object.source.url, group_name)
-                            except RemoteResourceError:
-                                log.error('Could not get remote group %s' % group_name)
-                                continue
 
-                            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
-                                group.pop(key, None)
+            package_dict['groups'] = validated_groups
 
-                            get_action('group_create')(context, group)
-                            log.info('Group %s has been newly created' % group_name)
-                            if self.api_version == 1:
-                                validated_groups.append(group['name'])
-                            else:
-                                validated_groups.append(group['id'])
+        # Local harvest source organization
+        local_org = source_context.owner_org
 
-                package_dict['groups'] = validated_groups
-
-            log.debug('Starting to get harvest source info for: %s' % harvest_object.id)
-            # Local harvest source organization
-            source_dataset = get_action('package_show')(context, {'id': harvest_object.source.id})
-            local_org = source_dataset.get('owner_org')
-
-            log.debug('Have harvest source info for: %s' % harvest_object.id)
-
-            remote_orgs = self.config.get('remote_orgs', None)
-            if not remote_orgs in ('only_local', 'create'):
-                # Assign dataset to the source organization
-                package_dict['owner_org'] = local_org
-            else:
-                if not 'owner_org' in package_dict:
-                    package_dict['owner_org'] = None
+        remote_orgs = self.config.get('remote_orgs', None)
+        if not remote_orgs in ('only_local', 'create'):
+            # Assign dataset to the source organization
+            package_dict['owner_org'] = local_org
+        else:
+            if not 'owner_org' in package_dict:
+                package_dict['owner_org'] = None
 
-                # check if remote org exist locally, otherwise remove
-                validated_org = None
-                remote_org = package_dict['owner_org']
+            # check if remote org exist locally, otherwise remove
+            validated_org = None
+            remote_org = package_dict['owner_org']
 
-                if remote_org:
-                    try:
-                        data_dict = {'id': remote_org}
-                        org = get_action('organization_show')(context, data_dict)
-                        validated_org = org['id']
-                    except NotFound, e:
-                        log.info('Organization %s is not available' % remote_org)
-                        if remote_orgs == 'create':
+            if remote_org:
+                try:
+                    org = self._get_local_organization(context, remote_org)
+                    validated_org = org['id']
+                except NotFound, e:
+                    log.info('Organization %s is not available' % remote_org)
+                    if remote_orgs == 'create':
+                        try:
                             try:
-                                try:
-                                    org = self._get_organization(harvest_object.source.url, remote_org)
-                                except RemoteResourceError:
-                                    # fallback if remote CKAN exposes organizations as groups
-                                    # this especially targets older versions of CKAN
-                                    org = self._get_group(harvest_object.source.url, remote_org)
-
-                                for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name', 'type']:
-                                    org.pop(key, None)
-                                get_action('organization_create')(context, org)
-                                log.info('Organization %s has been newly created' % remote_org)
-                                validated_org = org['id']
-                            except (RemoteResourceError, ValidationError):
-                                log.error('Could not get remote org %s' % remote_org)
-
-                package_dict['owner_org'] = validated_org or local_org
-
-            log.debug('Organization owner setup for: %s' % harvest_object.id)
-            # Set default groups if needed
-            default_groups = self.config.get('default_groups', [])
-            if default_groups:
-                if not 'groups' in package_dict:
-                    package_dict['groups'] = []
-                package_dict['groups'].extend([g for g in default_groups if g not in package_dict['groups']])
-
-	    # Download full metadata link if applicable
-            harvest_source_id = None
-            for key in package_dict['extras']:
-                if key['key'] == 'harvest_object_id':
-                    harvest_source_id = key['value']
-            if harvest_source_id != None:
-                # Store the full metadata link
-                url = harvest_object.source.url.rstrip('/') + '/harvest/object/' + harvest_source_id
-                full_metadata = self._get_content(url)
-                harvest_object.content = full_metadata
-                harvest_object.save()
-
-            log.debug('Got full metadata content for: %s' % harvest_object.id)
-            # Find any extras whose values are not strings and try to convert
-            # them to strings, as non-string extras are not allowed anymore in
-            # CKAN 2.0.
-            for key in package_dict['extras']:
-                if not isinstance(key['value'], basestring):
-                    try:
-                        key['value'] = json.dumps(key['value'])
-                    except TypeError:
-                        # If converting to a string fails, just delete it.
-                        del key
-
-            # Flip extras to correct format
-            package_dict_extras = {}
-            for key in package_dict['extras']:
-                package_dict_extras[key['key']] = key['value']
-            package_dict['extras'] = package_dict_extras
-
-            # Flip tags to correct format
-            package_dict_tags = []
-            for key in package_dict['tags']:
-                package_dict_tags.append(key['name'])
-            package_dict['tags'] = package_dict_tags
-
-            # Update old harvest information with current harvest info
-            package_dict['extras']['harvest_object_id'] = harvest_object.id
-            package_dict['extras']['harvest_source_id']= harvest_object.job.source.id
-            package_dict['extras']['harvest_source_title'] = harvest_object.job.source.title
-
-            # Allow CKAN automation to handle name creation
-            if('name' in package_dict):
-                del package_dict['name']
-
-            if('bureauCode' in package_dict['extras']):
-                package_dict['extras']['bureauCode'] = ast.literal_eval(package_dict['extras']['bureauCode'])
-	    if('programCode' in package_dict['extras']):
-                package_dict['extras']['programCode'] = ast.literal_eval(package_dict['extras']['programCode'])
-
-            log.debug('Import cleanup complete for: %s' % harvest_object.id)
-
-            # Set default extras if needed
-            default_extras = self.config.get('default_extras',{})
-            if default_extras:
-                override_extras = self.config.get('override_extras',False)
-                if not 'extras' in package_dict:
-                    package_dict['extras'] = {}
-                for key,value in default_extras.iteritems():
-                    if not key in package_dict['extras'] or override_extras:
-                        # Look for replacement strings
-                        if isinstance(value,basestring):
-                            value = value.format(harvest_source_id=harvest_object.job.source.id,
-                                     harvest_source_url=harvest_object.job.source.url.strip('/'),
-                                     harvest_source_title=harvest_object.job.source.title,
-                                     harvest_job_id=harvest_object.job.id,
-                                     harvest_object_id=harvest_object.id,
-                                     dataset_id=package_dict['id'])
-
-                        package_dict['extras'][key] = value
-
-            # Clear remote url_type for resources (eg datastore, upload) as we
-            # are only creating normal resources with links to the remote ones
-            for resource in package_dict.get('resources', []):
-                resource.pop('url_type', None)
-
-            result = self._create_or_update_package(package_dict,harvest_object)
-
-            if result and self.config.get('read_only',False) == True:
-
-                package = model.Package.get(package_dict['id'])
-
-                # Clear default permissions
-                model.clear_user_roles(package)
-
-                # Setup harvest user as admin
-                user_name = self.config.get('user',u'harvest')
-                user = model.User.get(user_name)
-                pkg_role = model.PackageRole(package=package, user=user, role=model.Role.ADMIN)
-
-                # Other users can only read
-                for user_name in (u'visitor',u'logged_in'):
-                    user = model.User.get(user_name)
-                    pkg_role = model.PackageRole(package=package, user=user, role=model.Role.READER)
-
-            log.debug('Import complete for: %s' % harvest_object.id)
+                                org = self._get_organization(source_context.url, remote_org)
+                            except RemoteResourceError:
+                                # fallback if remote CKAN exposes organizations as groups
+                                # this especially targets older versions of CKAN
+                                org = self._get_group(source_context.url, remote_org)
+
+                            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name', 'type']:
+                                org.pop(key, None)
+                            get_action('organization_create')(context, org)
+                            log.info('Organization %s has been newly created' % remote_org)
+                            get_cache('local_organizations').set(remote_org,
+                                {'id': org['id'], 'name': org['name']})
+                            validated_org = org['id']
+                        except (RemoteResourceError, ValidationError):
+                            log.error('Could not get remote org %s' % remote_org)
+
+            package_dict['owner_org'] = validated_org or local_org
+
+        log.debug('Organization owner setup for: %s' % harvest_object.id)
+        # Set default groups if needed
+        default_groups = self.config.get('default_groups', [])
+        if default_groups:
+            if not 'groups' in package_dict:
+                package_dict['groups'] = []
+            package_dict['groups'].extend([g for g in default_groups if g not in package_dict['groups']])
+
+        # Download full metadata link if applicable
+        harvest_source_id = None
+        for key in package_dict['extras']:
+            if key['key'] == 'harvest_object_id':
+                harvest_source_id = key['value']
+        if harvest_source_id != None:
+            # Store the full metadata link
+            url = source_context.url.rstrip('/') + '/harvest/object/' + harvest_source_id
+            full_metadata = self._get_content(url)
+            harvest_object.content = full_metadata
+            harvest_object.save()
 
-            return True
-        except ValidationError,e:
-            self._save_object_error('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
-                    harvest_object, 'Import')
-        except Exception, e:
-            self._save_object_error('%r'%e,harvest_object,'Import')
-            log.debug('ImportError %r' % e)
+        log.debug('Got full metadata content for: %s' % harvest_object.id)
+        # Find any extras whose values are not strings and try to convert
+        # them to strings, as non-string extras are not allowed anymore in
+        # CKAN 2.0.
+        for key in package_dict['extras']:
+            if not isinstance(key['value'], basestring):
+                try:
+                    key['value'] = json.dumps(key['value'])
+                except TypeError:
+                    # If converting to a string fails, just delete it.
+                    del key
+
+        # Flip extras to correct format
+        package_dict_extras = {}
+        for key in package_dict['extras']:
+            package_dict_extras[key['key']] = key['value']
+        package_dict['extras'] = package_dict_extras
+
+        # Flip tags to correct format
+        package_dict_tags = []
+        for key in package_dict['tags']:
+            package_dict_tags.append(key['name'])
+        package_dict['tags'] = package_dict_tags
+
+        # Update old harvest information with current harvest info
+        package_dict['extras']['harvest_object_id'] = harvest_object.id
+        package_dict['extras']['harvest_source_id']= source_context.source_id
+        package_dict['extras']['harvest_source_title'] = source_context.title
+
+        # Allow CKAN automation to handle name creation
+        if('name' in package_dict):
+            del package_dict['name']
+
+        if('bureauCode' in package_dict['extras']):
+            package_dict['extras']['bureauCode'] = ast.literal_eval(package_dict['extras']['bureauCode'])
+        if('programCode' in package_dict['extras']):
+            package_dict['extras']['programCode'] = ast.literal_eval(package_dict['extras']['programCode'])
+
+        log.debug('Import cleanup complete for: %s' % harvest_object.id)
+
+        # Set default extras if needed
+        default_extras = self.config.get('default_extras',{})
+        if default_extras:
+            override_extras = self.config.get('override_extras',False)
+            if not 'extras' in package_dict:
+                package_dict['extras'] = {}
+            for key,value in default_extras.iteritems():
+                if not key in package_dict['extras'] or override_extras:
+                    # Look for replacement strings
+                    if isinstance(value,basestring):
+                        value = value.format(harvest_source_id=source_context.source_id,
+                                 harvest_source_url=source_context.url.strip('/'),
+                                 harvest_source_title=source_context.title,
+                                 harvest_job_id=harvest_object.harvest_job_id,
+                                 harvest_object_id=harvest_object.id,
+                                 dataset_id=package_dict['id'])
+
+                    package_dict['extras'][key] = value
+
+        # Clear remote url_type for resources (eg datastore, upload) as we
+        # are only creating normal resources with links to the remote ones
+        for resource in package_dict.get('resources', []):
+            resource.pop('url_type', None)
+
+    def _set_read_only(self, package_dict):
+
+        package = model.Package.get(package_dict['id'])
+
+        # Clear default permissions
+        model.clear_user_roles(package)
+
+        # Setup harvest user as admin
+        user_name = self.config.get('user',u'harvest')
+        user = model.User.get(user_name)
+        pkg_role = model.PackageRole(package=package, user=user, role=model.Role.ADMIN)
+
+        # Other users can only read
+        for user_name in (u'visitor',u'logged_in'):
+            user = model.User.get(user_name)
+            pkg_role = model.PackageRole(package=package, user=user, role=model.Role.READER)
+
+    def import_stage_batch(self, harvest_objects):
+        '''
+        Imports several harvest objects at once, creating or updating their
+        packages in a single transaction per chunk (see
+        HarvesterBase._create_or_update_packages).
+
+        Returns a dict with the import_stage result for each harvest object
+        id.
+        '''
+        log.debug('In CKANHarvester import_stage_batch: %s objects' % len(harvest_objects))
+
+        results = {}
+        objects_by_job = {}
+        for harvest_object in harvest_objects:
+            if harvest_object.report_status in ('deleted', 'unchanged'):
+                log.debug('Nothing to import for %s (%s)' % (harvest_object.id, harvest_object.report_status))
+                results[harvest_object.id] = True
+            elif harvest_object.content is None:
+                self._save_object_error('Empty content for object %s' % harvest_object.id,
+                        harvest_object, 'Import')
+                results[harvest_object.id] = False
+            else:
+                objects_by_job.setdefault(harvest_object.harvest_job_id, []) \
+                    .append(harvest_object)
+
+        for job_id, job_objects in objects_by_job.items():
+            # The config is per source
+            self._set_source_context(job_id)
+            context = {'model': model, 'session': Session,
+                       'user': self.source_context.user_name}
+
+            items = []
+            for harvest_object in job_objects:
+                if harvest_object.content_hash is None and \
+                        self._check_unchanged(harvest_object):
+                    results[harvest_object.id] = True
+                    continue
+                try:
+                    package_dict = json.loads(harvest_object.content)
+
+                    if package_dict.get('type') == 'harvest':
+                        log.warn('Remote dataset is a harvest source, ignoring...')
+                        results[harvest_object.id] = True
+                        continue
+
+                    self._prepare_package_dict(harvest_object, package_dict, context)
+                    items.append((package_dict, harvest_object))
+                except ValidationError,e:
+                    self._save_object_error('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
+                            harvest_object, 'Import')
+                    results[harvest_object.id] = None
+                except Exception, e:
+                    self._save_object_error('%r'%e,harvest_object,'Import')
+                    log.debug('ImportError %r' % e)
+                    results[harvest_object.id] = None
+
+            package_results = self._create_or_update_packages(items)
+            for (package_dict, harvest_object), result in zip(items, package_results):
+                if result and self.config.get('read_only',False) == True:
+                    self._set_read_only(package_dict)
+                log.debug('Import complete for: %s' % harvest_object.id)
+                results[harvest_object.id] = True
+
+        return results
 
 class ContentFetchError(Exception):
-    pass
+    def __init__(self, message, transient=False, code=None):
+        super(ContentFetchError, self).__init__(message)
+        # Whether fetching it again later may work
+        self.transient = transient
+        # HTTP status of the response, if there was one
+        self.code = code
 
 class ContentNotFoundError(Exception):
     pass
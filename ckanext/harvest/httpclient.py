@@ -0,0 +1,610 @@
+'''
+HTTP client used by the harvesters to make requests to remote servers.
+
+Connections are kept open after each request and reused for the following
+requests to the same host, saving a TCP (and TLS) handshake per request.
+Errors are raised as urllib2 exceptions, so callers can handle them as if
+the request had been made with urllib2.urlopen.
+
+If ``ckanext.harvest.http_cache_path`` is set, the responses to requests
+made with ``use_cache`` that have an ETag or Last-Modified header are stored
+in a sqlite database there, and requested again with
+If-None-Match/If-Modified-Since, so unchanged ones are not downloaded again.
+
+The requests to each host go through a HostLimiter, which adapts their rate
+and concurrency to what the host tolerates.
+'''
+import gzip
+import hashlib
+import httplib
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+from email.utils import mktime_tz, parsedate_tz
+from StringIO import StringIO
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+# seconds to wait for a response, can be set with ckanext.harvest.http_timeout
+DEFAULT_TIMEOUT = 30
+MAX_REDIRECTS = 5
+# idle connections kept open per host
+MAX_IDLE_CONNECTIONS = 10
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# bytes of response bodies kept in the response cache, can be set with
+# ckanext.harvest.http_cache_size
+DEFAULT_CACHE_SIZE = 100 * 1024 * 1024
+# seconds the cache stats of a key (eg a harvest job) are kept after its
+# last request
+CACHE_STATS_TTL = 30 * 24 * 3600
+
+# requests per second to a host, initially and at most, can be set with
+# ckanext.harvest.http_rate and ckanext.harvest.http_max_rate
+DEFAULT_RATE = 10
+DEFAULT_MAX_RATE = 100
+MIN_RATE = 0.1
+# requests in flight to a host at most, ckanext.harvest.fetch_concurrency_per_host
+DEFAULT_MAX_CONCURRENCY = 4
+# times a request is repeated when the host says it is overloaded
+MAX_THROTTLED_RETRIES = 3
+# longest pause in seconds taken to honour a Retry-After header
+MAX_RETRY_AFTER = 120
+
+# statuses of an overloaded host, whose requests are repeated. Other 5xx
+# statuses slow down the requests to the host too, but are not repeated
+THROTTLED_CODES = (429, 503)
+
+
+class ConnectionPool(object):
+    '''
+    Keeps the idle connections to each host, so they can be reused by the
+    next request to it from any thread.
+
+    Connections are not shared with forked processes, as they are keyed by
+    process id.
+    '''
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def acquire(self, scheme, netloc, timeout):
+        '''
+        Returns an idle connection to the host, or a new one, and whether
+        it was reused.
+        '''
+        key = (os.getpid(), scheme, netloc)
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                self.stats['hits'] += 1
+                connection = connections.pop()
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+            self.stats['misses'] += 1
+        log.debug('Opening a new connection to %s', netloc)
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=timeout)
+        return connection, False
+
+    def release(self, scheme, netloc, connection):
+        key = (os.getpid(), scheme, netloc)
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < MAX_IDLE_CONNECTIONS:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+connection_pool = ConnectionPool()
+
+
+class HostLimiter(object):
+    '''
+    Limits the requests to a host with a token bucket, and the number of
+    them in flight.
+
+    Both the rate the bucket is refilled at and the number of requests in
+    flight grow additively while the host responds fine, and are halved
+    when it is overloaded or failing (it replies 429 or a 5xx status, or
+    times out). A Retry-After header pauses all the requests to the host.
+    '''
+    def __init__(self, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.rate = float(min(rate, max_rate))
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.concurrency = 1.0
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0
+        self.last_refill = time.time()
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0}
+
+    def acquire(self):
+        '''
+        Waits until a request can be made to the host.
+        '''
+        with self.condition:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    # Until a request finishes
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.stats['requests'] += 1
+                    return
+                self.condition.wait(wait)
+
+    def release(self, overloaded=False, error=False, retry_after=None):
+        '''
+        Records the outcome of a request made after ``acquire``.
+        '''
+        with self.condition:
+            self.in_flight -= 1
+            now = time.time()
+            if overloaded:
+                self.stats['throttled'] += 1
+                # Several requests in flight may fail for the same reason
+                if now - self.last_decrease > 1:
+                    self.rate = max(MIN_RATE, self.rate / 2)
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.tokens = min(self.tokens, 0)
+                    self.last_decrease = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until,
+                                            now + min(retry_after, MAX_RETRY_AFTER))
+            elif error:
+                self.stats['errors'] += 1
+            else:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def _refill(self, now):
+        # The bucket holds up to a second worth of requests
+        self.tokens = min(max(self.rate, 1),
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def get_state(self):
+        with self.condition:
+            state = dict(self.stats)
+            state.update({
+                'rate': round(self.rate, 2),
+                'concurrency': int(self.concurrency),
+                'in_flight': self.in_flight,
+                'paused_for': max(0, round(self.paused_until - time.time(), 1)),
+            })
+            return state
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(netloc):
+    '''
+    Returns the HostLimiter for a host, shared by all the threads of the
+    process.
+    '''
+    with _limiters_lock:
+        limiter = _limiters.get(netloc)
+        if limiter is None:
+            limiter = _limiters[netloc] = HostLimiter(
+                float(config.get('ckanext.harvest.http_rate', DEFAULT_RATE)),
+                float(config.get('ckanext.harvest.http_max_rate',
+                                 DEFAULT_MAX_RATE)),
+                int(config.get('ckanext.harvest.fetch_concurrency_per_host',
+                               DEFAULT_MAX_CONCURRENCY)))
+        return limiter
+
+
+def get_limiter_state_key(source_id):
+    '''
+    Key of the HarvestSystemInfo entry the harvesters store the limiter
+    state of a source in.
+    '''
+    return 'http_limiter:%s' % source_id
+
+
+def get_limiter_state(url):
+    '''
+    Returns the current rate, concurrency and counts of requests of the
+    limiter for the host of url.
+    '''
+    return get_limiter(urlparse.urlsplit(url).netloc).get_state()
+
+
+class ResponseCache(object):
+    '''
+    Stores the responses with validators (ETag or Last-Modified) in a
+    sqlite database, keyed by url (see ``get_cache_key``). When the stored
+    bodies take more than max_size bytes, the least recently used ones are
+    removed. Their total size is kept up to date in the size table, so it
+    is not added up on every insert.
+
+    The hits (304 responses), misses and bytes not downloaded thanks to the
+    cache are counted per stats key, eg the id of the harvest job, in the
+    stats table, so they add up the requests of all the processes sharing
+    the cache.
+    '''
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        with self.lock:
+            connection = self._connection()
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS response (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body BLOB,
+                    size INTEGER,
+                    accessed REAL
+                )''')
+            connection.execute('''
+                CREATE INDEX IF NOT EXISTS response_accessed_idx
+                ON response (accessed)''')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS stats (
+                    key TEXT PRIMARY KEY,
+                    hits INTEGER,
+                    misses INTEGER,
+                    bytes_saved INTEGER,
+                    updated REAL
+                )''')
+            connection.execute('DELETE FROM stats WHERE updated < ?',
+                               (time.time() - CACHE_STATS_TTL,))
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS size (total INTEGER)')
+                if not connection.execute('SELECT 1 FROM size').fetchone():
+                    connection.execute(
+                        'INSERT INTO size SELECT COALESCE(SUM(size), 0) FROM response')
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads or processes
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=30,
+                                                    isolation_level=None)
+            self.local.connection.text_factory = str
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get(self, url):
+        '''
+        Returns the (etag, last_modified, body) stored for url, or None.
+        '''
+        row = self._connection().execute(
+            'SELECT etag, last_modified, body FROM response WHERE url = ?',
+            (url,)).fetchone()
+        if row:
+            return row[0], row[1], str(row[2])
+
+    def touch(self, url):
+        with self.lock:
+            self._connection().execute(
+                'UPDATE response SET accessed = ? WHERE url = ?',
+                (time.time(), url))
+
+    def set(self, url, etag, last_modified, body):
+        if len(body) > self.max_size:
+            return
+        with self.lock:
+            connection = self._connection()
+            # Locks the database for writing, so the total size stays
+            # right with other processes writing to it
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute(
+                    'SELECT size FROM response WHERE url = ?', (url,)).fetchone()
+                connection.execute(
+                    'INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)',
+                    (url, etag, last_modified, sqlite3.Binary(body), len(body),
+                     time.time()))
+                connection.execute('UPDATE size SET total = total + ?',
+                                   (len(body) - (row[0] if row else 0),))
+                total, = connection.execute('SELECT total FROM size').fetchone()
+                if total > self.max_size:
+                    self._evict(connection, total - self.max_size)
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _evict(self, connection, excess):
+        removed = 0
+        urls = []
+        for url, size in connection.execute(
+                'SELECT url, size FROM response ORDER BY accessed'):
+            if removed >= excess:
+                break
+            urls.append(url)
+            removed += size
+        connection.executemany('DELETE FROM response WHERE url = ?',
+                               [(url,) for url in urls])
+        connection.execute('UPDATE size SET total = total - ?', (removed,))
+        log.debug('Removed %s responses from the HTTP cache', len(urls))
+
+    def count(self, stats_key, hits=0, misses=0, bytes_saved=0):
+        with self.lock:
+            connection = self._connection()
+            key = stats_key or ''
+            connection.execute(
+                'INSERT OR IGNORE INTO stats VALUES (?, 0, 0, 0, ?)',
+                (key, time.time()))
+            connection.execute(
+                '''UPDATE stats SET hits = hits + ?, misses = misses + ?,
+                       bytes_saved = bytes_saved + ?, updated = ?
+                   WHERE key = ?''',
+                (hits, misses, bytes_saved, time.time(), key))
+
+    def get_stats(self, stats_key):
+        row = self._connection().execute(
+            'SELECT hits, misses, bytes_saved FROM stats WHERE key = ?',
+            (stats_key or '',)).fetchone()
+        if row:
+            return {'hits': row[0], 'misses': row[1], 'bytes_saved': row[2]}
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    '''
+    Returns the response cache, or None if ckanext.harvest.http_cache_path
+    is not set.
+    '''
+    global _response_cache
+    path = config.get('ckanext.harvest.http_cache_path')
+    if not path:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None or _response_cache.path != path:
+            max_size = int(config.get('ckanext.harvest.http_cache_size',
+                                      DEFAULT_CACHE_SIZE))
+            _response_cache = ResponseCache(path, max_size)
+        return _response_cache
+
+
+def get_cache_stats(stats_key=None):
+    '''
+    Returns the hits, misses and bytes saved by the response cache for the
+    given stats key (eg a harvest job id).
+    '''
+    response_cache = get_response_cache()
+    stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+    if response_cache:
+        stats.update(response_cache.get_stats(stats_key) or {})
+    return stats
+
+
+def get_cache_key(url, headers):
+    '''
+    Returns the key of the response to a request in the response cache.
+    Responses to authenticated requests are only served to requests with
+    the same credentials.
+    '''
+    authorization = dict((key.lower(), value) for key, value
+                         in (headers or {}).items()).get('authorization')
+    if not authorization:
+        return url
+    return '%s auth:%s' % (url, hashlib.sha1(authorization).hexdigest())
+
+
+def get_stats():
+    '''
+    Returns the number of requests that reused an open connection (hits)
+    and that had to open a new one (misses).
+    '''
+    return dict(connection_pool.stats)
+
+
+def get_timeout():
+    try:
+        return float(config.get('ckanext.harvest.http_timeout',
+                                DEFAULT_TIMEOUT))
+    except ValueError:
+        return DEFAULT_TIMEOUT
+
+
+def get(url, headers=None, timeout=None, stats_key=None, use_cache=False):
+    '''
+    Makes a GET request to url and returns the body of the response,
+    following redirects and decompressing it if needed.
+
+    If use_cache is set, the response cache is enabled and has a response
+    for url, the request is conditional, and the stored body is returned if
+    the server replies that it has not been modified. The cache hits and
+    misses are counted under stats_key. It is meant for documents requested
+    again on each harvest, eg a dataset, not for paged listings, which
+    change all the time.
+
+    Raises urllib2.HTTPError if the response status is 400 or higher, and
+    urllib2.URLError if the server could not be reached.
+    '''
+    timeout = timeout or get_timeout()
+    request_headers = {'Accept-Encoding': 'gzip, deflate'}
+    request_headers.update(headers or {})
+
+    response_cache = get_response_cache() if use_cache else None
+    cache_key = get_cache_key(url, request_headers)
+    cached = response_cache.get(cache_key) if response_cache else None
+    conditional_headers = dict(request_headers)
+    if cached:
+        etag, last_modified, cached_body = cached
+        if etag:
+            conditional_headers['If-None-Match'] = etag
+        if last_modified:
+            conditional_headers['If-Modified-Since'] = last_modified
+
+    for i in range(MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise urllib2.URLError('Unsupported URL scheme: %s' % url)
+        if parts.scheme in urllib.getproxies():
+            # Let urllib2 handle the proxy
+            return _get_with_urllib2(url, request_headers, timeout)
+
+        response, body = _limited_request(parts, conditional_headers, timeout)
+
+        location = response.getheader('location')
+        if response.status in REDIRECT_CODES and location:
+            url = urlparse.urljoin(url, location)
+            continue
+        if response.status == 304 and cached:
+            response_cache.touch(cache_key)
+            response_cache.count(stats_key, hits=1,
+                                 bytes_saved=len(cached_body))
+            return cached_body
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(body))
+        if response_cache:
+            response_cache.count(stats_key, misses=1)
+            etag = response.getheader('etag')
+            last_modified = response.getheader('last-modified')
+            if etag or last_modified:
+                response_cache.set(cache_key, etag, last_modified, body)
+        return body
+
+    raise urllib2.URLError('Too many redirects: %s' % url)
+
+
+def _limited_request(parts, headers, timeout):
+    '''
+    Makes the request once the host limiter allows it, repeating it with
+    a backoff if the host is overloaded. Server errors slow down the next
+    requests, but are returned to the caller.
+    '''
+    limiter = get_limiter(parts.netloc)
+    for attempt in range(MAX_THROTTLED_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response, body = _request(parts, headers, timeout)
+        except urllib2.URLError, e:
+            limiter.release(overloaded=isinstance(e.reason, socket.timeout),
+                            error=True)
+            raise
+        except:
+            limiter.release(error=True)
+            raise
+        if response.status not in THROTTLED_CODES:
+            limiter.release(overloaded=response.status >= 500)
+            return response, body
+
+        retry_after = _parse_retry_after(response.getheader('retry-after'))
+        if not retry_after:
+            # Exponential backoff with jitter
+            retry_after = (2 ** attempt) * (1 + random.random())
+        limiter.release(overloaded=True, retry_after=retry_after)
+        if attempt < MAX_THROTTLED_RETRIES:
+            log.info('%s replied %s, retrying in %.1f seconds', parts.netloc,
+                     response.status, min(retry_after, MAX_RETRY_AFTER))
+    return response, body
+
+
+def _parse_retry_after(value):
+    '''
+    Returns the seconds to wait given by a Retry-After header, which can be
+    a number of seconds or a date.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date:
+            return max(0, mktime_tz(date) - time.time())
+    return None
+
+
+def _request(parts, headers, timeout):
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    while True:
+        connection, reused = connection_pool.acquire(parts.scheme,
+                                                     parts.netloc, timeout)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            connection.close()
+            if reused:
+                # The server closed the idle connection, try with a new one
+                continue
+            raise urllib2.URLError(e)
+
+        if response.will_close:
+            connection.close()
+        else:
+            connection_pool.release(parts.scheme, parts.netloc, connection)
+        return response, _decode(response.getheader('content-encoding'),
+                                 body)
+
+
+def _decode(encoding, body):
+    encoding = (encoding or '').lower()
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=StringIO(body)).read()
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # raw deflate stream, without the zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def _get_with_urllib2(url, headers, timeout):
+    request = urllib2.Request(url, headers=headers)
+    response = urllib2.urlopen(request, timeout=timeout)
+    return _decode(response.info().getheader('content-encoding'),
+                   response.read())
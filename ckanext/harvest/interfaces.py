@@ -1,5 +1,16 @@
 from ckan.plugins.interfaces import Interface
 
+class RetryLater(Exception):
+    '''
+    Raised by the fetch or import stage of a harvester when a harvest object
+    could not be handled because of a transient failure (eg the remote
+    server timed out or is overloaded), to have it sent back to its queue
+    and tried again after a delay.
+
+    Batch stages can return an instance of it as the result of a harvest
+    object instead.
+    '''
+
 class IHarvester(Interface):
     '''
     Common harvesting interface
@@ -83,8 +94,14 @@ class IHarvester(Interface):
               occur.
             - returning a list with all the ids of the created HarvestObjects.
 
+        Alternatively, it can return an iterator (e.g. a generator) yielding
+        the ids of the HarvestObjects as they are created, which are sent
+        to the fetch queue in chunks while the gathering goes on. Each
+        HarvestObject must be committed before its id is yielded.
+        HarvesterBase._create_harvest_objects_iter can be used for this.
+
         :param harvest_job: HarvestJob object
-        :returns: A list of HarvestObject ids
+        :returns: A list or an iterator of HarvestObject ids
         '''
 
     def fetch_stage(self, harvest_object):
@@ -97,11 +114,31 @@ class IHarvester(Interface):
             - creating and storing any suitable HarvestObjectErrors that may
               occur.
             - returning True if everything went as expected, False otherwise.
+            - raising RetryLater if the object could not be fetched because
+              of a transient failure. It is fetched again after a delay,
+              until ``ckan.harvest.mq.max_retries`` is reached.
 
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         '''
 
+    def fetch_stage_batch(self, harvest_objects):
+        '''
+
+        [optional]
+
+        Harvesters can provide this method to fetch several harvest objects
+        at once, eg to keep several requests to the remote server in flight.
+        It is used instead of ``fetch_stage`` when the fetch consumer is run
+        with ``--batch-size``. The same responsibilities as ``fetch_stage``
+        apply for each of the harvest objects.
+
+        :param harvest_objects: A list of HarvestObject objects
+        :returns: A dict with the result ``fetch_stage`` would have returned
+                  for each HarvestObject id, or the RetryLater it would have
+                  raised
+        '''
+
     def import_stage(self, harvest_object):
         '''
         The import stage will receive a HarvestObject object and will be
@@ -118,3 +155,21 @@ class IHarvester(Interface):
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         '''
+
+    def import_stage_batch(self, harvest_objects):
+        '''
+
+        [optional]
+
+        Harvesters can provide this method to import several harvest objects
+        at once, eg to create or update their packages in a single
+        transaction (see HarvesterBase._create_or_update_packages). It is
+        used instead of ``import_stage`` when the fetch or import consumer
+        is run with ``--batch-size``. The same responsibilities as
+        ``import_stage`` apply for each of the harvest objects.
+
+        :param harvest_objects: A list of HarvestObject objects
+        :returns: A dict with the result ``import_stage`` would have returned
+                  for each HarvestObject id, or the RetryLater it would have
+                  raised
+        '''
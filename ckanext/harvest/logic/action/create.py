@@ -51,6 +51,10 @@ def harvest_source_create(context,data_dict):
         ``ckanext.harvest.model`` source for possible values. Default is
         'MANUAL'
     :type frequency: string
+    :param weight: the share of the fetch queue given to this source when
+        fair scheduling is enabled, relative to the other sources
+        (optional, default: 1)
+    :type weight: int
     :param config: extra configuration options for the particular harvester
         type. Should be a serialized as JSON. (optional)
     :type config: string
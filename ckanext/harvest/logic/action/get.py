@@ -5,13 +5,13 @@ from ckan.model import User
 import datetime
 
 from ckan import logic
-from ckan.plugins import PluginImplementations
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.registry import get_harvester, get_harvesters_info
 
 import ckan.plugins as p
 from ckan.logic import NotFound, check_access, side_effect_free
 
 from ckanext.harvest import model as harvest_model
+from ckanext.harvest import httpclient
 
 from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject)
 from ckanext.harvest.logic.dictization import (harvest_source_dictize,
@@ -90,6 +90,13 @@ def harvest_source_show_status(context, data_dict):
            'total_datasets': 0,
            }
 
+    # State of the limiter of the requests to the source host, as last
+    # stored by the harvester
+    limiter_state = harvest_model.HarvestSystemInfo.get_value(
+        httpclient.get_limiter_state_key(source.id))
+    if limiter_state:
+        out['http_limiter'] = json.loads(limiter_state)
+
     jobs = harvest_model.HarvestJob.filter(source=source).all()
 
     job_count = len(jobs)
@@ -107,6 +114,11 @@ def harvest_source_show_status(context, data_dict):
 
     out['last_job'] = harvest_job_dictize(last_job, context)
 
+    # Response cache stats of the last job, shared by all the processes
+    # using the cache
+    if httpclient.get_response_cache():
+        out['http_cache'] = httpclient.get_cache_stats(last_job.id)
+
     # Overall statistics
     packages = model.Session.query(model.Package) \
             .join(harvest_model.HarvestObject) \
@@ -209,10 +221,9 @@ def harvest_job_report(context, data_dict):
     # Check if the harvester for this job's source has a method for returning
     # the URL to the original document
     original_url_builder = None
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == job.source.type:
-             if hasattr(harvester, 'get_original_url'):
-                original_url_builder = harvester.get_original_url
+    harvester = get_harvester(job.source.type)
+    if harvester and hasattr(harvester, 'get_original_url'):
+        original_url_builder = harvester.get_original_url
 
     q = model.Session.query(harvest_model.HarvestObjectError, harvest_model.HarvestObject.guid) \
                       .join(harvest_model.HarvestObject) \
@@ -327,11 +338,7 @@ def harvesters_info_show(context,data_dict):
     check_access('harvesters_info_show',context,data_dict)
 
     available_harvesters = []
-    for harvester in PluginImplementations(IHarvester):
-        info = harvester.info()
-        if not info or 'name' not in info:
-            log.error('Harvester %r does not provide the harvester name in the info response' % str(harvester))
-            continue
+    for info in get_harvesters_info():
         info['show_config'] = (info.get('form_config_interface','') == 'Text')
         available_harvesters.append(info)
 
@@ -8,16 +8,16 @@ from paste.deploy.converters import asbool
 from sqlalchemy import and_, or_, exc
 import ckan.lib.search as search
 from ckan.lib.search.index import PackageSearchIndex
-from ckan.plugins import PluginImplementations
 from ckan.logic import get_action
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.registry import get_harvester
 from ckan.lib.search.common import SearchIndexError, make_connection
 from ckan.model import Package
 from ckan import logic
 from ckan.plugins import toolkit
 from ckan.logic import NotFound, check_access
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
-from ckanext.harvest.queue import get_gather_publisher, resubmit_jobs
+from ckanext.harvest.queue import get_gather_publisher, resubmit_jobs, \
+                                  commit_and_send
 from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, HarvestSystemInfo
 from ckanext.harvest.logic import HarvestJobExists
 from ckanext.harvest.logic.action.get import harvest_source_show, harvest_job_list, _get_sources_for_user
@@ -58,6 +58,10 @@ def harvest_source_update(context, data_dict):
         ``ckanext.harvest.model`` source for possible values. Default is
         'MANUAL'
     :type frequency: string
+    :param weight: the share of the fetch queue given to this source when
+        fair scheduling is enabled, relative to the other sources
+        (optional, default: 1)
+    :type weight: int
     :param config: extra configuration options for the particular harvester
         type. Should be a serialized as JSON. (optional)
     :type config: string
@@ -268,12 +272,11 @@ def harvest_objects_import(context, data_dict):
 
         obj = session.query(HarvestObject).get(obj_id)
 
-        for harvester in PluginImplementations(IHarvester):
-            if harvester.info()['name'] == obj.source.type:
-                if hasattr(harvester, 'force_import'):
-                    harvester.force_import = True
-                harvester.import_stage(obj)
-                break
+        harvester = get_harvester(obj.source.type)
+        if harvester:
+            if hasattr(harvester, 'force_import'):
+                harvester.force_import = True
+            harvester.import_stage(obj)
         last_objects_count += 1
     log.info('Harvest objects imported: %s', last_objects_count)
     return last_objects_count
@@ -577,6 +580,7 @@ def harvest_jobs_run(context, data_dict):
                         msg += 'Records in Error: ' + str(out['last_job']['stats'].get('errored', 0)) + '\n'
                         msg += 'Records Added: ' + str(out['last_job']['stats'].get('added', 0)) + '\n'
                         msg += 'Records Updated: ' + str(out['last_job']['stats'].get('updated', 0)) + '\n'
+                        msg += 'Records Unchanged: ' + str(out['last_job']['stats'].get('unchanged', 0)) + '\n'
                         msg += 'Records Deleted: ' + str(out['last_job']['stats'].get('deleted', 0)) + '\n\n'
 
                         obj_error = ''
@@ -695,8 +699,8 @@ def harvest_jobs_run(context, data_dict):
         if source['active']:
             job_obj = HarvestJob.get(job['id'])
             job_obj.status = job['status'] = u'Running'
-            job_obj.save()
-            publisher.send({'harvest_job_id': job['id']})
+            job_obj.add()
+            commit_and_send(lambda: publisher.send({'harvest_job_id': job['id']}))
             log.info('Sent job %s to the gather queue' % job['id'])
             sent_jobs.append(job)
 
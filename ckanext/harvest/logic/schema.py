@@ -21,6 +21,7 @@ from ckanext.harvest.logic.validators import (harvest_source_url_validator,
                                               harvest_source_config_validator,
                                               harvest_source_extra_validator,
                                               harvest_source_frequency_exists,
+                                              harvest_source_weight_validator,
                                               dataset_type_exists,
                                               harvest_source_convert_from_config,
                                               harvest_source_id_exists,
@@ -42,6 +43,7 @@ def harvest_source_schema():
         'private': [ignore_missing, boolean_validator],
         'organization': [ignore_missing],
         'frequency': [ignore_missing, unicode, harvest_source_frequency_exists, convert_to_extras],
+        'weight': [ignore_missing, harvest_source_weight_validator, convert_to_extras],
         'state': [ignore_missing],
         'config': [ignore_missing, harvest_source_config_validator, convert_to_extras],
         'extras': default_extras_schema(),
@@ -81,6 +83,7 @@ def harvest_source_show_package_schema():
     schema.update({
         'source_type': [convert_from_extras, ignore_missing],
         'frequency': [convert_from_extras, ignore_missing],
+        'weight': [convert_from_extras, ignore_missing],
         'config': [convert_from_extras, harvest_source_convert_from_config, ignore_missing],
         'metadata_created': [],
         'metadata_modified': [],
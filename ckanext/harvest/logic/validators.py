@@ -9,6 +9,7 @@ from ckan.plugins import PluginImplementations
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
 from ckanext.harvest.model import HarvestSource, UPDATE_FREQUENCIES, HarvestJob
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.registry import get_harvester
 
 from ckan.lib.navl.validators import keep_extras
 
@@ -85,33 +86,22 @@ def harvest_source_url_validator(key,data,errors,context):
 def harvest_source_type_exists(value,context):
     #TODO: use new description interface
 
-    # Get all the registered harvester types
-    available_types = []
-    for harvester in PluginImplementations(IHarvester):
-        info = harvester.info()
-        if not info or 'name' not in info:
-            log.error('Harvester %r does not provide the harvester name in the info response' % str(harvester))
-            continue
-        available_types.append(info['name'])
-
-
-    if not value in available_types:
+    if get_harvester(value) is None:
         raise Invalid('Unknown harvester type: %s. Have you registered a harvester for this type?' % value)
 
     return value
 
 def harvest_source_config_validator(key,data,errors,context):
     harvester_type = data.get(('source_type',),'')
-    for harvester in PluginImplementations(IHarvester):
-        info = harvester.info()
-        if info['name'] == harvester_type:
-            if hasattr(harvester, 'validate_config'):
-                try:
-                    return harvester.validate_config(data[key])
-                except Exception, e:
-                    raise Invalid('Error parsing the configuration options: %s' % str(e))
-            else:
-                return data[key]
+    harvester = get_harvester(harvester_type)
+    if harvester:
+        if hasattr(harvester, 'validate_config'):
+            try:
+                return harvester.validate_config(data[key])
+            except Exception, e:
+                raise Invalid('Error parsing the configuration options: %s' % str(e))
+        else:
+            return data[key]
 
 def keep_not_empty_extras(key, data, errors, context):
     extras = data.pop(key, {})
@@ -131,14 +121,9 @@ def harvest_source_extra_validator(key,data,errors,context):
         all_extra_fields.update(harvester.extra_schema().keys())
 
     extra_schema = {'__extras': [keep_not_empty_extras]}
-    for harvester in PluginImplementations(IHarvester):
-        if not hasattr(harvester, 'extra_schema'):
-            continue
-        info = harvester.info()
-        if not info['name'] == harvester_type:
-            continue
+    harvester = get_harvester(harvester_type)
+    if harvester and hasattr(harvester, 'extra_schema'):
         extra_schema.update(harvester.extra_schema())
-        break
 
     extra_data, extra_errors = validate(data.get(key, {}), extra_schema)
     for key in extra_data.keys():
@@ -199,6 +184,17 @@ def harvest_source_frequency_exists(value):
         raise Invalid('Frequency %s not recognised' % value)
     return value.upper()
 
+def harvest_source_weight_validator(value):
+    if value in (None, ''):
+        return 1
+    try:
+        value = int(value)
+    except (ValueError, TypeError):
+        raise Invalid('Weight must be an integer')
+    if value < 1:
+        raise Invalid('Weight must be a positive integer')
+    return value
+
 
 def dataset_type_exists(value):
     if value != DATASET_TYPE_NAME:
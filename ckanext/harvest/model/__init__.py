@@ -1,5 +1,8 @@
 import logging
 import datetime
+import hashlib
+import itertools
+import json
 import uuid
 
 from sqlalchemy import event
@@ -7,10 +10,14 @@ from sqlalchemy import distinct
 from sqlalchemy import Table
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import types
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import backref, relation
 
+from pylons import config
+from paste.deploy.converters import asbool
+
 from ckan import model
 from ckan import logic
 from ckan.model.meta import metadata,  mapper, Session
@@ -21,6 +28,9 @@ from ckan.lib.munge import munge_title_to_name
 
 UPDATE_FREQUENCIES = ['MANUAL','MONTHLY','WEEKLY','BIWEEKLY','DAILY', 'ALWAYS']
 
+# Rows inserted per statement by HarvestObject.bulk_create
+BULK_CREATE_CHUNK_SIZE = 1000
+
 log = logging.getLogger(__name__)
 
 __all__ = [
@@ -72,6 +82,20 @@ def setup():
             if not 'frequency' in [column['name'] for column in columns]:
                 log.debug('Harvest tables need to be updated')
                 migrate_v3()
+            if not 'weight' in [column['name'] for column in columns]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v4()
+            indexes = inspector.get_indexes('harvest_object')
+            if not 'harvest_object_package_id_idx' in [index['name'] for index in indexes]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v5()
+            columns = inspector.get_columns('harvest_object')
+            if not 'content_hash' in [column['name'] for column in columns]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v6()
+            if not 'queue' in [column['name'] for column in columns]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v7()
 
             # Check if this instance has harvest source datasets
             ## disable migrate check for now. takes too much time.
@@ -143,6 +167,123 @@ class HarvestObject(HarvestDomainObject):
 
     '''
 
+    @classmethod
+    def bulk_create(cls, job, items, chunk_size=BULK_CREATE_CHUNK_SIZE):
+        '''
+        Creates a harvest object in the given job for each of the items,
+        which can be guids or dicts with a guid and optionally a content and
+        a dict of extras.
+
+        The ids are generated here and the rows inserted with a single
+        executemany statement per chunk, which is committed. This skips the
+        ORM, so the before insert listener is not called and the source id
+        is taken from the job.
+
+        Returns the list of ids of the new harvest objects.
+        '''
+        ids = []
+        items = iter(items)
+        while True:
+            rows = []
+            extra_rows = []
+            for item in itertools.islice(items, chunk_size):
+                if isinstance(item, basestring):
+                    item = {'guid': item}
+                rows.append({
+                    'id': make_uuid(),
+                    'guid': item['guid'],
+                    'content': item.get('content'),
+                    'harvest_job_id': job.id,
+                    'harvest_source_id': job.source_id,
+                })
+                for key, value in item.get('extras', {}).iteritems():
+                    extra_rows.append({
+                        'id': make_uuid(),
+                        'harvest_object_id': rows[-1]['id'],
+                        'key': key,
+                        'value': value,
+                    })
+            if not rows:
+                break
+            Session.connection().execute(harvest_object_table.insert(), rows)
+            if extra_rows:
+                Session.connection().execute(
+                    harvest_object_extra_table.insert(), extra_rows)
+            Session.commit()
+            ids.extend(row['id'] for row in rows)
+        return ids
+
+    def get_current_object(self):
+        '''
+        Returns the id, content hash and package id of the current harvest
+        object with the same guid in the source, if there is one and its
+        package is active.
+        '''
+        return Session.query(HarvestObject.id, HarvestObject.content_hash,
+                             HarvestObject.package_id) \
+            .join(Package, Package.id == HarvestObject.package_id) \
+            .filter(Package.state == u'active') \
+            .filter(HarvestObject.harvest_source_id == self.harvest_source_id) \
+            .filter(HarvestObject.guid == self.guid) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.id != self.id) \
+            .first()
+
+    # State transitions. The timestamps and states are only set in memory,
+    # and committed in one go when the next stage starts, unless
+    # ckan.harvest.commit_per_object is set, in which case they are only
+    # committed once the object is finished (see ``finish``).
+
+    def start_fetch(self, commit=True):
+        self.fetch_started = datetime.datetime.utcnow()
+        self.state = u'FETCH'
+        self._stage_boundary(commit)
+
+    def finish_fetch(self, success):
+        self.fetch_finished = datetime.datetime.utcnow()
+        if not success:
+            self.state = u'ERROR'
+
+    def start_import(self, commit=True):
+        self.import_started = datetime.datetime.utcnow()
+        self.state = u'IMPORT'
+        self._stage_boundary(commit)
+
+    def finish_import(self, success):
+        self.import_finished = datetime.datetime.utcnow()
+        self.state = u'COMPLETE' if success else u'ERROR'
+
+    def finish(self):
+        '''Commits all the pending changes of the object'''
+        self.save()
+
+    def _stage_boundary(self, commit):
+        if commit and not asbool(config.get('ckan.harvest.commit_per_object',
+                                            False)):
+            self.save()
+        else:
+            self.add()
+
+def make_content_hash(content, *extra):
+    '''
+    Returns a fingerprint of the content of a harvest object, plus any
+    other strings that affect its import (eg the source config).
+
+    JSON content is normalised first, so the order of its keys and the
+    whitespace don't matter.
+    '''
+    try:
+        content = json.dumps(json.loads(content), sort_keys=True)
+    except (TypeError, ValueError):
+        pass
+    content_hash = hashlib.sha1()
+    for value in (content,) + extra:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        content_hash.update(value or '')
+        content_hash.update('\0')
+    return unicode(content_hash.hexdigest())
+
 class HarvestObjectExtra(HarvestDomainObject):
     '''Extra key value data for Harvest objects'''
 
@@ -161,6 +302,19 @@ class HarvestObjectError(HarvestDomainObject):
 class HarvestSystemInfo(HarvestDomainObject):
     '''Some system info for harvest'''
 
+    @classmethod
+    def get_value(cls, key, default=None):
+        obj = Session.query(cls).filter_by(key=key).first()
+        return obj.value if obj else default
+
+    @classmethod
+    def set_value(cls, key, value):
+        obj = Session.query(cls).filter_by(key=key).first()
+        if not obj:
+            obj = cls(key=key)
+        obj.value = unicode(value)
+        obj.save()
+
 def harvest_object_before_insert_listener(mapper,connection,target):
     '''
         For compatibility with old harvesters, check if the source id has
@@ -196,6 +350,7 @@ def define_harvester_tables():
         Column('publisher_id', types.UnicodeText, default=u''),
         Column('frequency', types.UnicodeText, default=u'MANUAL'),
         Column('next_run', types.DateTime),
+        Column('weight', types.Integer, default=1),
     )
     # Was harvesting_job
     harvest_job_table = Table('harvest_job', metadata,
@@ -206,7 +361,14 @@ def define_harvester_tables():
         Column('finished', types.DateTime),
         Column('source_id', types.UnicodeText, ForeignKey('harvest_source.id')),
         Column('status', types.UnicodeText, default=u'New', nullable=False),
+        # Queue the job is waiting in and when it can be taken from it, on
+        # the postgres queue backend
+        Column('queue', types.UnicodeText, nullable=True),
+        Column('queue_due', types.DateTime, nullable=True),
     )
+    Index('harvest_job_queue_idx', harvest_job_table.c.queue,
+          harvest_job_table.c.queue_due,
+          postgresql_where=harvest_job_table.c.queue != None)
     # Was harvested_document
     harvest_object_table = Table('harvest_object', metadata,
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
@@ -225,7 +387,16 @@ def define_harvester_tables():
         Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id')),
         Column('package_id', types.UnicodeText, ForeignKey('package.id', deferrable=True), nullable=True),
         Column('report_status', types.UnicodeText, nullable=True),
+        Column('content_hash', types.UnicodeText, nullable=True),
+        Column('queue', types.UnicodeText, nullable=True),
+        Column('queue_due', types.DateTime, nullable=True),
     )
+    Index('harvest_object_package_id_idx', harvest_object_table.c.package_id)
+    Index('harvest_object_source_guid_idx', harvest_object_table.c.harvest_source_id,
+          harvest_object_table.c.guid)
+    Index('harvest_object_queue_idx', harvest_object_table.c.queue,
+          harvest_object_table.c.queue_due,
+          postgresql_where=harvest_object_table.c.queue != None)
 
     # New table
     harvest_object_extra_table = Table('harvest_object_extra', metadata,
@@ -429,6 +600,62 @@ ALTER TABLE harvest_object_error
     Session.commit()
     log.info('Harvest tables migrated to v3')
 
+def migrate_v4():
+    log.debug('Migrating harvest tables to v4.')
+    conn = Session.connection()
+
+    statement = """
+ALTER TABLE harvest_source
+    ADD COLUMN weight integer;
+
+UPDATE harvest_source set weight = 1;
+"""
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v4')
+
+def migrate_v5():
+    log.debug('Migrating harvest tables to v5. This may take a while...')
+    conn = Session.connection()
+
+    statement = """
+CREATE INDEX harvest_object_package_id_idx ON harvest_object (package_id);
+"""
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v5')
+
+def migrate_v6():
+    log.debug('Migrating harvest tables to v6. This may take a while...')
+    conn = Session.connection()
+
+    statement = """
+ALTER TABLE harvest_object
+	ADD COLUMN content_hash text;
+CREATE INDEX harvest_object_source_guid_idx ON harvest_object (harvest_source_id, guid);
+"""
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v6')
+
+def migrate_v7():
+    log.debug('Migrating harvest tables to v7. This may take a while...')
+    conn = Session.connection()
+
+    statement = """
+ALTER TABLE harvest_job
+	ADD COLUMN queue text,
+	ADD COLUMN queue_due timestamp without time zone;
+ALTER TABLE harvest_object
+	ADD COLUMN queue text,
+	ADD COLUMN queue_due timestamp without time zone;
+CREATE INDEX harvest_job_queue_idx ON harvest_job (queue, queue_due) WHERE queue IS NOT NULL;
+CREATE INDEX harvest_object_queue_idx ON harvest_object (queue, queue_due) WHERE queue IS NOT NULL;
+"""
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v7')
+
 class PackageIdHarvestSourceIdMismatch(Exception):
     """
     The package created for the harvest source must match the id of the
@@ -12,6 +12,8 @@ from ckan.lib.navl import dictization_functions
 from ckanext.harvest.logic.action.get import harvest_source_show_status
 
 from ckanext.harvest.model import setup as model_setup
+from ckanext.harvest import registry as harvest_registry
+from ckanext.harvest.cache import get_cache
 from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
 
 
@@ -218,6 +220,10 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm):
         return map
 
     def update_config(self, config):
+        # Called again whenever plugins are loaded or unloaded, so the
+        # harvester plugins may have changed
+        harvest_registry.reset()
+
         # check if new templates
         templates = 'templates'
         if p.toolkit.check_ckan_version(min_version='2.0'):
@@ -327,9 +333,11 @@ def _create_harvest_source_object(context, data_dict):
     source.type = data_dict['source_type']
 
     opt = ['active', 'title', 'description', 'user_id',
-           'publisher_id', 'config', 'frequency']
+           'publisher_id', 'config', 'frequency', 'weight']
     for o in opt:
         if o in data_dict and data_dict[o] is not None:
+            if o == 'weight':
+                data_dict[o] = int(data_dict[o])
             source.__setattr__(o,data_dict[o])
 
     source.active = not data_dict.get('state', None) == 'deleted'
@@ -363,11 +371,13 @@ def _update_harvest_source_object(context, data_dict):
 
 
     fields = ['url', 'title', 'description', 'user_id',
-              'publisher_id', 'frequency']
+              'publisher_id', 'frequency', 'weight']
     for f in fields:
         if f in data_dict and data_dict[f] is not None:
             if f == 'url':
                 data_dict[f] = data_dict[f].strip()
+            if f == 'weight':
+                data_dict[f] = int(data_dict[f])
             source.__setattr__(f,data_dict[f])
 
     # Avoids clashes with the dataset type
@@ -384,6 +394,10 @@ def _update_harvest_source_object(context, data_dict):
     # Don't commit yet, let package_create do it
     source.add()
 
+    # The harvesters of other processes notice the change by the
+    # metadata_modified of the source dataset (see _get_source_context)
+    get_cache('source_contexts').clear()
+
     # Abort any pending jobs
     if not source.active:
         jobs = HarvestJob.filter(source=source,status=u'New')
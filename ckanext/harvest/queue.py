@@ -1,21 +1,32 @@
 import logging
 import datetime
 import json
+import os
+import random
+import select
+import socket
+import time
 
 import pika
+from paste.deploy.converters import asbool
 
 from ckan.lib.base import config
-from ckan.plugins import PluginImplementations
 from ckan import model
 
-from ckanext.harvest.model import HarvestJob, HarvestObject,HarvestGatherError
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.model import HarvestJob, HarvestObject,HarvestGatherError, \
+                                   HarvestObjectError
+from ckanext.harvest.registry import get_harvester
+from ckanext.harvest import httpclient
+from ckanext.harvest import cache
+from ckanext.harvest.interfaces import RetryLater
 
 log = logging.getLogger(__name__)
 assert not log.disabled
 
 __all__ = ['get_gather_publisher', 'get_gather_consumer', \
-           'get_fetch_publisher', 'get_fetch_consumer']
+           'get_fetch_publisher', 'get_fetch_consumer', \
+           'get_import_publisher', 'get_import_consumer', \
+           'get_connection_stats']
 
 PORT = 5672
 USERID = 'guest'
@@ -30,7 +41,198 @@ REDIS_DB = 0
 EXCHANGE_TYPE = 'direct'
 EXCHANGE_NAME = 'ckan.harvest'
 
-def get_connection():
+# number of messages sent to the broker in a single round trip by send_many
+PUBLISH_CHUNK_SIZE = 1000
+
+# seconds a message can be in-flight before being resubmitted to its queue
+QUEUE_TYPES = {'harvest_job_id': 'gather', 'harvest_object_id': 'fetch',
+               'harvest_import_object_id': 'import'}
+VISIBILITY_TIMEOUTS = {
+    'gather': 7200, # 2 hours for a gather
+    'fetch': 180,   # 3 minutes for fetch and import
+    'import': 180,  # 3 minutes for import, if run from its own queue
+}
+REQUEUE_CHUNK_SIZE = 1000
+
+# seconds a pooled connection can stay idle before being checked again
+HEALTH_CHECK_INTERVAL = 30
+# errors raised when publishing on an AMQP connection that was dropped
+AMQP_CONNECTION_ERRORS = (pika.exceptions.AMQPConnectionError,
+                          pika.exceptions.AMQPChannelError, socket.error)
+
+# deliveries of a harvest object before it is dead lettered, and seconds
+# before the first retry of a transient failure, doubled on each retry up
+# to a maximum
+MAX_RETRIES = 5
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+# seconds between checks for delayed messages that are due, on Redis and
+# PostgreSQL
+DELAYED_POLL_INTERVAL = 5
+# seconds between logs of the connection stats of a consumer
+STATS_INTERVAL = 300
+
+# tables holding the messages of each queue on the postgres backend
+POSTGRES_QUEUE_TABLES = {'harvest_job_id': 'harvest_job',
+                         'harvest_object_id': 'harvest_object',
+                         'harvest_import_object_id': 'harvest_object'}
+
+# number of jobs whose previously harvested packages are kept in memory
+KNOWN_PACKAGES_JOBS = 4
+_known_package_ids = {}
+
+
+class ConnectionPool(object):
+    '''
+    Process-wide pool of broker connections.
+
+    Connections are keyed by process id, so forked workers never reuse a
+    socket opened by their parent, and by purpose, so AMQP consumers blocked
+    on a queue don't share their connection with the publishers. Publishers
+    are pooled as well, keeping their channel (and exchange declaration)
+    open between calls to ``get_publisher``.
+
+    Connections are health checked before being handed out again and
+    transparently replaced if they were closed or lost.
+    '''
+    def __init__(self):
+        self.connections = {}
+        self.publishers = {}
+        self.stats = {'created': 0, 'reused': 0, 'reconnected': 0}
+
+    def get_connection(self, purpose='default'):
+        key = (os.getpid(), purpose)
+        entry = self.connections.get(key)
+        if entry:
+            if self._is_healthy(entry):
+                self.stats['reused'] += 1
+                return entry['connection']
+            log.info('Broker connection for %s lost, reconnecting', purpose)
+            self.stats['reconnected'] += 1
+            self._close(entry['connection'])
+            del self.connections[key]
+
+        connection = new_connection()
+        self.connections[key] = {'connection': connection,
+                                 'checked': time.time()}
+        self.stats['created'] += 1
+        log.debug('Opened broker connection for {0} ({1})'.format(
+            purpose, self.format_stats()))
+        return connection
+
+    def get_publisher(self, routing_key, factory):
+        '''
+        Returns the pooled publisher for this routing key, creating it with
+        ``factory(connection)`` if there isn't one or its connection was
+        replaced.
+        '''
+        connection = self.get_connection('publisher')
+        key = (os.getpid(), routing_key)
+        publisher = self.publishers.get(key)
+        if publisher is None or publisher.connection is not connection \
+           or not _is_open(getattr(publisher, 'channel', None)):
+            publisher = factory(connection)
+            self.publishers[key] = publisher
+        return publisher
+
+    def discard(self, connection):
+        '''
+        Closes and forgets a connection found to be broken, so the next
+        request for it opens a new one.
+        '''
+        for key, entry in self.connections.items():
+            if entry['connection'] is connection:
+                del self.connections[key]
+                self.stats['reconnected'] += 1
+        self._close(connection)
+
+    def close_all(self):
+        pid = os.getpid()
+        for key in self.connections.keys():
+            if key[0] == pid:
+                self._close(self.connections.pop(key)['connection'])
+        for key in self.publishers.keys():
+            if key[0] == pid:
+                del self.publishers[key]
+
+    def format_stats(self):
+        requests = self.stats['created'] + self.stats['reused']
+        rate = 100.0 * self.stats['reused'] / requests if requests else 0
+        return 'created: {0}, reused: {1}, reconnected: {2}, reuse rate: {3:.1f}%'.format(
+            self.stats['created'], self.stats['reused'],
+            self.stats['reconnected'], rate)
+
+    def _is_healthy(self, entry):
+        connection = entry['connection']
+        if not _is_open(connection):
+            return False
+        if time.time() - entry['checked'] < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            if hasattr(connection, 'ping'):
+                connection.ping()
+            else:
+                # An AMQP connection whose socket was dropped while idle
+                # still reports it is open until it is read from
+                connection.process_data_events()
+        except Exception:
+            return False
+        entry['checked'] = time.time()
+        return True
+
+    def _close(self, connection):
+        try:
+            if hasattr(connection, 'connection_pool'):
+                connection.connection_pool.disconnect()
+            else:
+                connection.close()
+        except Exception, e:
+            log.debug('Error closing broker connection: %r', e)
+
+
+def _is_open(connection_or_channel):
+    if connection_or_channel is None:
+        return True
+    return getattr(connection_or_channel, 'is_open', True)
+
+
+connection_pool = ConnectionPool()
+
+
+def get_connection_stats():
+    '''
+    Returns the counters of broker connections created, reused and
+    reconnected by this process
+    '''
+    return dict(connection_pool.stats)
+
+
+def get_stats_interval():
+    try:
+        return int(config.get('ckan.harvest.stats_interval', STATS_INTERVAL))
+    except ValueError:
+        return STATS_INTERVAL
+
+
+def log_stats():
+    '''
+    Logs how many broker and HTTP connections this process has opened and
+    reused so far, and the hit rate of its caches.
+    '''
+    log.info('Broker connections: {0!r}'.format(get_connection_stats()))
+    log.info('HTTP connections: {0!r}'.format(httpclient.get_stats()))
+    for name, stats in sorted(cache.get_stats().items()):
+        log.info('Cache {0}: {1!r}'.format(name, stats))
+
+
+def get_connection(purpose='default'):
+    '''
+    Returns a broker connection from the process-wide pool. Use
+    ``new_connection`` to get a connection that is not shared.
+    '''
+    return connection_pool.get_connection(purpose)
+
+def new_connection():
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):  # "ampq" is for compat with old typo
         return get_connection_amqp()
@@ -76,41 +278,240 @@ def get_fetch_queue_name():
                                                       'default'))
 
 
+def get_import_queue_name():
+    return 'ckan.harvest.{0}.import'.format(config.get('ckan.site_id',
+                                                       'default'))
+
+
+def is_import_queue_enabled():
+    '''
+    Whether fetched harvest objects are sent to a separate import queue,
+    enabled with the ``ckan.harvest.mq.import_queue`` option. Otherwise the
+    fetch consumer runs the import stage straight after the fetch stage.
+    '''
+    return asbool(config.get('ckan.harvest.mq.import_queue', False))
+
+
+def get_queue_name(routing_key):
+    return 'ckan.harvest.{0}.{1}'.format(config.get('ckan.site_id', 'default'),
+                                         QUEUE_TYPES[routing_key])
+
+
+def get_dead_letter_queue_name(routing_key):
+    return get_queue_name(routing_key) + '.dead'
+
+
+def get_max_retries():
+    '''
+    Returns the number of times a harvest object can be delivered by a
+    queue before being dead lettered, set with the
+    ``ckan.harvest.mq.max_retries`` option.
+    '''
+    try:
+        return int(config.get('ckan.harvest.mq.max_retries', MAX_RETRIES))
+    except ValueError:
+        return MAX_RETRIES
+
+
+def get_retry_delay(retry_times):
+    '''
+    Returns the seconds to wait before retrying a harvest object delivered
+    ``retry_times`` times, and the longest delay it could have been given.
+
+    The delay starts at ``ckan.harvest.mq.retry_delay`` and doubles with
+    each retry, up to ``ckan.harvest.mq.max_retry_delay``. A random part of
+    it is dropped, so objects that failed together are not retried
+    together.
+    '''
+    base = float(config.get('ckan.harvest.mq.retry_delay', RETRY_DELAY))
+    max_delay = float(config.get('ckan.harvest.mq.max_retry_delay',
+                                 MAX_RETRY_DELAY))
+    ceiling = min(max_delay, base * 2 ** max(0, retry_times - 1))
+    return random.uniform(ceiling / 2, ceiling), ceiling
+
+
+def get_publish_chunk_size():
+    try:
+        return int(config.get('ckan.harvest.mq.publish_chunk_size',
+                              PUBLISH_CHUNK_SIZE))
+    except ValueError:
+        return PUBLISH_CHUNK_SIZE
+
+
+def _chunks(iterable, size):
+    '''Yields lists of at most ``size`` items from any iterable'''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def purge_queues():
 
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend == 'postgres':
+        for routing_key in POSTGRES_QUEUE_TABLES:
+            PostgresConsumer(routing_key).queue_purge(None)
+        return
     connection = get_connection()
     if backend in ('amqp', 'ampq'):
         channel = connection.channel()
         channel.queue_purge(queue=get_gather_queue_name())
         channel.queue_purge(queue=get_fetch_queue_name())
+        if is_import_queue_enabled():
+            channel.queue_purge(queue=get_import_queue_name())
         return
     if backend == 'redis':
         connection.flushall()
 
+def get_visibility_timeout(routing_key):
+    '''
+    Returns the number of seconds a message taken from the given queue can
+    stay unacknowledged before being put back in the queue by
+    ``resubmit_jobs``.
+
+    It can be set per queue with the ``ckan.harvest.mq.gather_timeout``,
+    ``ckan.harvest.mq.fetch_timeout`` and ``ckan.harvest.mq.import_timeout``
+    options.
+    '''
+    queue = QUEUE_TYPES.get(routing_key, 'fetch')
+    default = VISIBILITY_TIMEOUTS[queue]
+    try:
+        return int(config.get('ckan.harvest.mq.{0}_timeout'.format(queue),
+                              default))
+    except ValueError:
+        return default
+
+
+def get_lease_key(routing_key):
+    '''Name of the sorted set holding the in-flight messages of a queue'''
+    return routing_key + '_leases'
+
+
+def get_queued_key(routing_key):
+    '''Name of the set holding the messages currently waiting in a queue'''
+    return routing_key + '_queued'
+
+
+def get_sources_key(routing_key):
+    '''Name of the round robin list of sources with waiting messages'''
+    return routing_key + '_sources'
+
+
+def get_active_sources_key(routing_key):
+    '''Name of the set of sources with waiting messages'''
+    return routing_key + '_active_sources'
+
+
+def get_signal_key(routing_key):
+    '''
+    Name of the list where a token is pushed to wake up a consumer when
+    messages are queued
+    '''
+    return routing_key + '_signal'
+
+
+def get_delayed_key(routing_key):
+    '''Name of the sorted set holding the messages to be retried later'''
+    return routing_key + '_delayed'
+
+
+def get_dead_letter_key(routing_key):
+    '''Name of the list holding the dead lettered messages of a queue'''
+    return routing_key + '_dead'
+
+
+def is_fair_queue(routing_key):
+    '''
+    Whether messages on this queue are split in one queue per harvest
+    source and served in weighted round robin. This is only supported for
+    the fetch queue on Redis, and is enabled with the
+    ``ckan.harvest.mq.fair_fetch_queue`` option.
+    '''
+    return (routing_key == 'harvest_object_id' and
+            config.get('ckan.harvest.mq.type', MQ_TYPE) == 'redis' and
+            asbool(config.get('ckan.harvest.mq.fair_fetch_queue', False)))
+
+
+# Moves up to ARGV[2] messages whose lease expired before ARGV[1] from the
+# KEYS[1] lease set (or delayed set) back to the KEYS[2] queue, unless they are already
+# waiting there again (ie members of the KEYS[3] set). If ARGV[3] is set,
+# messages with a harvest_source_id go back to their source queue instead,
+# adding the source to the KEYS[4] round robin list and KEYS[5] set of
+# sources with waiting messages. A consumer is woken up with a token in the
+# KEYS[6] list.
+REDIS_REQUEUE_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                           'LIMIT', 0, tonumber(ARGV[2]))
+for i, body in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], body)
+    if redis.call('SADD', KEYS[3], body) == 1 then
+        local source = nil
+        if ARGV[3] ~= '' then
+            source = cjson.decode(body)['harvest_source_id']
+            -- a JSON null is decoded as cjson.null, which is truthy
+            if type(source) ~= 'string' then
+                source = nil
+            end
+        end
+        if source then
+            redis.call('RPUSH', KEYS[2] .. ':' .. source, body)
+            if redis.call('SADD', KEYS[5], source) == 1 then
+                redis.call('RPUSH', KEYS[4], source)
+            end
+        else
+            redis.call('RPUSH', KEYS[2], body)
+        end
+    end
+end
+if #expired > 0 and redis.call('LLEN', KEYS[6]) == 0 then
+    redis.call('RPUSH', KEYS[6], 1)
+end
+return #expired
+'''
+
 def resubmit_jobs():
+    '''
+    Puts back in their queues the messages that were taken by a consumer
+    but not acknowledged within the queue visibility timeout (eg because the
+    consumer died).
+
+    In-flight messages are kept in a sorted set per queue scored by their
+    lease deadline, so only the expired ones are looked at.
+    '''
     if config.get('ckan.harvest.mq.type') != 'redis':
         return
     redis = get_connection()
-    harvest_object_pending = redis.keys('harvest_object_id:*')
-    for key in harvest_object_pending:
-        date_of_key = datetime.datetime.strptime(redis.get(key),
-                                                 "%Y-%m-%d %H:%M:%S.%f")
-        if (datetime.datetime.now() - date_of_key).seconds > 180: # 3 minuites for fetch and import max
-            redis.rpush('harvest_object_id',
-                json.dumps({'harvest_object_id': key.split(':')[-1]})
-            )
-            redis.delete(key)
-
-    harvest_jobs_pending = redis.keys('harvest_job_id:*')
-    for key in harvest_jobs_pending:
-        date_of_key = datetime.datetime.strptime(redis.get(key),
-                                                 "%Y-%m-%d %H:%M:%S.%f")
-        if (datetime.datetime.now() - date_of_key).seconds > 7200: # 3 hours for a gather
-            redis.rpush('harvest_job_id',
-                json.dumps({'harvest_job_id': key.split(':')[-1]})
-            )
-            redis.delete(key)
+    requeue = redis.register_script(REDIS_REQUEUE_SCRIPT)
+    for routing_key in ('harvest_object_id', 'harvest_job_id',
+                        'harvest_import_object_id'):
+        fair = is_fair_queue(routing_key)
+        total = 0
+        while True:
+            count = requeue(keys=[get_lease_key(routing_key), routing_key,
+                                  get_queued_key(routing_key),
+                                  get_sources_key(routing_key),
+                                  get_active_sources_key(routing_key),
+                                  get_signal_key(routing_key)],
+                            args=[time.time(), REQUEUE_CHUNK_SIZE,
+                                  '1' if fair else ''])
+            total += count
+            if count < REQUEUE_CHUNK_SIZE:
+                break
+        if total:
+            log.info('Resubmitted {0} expired messages to {1}'.format(
+                total, routing_key))
+        if fair:
+            # Put back in the round robin the sources whose turn was lost
+            # by a consumer that died while holding it
+            active = redis.smembers(get_active_sources_key(routing_key))
+            in_turn = set(redis.lrange(get_sources_key(routing_key), 0, -1))
+            for source_id in active - in_turn:
+                redis.rpush(get_sources_key(routing_key), source_id)
 
 class Publisher(object):
     def __init__(self, connection, channel, exchange, routing_key):
@@ -118,7 +519,34 @@ class Publisher(object):
         self.channel = channel
         self.exchange = exchange
         self.routing_key = routing_key
-    def send(self, body, **kw):
+        self.transactional = False
+    def send(self, body, source_id=None, weight=None, **kw):
+        def publish():
+            result = self._publish(body, **kw)
+            if self.transactional:
+                self.channel.tx_commit()
+            return result
+        return self._with_reconnect(publish)
+    def _with_reconnect(self, publish):
+        '''
+        Calls publish, and once more on a new connection if the pooled one
+        turns out to be broken. Messages not confirmed by a commit are
+        published again, so it is only retried within a transaction or for
+        a single message.
+        '''
+        try:
+            return publish()
+        except AMQP_CONNECTION_ERRORS, e:
+            log.info('Broker connection lost publishing to {0}, reconnecting: {1!r}'
+                     .format(self.routing_key, e))
+            connection_pool.discard(self.connection)
+            self.connection = connection_pool.get_connection('publisher')
+            self.channel = self.connection.channel()
+            self.channel.exchange_declare(exchange=self.exchange, durable=True)
+            if self.transactional:
+                self.channel.tx_select()
+            return publish()
+    def _publish(self, body, **kw):
         return self.channel.basic_publish(self.exchange,
                                           self.routing_key,
                                           json.dumps(body),
@@ -126,35 +554,258 @@ class Publisher(object):
                                              delivery_mode = 2, # make message persistent
                                           ),
                                           **kw)
+    def send_many(self, bodies, chunk_size=None, source_id=None, weight=None,
+                  **kw):
+        '''
+        Publishes all the given message bodies, wrapping every chunk of
+        messages in an AMQP transaction so the broker confirms the whole
+        chunk in a single round trip instead of one per message.
+
+        Returns the number of messages sent.
+        '''
+        chunk_size = chunk_size or get_publish_chunk_size()
+        if not self.transactional:
+            self.channel.tx_select()
+            self.transactional = True
+        sent = 0
+        for chunk in _chunks(bodies, chunk_size):
+            def publish():
+                for body in chunk:
+                    self._publish(body, **kw)
+                self.channel.tx_commit()
+            try:
+                self._with_reconnect(publish)
+            except Exception:
+                log.error('Could not publish a chunk of {0} messages to {1}'
+                          .format(len(chunk), self.routing_key))
+                raise
+            sent += len(chunk)
+        return sent
+    def send_later(self, body, delay, max_delay):
+        '''
+        Publishes the message to a queue without consumers, whose messages
+        expire after ``max_delay`` seconds (or the ``delay`` of the message
+        if shorter) and are then dead lettered back to this routing key.
+
+        There is one such queue per ``max_delay``, as messages only expire
+        once they reach the head of the queue.
+        '''
+        queue = '{0}.retry.{1}'.format(get_queue_name(self.routing_key),
+                                       int(max_delay))
+        def publish():
+            self.channel.queue_declare(queue=queue, durable=True, arguments={
+                'x-message-ttl': int(max_delay * 1000),
+                'x-dead-letter-exchange': self.exchange,
+                'x-dead-letter-routing-key': self.routing_key,
+            })
+            self.channel.basic_publish('', queue, json.dumps(body),
+                                       properties=pika.BasicProperties(
+                                           delivery_mode=2,
+                                           expiration=str(int(delay * 1000)),
+                                       ))
+            if self.transactional:
+                self.channel.tx_commit()
+        self._with_reconnect(publish)
+    def send_dead_letter(self, body):
+        queue = get_dead_letter_queue_name(self.routing_key)
+        def publish():
+            self.channel.queue_declare(queue=queue, durable=True)
+            self.channel.basic_publish('', queue, json.dumps(body),
+                                       properties=pika.BasicProperties(
+                                           delivery_mode=2,
+                                       ))
+            if self.transactional:
+                self.channel.tx_commit()
+        self._with_reconnect(publish)
     def close(self):
-        self.connection.close()
+        # The connection is pooled and reused by the next publisher
+        return
+
+# Pushes each of the ARGV messages to the KEYS[1] queue unless it is already
+# waiting there (ie it is a member of the KEYS[2] set), and a token to the
+# KEYS[3] list to wake up a consumer. Returns the number of messages queued.
+REDIS_ENQUEUE_SCRIPT = '''
+local queued = 0
+for i, body in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[2], body) == 1 then
+        redis.call('RPUSH', KEYS[1], body)
+        queued = queued + 1
+    end
+end
+if queued > 0 and redis.call('LLEN', KEYS[3]) == 0 then
+    redis.call('RPUSH', KEYS[3], 1)
+end
+return queued
+'''
+
+# Like REDIS_ENQUEUE_SCRIPT, but pushes the ARGV[3..n] messages to the KEYS[1]
+# queue of the ARGV[1] source, storing its ARGV[2] weight in the KEYS[5] hash
+# and giving it a turn in the KEYS[3] round robin list if it didn't have
+# messages waiting yet (ie it was not a member of the KEYS[4] set). A token
+# is pushed to the KEYS[6] list to wake up a consumer.
+REDIS_FAIR_ENQUEUE_SCRIPT = '''
+local queued = 0
+for i = 3, #ARGV do
+    if redis.call('SADD', KEYS[2], ARGV[i]) == 1 then
+        redis.call('RPUSH', KEYS[1], ARGV[i])
+        queued = queued + 1
+    end
+end
+redis.call('HSET', KEYS[5], ARGV[1], ARGV[2])
+if queued > 0 and redis.call('SADD', KEYS[4], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+if queued > 0 and redis.call('LLEN', KEYS[6]) == 0 then
+    redis.call('RPUSH', KEYS[6], 1)
+end
+return queued
+'''
 
 class RedisPublisher(object):
     def __init__(self, redis, routing_key):
-        self.redis = redis ## not used
+        self.redis = redis
+        self.connection = redis
+        self.routing_key = routing_key
+        self.queued_key = get_queued_key(routing_key)
+        self.fair = is_fair_queue(routing_key)
+        self._enqueue = redis.register_script(REDIS_ENQUEUE_SCRIPT)
+        self._fair_enqueue = redis.register_script(REDIS_FAIR_ENQUEUE_SCRIPT)
+    def send(self, body, source_id=None, weight=None, **kw):
+        # messages already waiting in the queue are not added again
+        return self._send_values([json.dumps(body)], source_id, weight)
+    def send_many(self, bodies, chunk_size=None, source_id=None, weight=None,
+                  **kw):
+        '''
+        Pushes all the given message bodies to the queue with a single
+        script call per chunk, skipping the ones already waiting in it.
+
+        On a fair queue, passing the ``source_id`` of the messages puts them
+        in the queue of that source, which gets ``weight`` consecutive turns
+        each round.
+
+        Returns the number of messages queued.
+        '''
+        chunk_size = chunk_size or get_publish_chunk_size()
+        queued = 0
+        for chunk in _chunks(bodies, chunk_size):
+            queued += self._send_values([json.dumps(body) for body in chunk],
+                                        source_id, weight)
+        return queued
+    def _send_values(self, values, source_id, weight):
+        if self.fair and source_id:
+            return self._fair_enqueue(
+                keys=[self.routing_key + ':' + source_id, self.queued_key,
+                      get_sources_key(self.routing_key),
+                      get_active_sources_key(self.routing_key),
+                      self.routing_key + '_weights',
+                      get_signal_key(self.routing_key)],
+                args=[source_id, weight or 1] + values)
+        return self._enqueue(keys=[self.routing_key, self.queued_key,
+                                   get_signal_key(self.routing_key)],
+                             args=values)
+    def send_later(self, body, delay, max_delay):
+        '''
+        Adds the message to the set of delayed messages, from where the
+        consumers move it back to the queue once it is due.
+        '''
+        self.redis.zadd(get_delayed_key(self.routing_key),
+                        time.time() + delay, json.dumps(body))
+    def send_dead_letter(self, body):
+        self.redis.rpush(get_dead_letter_key(self.routing_key),
+                         json.dumps(body))
+
+    def close(self):
+        return
+
+class PostgresPublisher(object):
+    '''
+    Publisher of the postgres backend, where there is no broker: the rows
+    of the harvest jobs or objects sent to a queue are marked with its name
+    in their ``queue`` column, along with the time they are due. Sending
+    them only flushes the session: they are queued when the caller commits,
+    together with the changes to their state (see ``commit_and_send``), so
+    the queue can't disagree with the state of the objects.
+
+    Consumers waiting for messages are woken up with a NOTIFY on the queue
+    name, which is delivered on commit too.
+    '''
+    def __init__(self, routing_key):
         self.routing_key = routing_key
-    def send(self, body, **kw):
-        value = json.dumps(body)
-        # remove if already there
-        if self.routing_key == 'harvest_job_id':
-            self.redis.lrem(self.routing_key, 0, value)
-        self.redis.rpush(self.routing_key, value)
+        self.connection = None
+        self.table = POSTGRES_QUEUE_TABLES[routing_key]
+        self.queue = QUEUE_TYPES[routing_key]
+        self.id_key = 'harvest_job_id' if self.table == 'harvest_job' \
+            else 'harvest_object_id'
+    def send(self, body, source_id=None, weight=None, **kw):
+        return self._update([body[self.id_key]], self.queue, 0)
+    def send_many(self, bodies, chunk_size=None, source_id=None, weight=None,
+                  **kw):
+        '''
+        Queues the harvest jobs or objects of the given message bodies with
+        one statement per chunk.
 
+        Returns the number of messages queued.
+        '''
+        chunk_size = chunk_size or get_publish_chunk_size()
+        queued = 0
+        for chunk in _chunks(bodies, chunk_size):
+            queued += self._update([body[self.id_key] for body in chunk],
+                                   self.queue, 0)
+        return queued
+    def send_later(self, body, delay, max_delay):
+        self._update([body[self.id_key]], self.queue, delay)
+    def send_dead_letter(self, body):
+        self._update([body[self.id_key]], self.queue + '.dead', 0,
+                     notify=False)
+    def _update(self, ids, queue, delay, notify=True):
+        # The rows may have been added to the session but not written yet
+        model.Session.flush()
+        result = model.Session.execute(
+            '''UPDATE {0} SET queue = :queue,
+                   queue_due = now() + :delay * interval '1 second'
+               WHERE id = ANY(:ids)'''.format(self.table),
+            {'queue': queue, 'delay': delay, 'ids': list(ids)})
+        if notify and not delay:
+            # Delivered to the listening consumers on commit
+            model.Session.execute('SELECT pg_notify(:channel, :payload)',
+                                  {'channel': get_queue_name(self.routing_key),
+                                   'payload': ''})
+        return result.rowcount
     def close(self):
         return
 
+def commit_and_send(send):
+    '''
+    Commits the pending changes of the session and sends a message with
+    the ``send`` function, returning what it returns.
+
+    On the postgres backend the message is sent first, so it is queued with
+    the same commit. On the others it is sent after the commit, so the
+    consumers can't see the harvest job or object in its previous state.
+    '''
+    if config.get('ckan.harvest.mq.type', MQ_TYPE) == 'postgres':
+        result = send()
+        model.Session.commit()
+        return result
+    model.Session.commit()
+    return send()
+
 def get_publisher(routing_key):
-    connection = get_connection()
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend == 'postgres':
+        return PostgresPublisher(routing_key)
     if backend in ('amqp', 'ampq'):
-        channel = connection.channel()
-        channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
-        return Publisher(connection,
-                         channel,
-                         EXCHANGE_NAME,
-                         routing_key=routing_key)
+        def factory(connection):
+            channel = connection.channel()
+            channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
+            return Publisher(connection,
+                             channel,
+                             EXCHANGE_NAME,
+                             routing_key=routing_key)
+        return connection_pool.get_publisher(routing_key, factory)
     if backend == 'redis':
-        return RedisPublisher(connection, routing_key)
+        return connection_pool.get_publisher(
+            routing_key, lambda connection: RedisPublisher(connection, routing_key))
 
 
 class FakeMethod(object):
@@ -162,31 +813,311 @@ class FakeMethod(object):
     def __init__(self, message):
         self.delivery_tag = message
 
+# Pops up to ARGV[1] messages from the KEYS[1] list and leases all of them
+# until ARGV[2] in the KEYS[2] sorted set in a single atomic call, removing
+# them from the KEYS[3] set of waiting messages. If messages are left, a
+# token is pushed to the KEYS[4] list to wake up another consumer.
+REDIS_POP_BATCH_SCRIPT = '''
+local messages = {}
+for i = 1, tonumber(ARGV[1]) do
+    local body = redis.call('LPOP', KEYS[1])
+    if not body then
+        break
+    end
+    redis.call('SREM', KEYS[3], body)
+    redis.call('ZADD', KEYS[2], ARGV[2], body)
+    messages[#messages + 1] = body
+end
+if redis.call('LLEN', KEYS[1]) > 0 and redis.call('LLEN', KEYS[4]) == 0 then
+    redis.call('RPUSH', KEYS[4], 1)
+end
+return messages
+'''
+
+# Fair queue version of REDIS_POP_BATCH_SCRIPT. Messages without a source in
+# the KEYS[1] list are served first. Otherwise the messages are taken from
+# the queue of the source whose turn it is (the head of the KEYS[4] round
+# robin list). The source then gets its turn again straight away if it has
+# credits left from its KEYS[6] weight (tracked in the KEYS[7] hash), or
+# goes to the back of the list. Sources left with no messages are removed
+# from the KEYS[5] set. If messages are left, a token is pushed to the
+# KEYS[8] list to wake up another consumer.
+REDIS_FAIR_POP_SCRIPT = '''
+local function signal()
+    if (redis.call('LLEN', KEYS[1]) > 0 or redis.call('LLEN', KEYS[4]) > 0)
+       and redis.call('LLEN', KEYS[8]) == 0 then
+        redis.call('RPUSH', KEYS[8], 1)
+    end
+end
+local messages = {}
+local body = nil
+for i = 1, tonumber(ARGV[1]) do
+    body = redis.call('LPOP', KEYS[1])
+    if not body then
+        break
+    end
+    redis.call('SREM', KEYS[3], body)
+    redis.call('ZADD', KEYS[2], ARGV[2], body)
+    messages[#messages + 1] = body
+end
+if #messages > 0 then
+    signal()
+    return messages
+end
+
+local source = redis.call('LPOP', KEYS[4])
+if not source then
+    return messages
+end
+local queue = KEYS[1] .. ':' .. source
+for i = 1, tonumber(ARGV[1]) do
+    body = redis.call('LPOP', queue)
+    if not body then
+        break
+    end
+    redis.call('SREM', KEYS[3], body)
+    redis.call('ZADD', KEYS[2], ARGV[2], body)
+    messages[#messages + 1] = body
+end
+if redis.call('LLEN', queue) == 0 then
+    redis.call('SREM', KEYS[5], source)
+    redis.call('HDEL', KEYS[7], source)
+else
+    local credits = redis.call('HGET', KEYS[7], source) or
+                    redis.call('HGET', KEYS[6], source) or 1
+    credits = tonumber(credits) - 1
+    if credits > 0 then
+        redis.call('HSET', KEYS[7], source, credits)
+        redis.call('LPUSH', KEYS[4], source)
+    else
+        redis.call('HDEL', KEYS[7], source)
+        redis.call('RPUSH', KEYS[4], source)
+    end
+end
+signal()
+return messages
+'''
+
 class RedisConsumer(object):
     def __init__(self, redis, routing_key):
         self.redis = redis
         self.routing_key = routing_key
+        self.lease_key = get_lease_key(routing_key)
+        self.queued_key = get_queued_key(routing_key)
+        self.timeout = get_visibility_timeout(routing_key)
+        self.fair = is_fair_queue(routing_key)
+        if self.fair:
+            self._pop_script = redis.register_script(REDIS_FAIR_POP_SCRIPT)
+        else:
+            self._pop_script = redis.register_script(REDIS_POP_BATCH_SCRIPT)
+        self._requeue_script = redis.register_script(REDIS_REQUEUE_SCRIPT)
+        self.delayed_checked = 0
     def consume(self, queue):
         while True:
-            key, body = self.redis.blpop(self.routing_key)
-            self.redis.set(self.persistance_key(body),
-                           str(datetime.datetime.now()))
-            yield (FakeMethod(body), self, body)
-    def persistance_key(self, message):
-        message = json.loads(message)
-        return self.routing_key + ':' + str(message[self.routing_key])
+            for body in self._next(1):
+                yield (FakeMethod(body), self, body)
+    def consume_batch(self, queue, batch_size):
+        '''
+        Like ``consume``, but yields lists of up to ``batch_size`` messages,
+        which are popped and leased with a single script call.
+        '''
+        while True:
+            bodies = self._next(batch_size)
+            if bodies:
+                yield [(FakeMethod(body), self, body) for body in bodies]
+    def _next(self, count):
+        '''
+        Pops the next messages. If the queue is empty, it waits with BLPOP
+        for a token pushed by the publishers, and tries again.
+
+        Messages are only ever popped by the scripts, which lease them in
+        the same atomic call, so a consumer dying at any point can't lose
+        a message or the turn of a source. The delayed messages that are
+        due are moved back to the queue first, which is checked again every
+        DELAYED_POLL_INTERVAL seconds while waiting.
+        '''
+        self.requeue_delayed()
+        bodies = self._pop(count)
+        if bodies:
+            return bodies
+        self.redis.blpop([get_signal_key(self.routing_key)],
+                         timeout=DELAYED_POLL_INTERVAL)
+        self.requeue_delayed()
+        return self._pop(count)
+    def _pop(self, count):
+        if self.fair:
+            return self._pop_script(
+                keys=[self.routing_key, self.lease_key, self.queued_key,
+                      get_sources_key(self.routing_key),
+                      get_active_sources_key(self.routing_key),
+                      self.routing_key + '_weights',
+                      self.routing_key + '_credits',
+                      get_signal_key(self.routing_key)],
+                args=[count, self.lease_deadline()])
+        return self._pop_script(
+            keys=[self.routing_key, self.lease_key, self.queued_key,
+                  get_signal_key(self.routing_key)],
+            args=[count, self.lease_deadline()])
+    def requeue_delayed(self):
+        '''
+        Moves the delayed messages that are due back to the queue.
+        '''
+        now = time.time()
+        if now - self.delayed_checked < DELAYED_POLL_INTERVAL:
+            return
+        self.delayed_checked = now
+        while True:
+            count = self._requeue_script(
+                keys=[get_delayed_key(self.routing_key), self.routing_key,
+                      self.queued_key, get_sources_key(self.routing_key),
+                      get_active_sources_key(self.routing_key),
+                      get_signal_key(self.routing_key)],
+                args=[now, REQUEUE_CHUNK_SIZE, '1' if self.fair else ''])
+            if count < REQUEUE_CHUNK_SIZE:
+                break
+    def lease_deadline(self):
+        return time.time() + self.timeout
+    def lease(self, message):
+        pipe = self.redis.pipeline()
+        pipe.srem(self.queued_key, message)
+        pipe.zadd(self.lease_key, self.lease_deadline(), message)
+        pipe.execute()
     def basic_ack(self, message):
-        self.redis.delete(self.persistance_key(message))
+        self.redis.zrem(self.lease_key, message)
+    def basic_ack_many(self, messages):
+        if messages:
+            self.redis.zrem(self.lease_key, *messages)
     def queue_purge(self, queue):
         self.redis.flushall()
     def basic_get(self, queue):
-        body = self.redis.lpop(self.routing_key)
+        bodies = self._pop(1)
+        body = bodies[0] if bodies else None
         return (FakeMethod(body), self, body)
 
+class PostgresConsumer(object):
+    '''
+    Consumer of the postgres backend (see ``PostgresPublisher``).
+
+    Messages are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED``, so
+    concurrent consumers take different rows without waiting for each
+    other, and leased by moving their due time forward by the visibility
+    timeout of the queue. Rows not acknowledged in time become due again,
+    so they are taken by another consumer. While the queue is empty, the
+    consumer waits for a NOTIFY from the publishers, checking for delayed
+    messages every DELAYED_POLL_INTERVAL seconds.
+    '''
+    def __init__(self, routing_key):
+        self.routing_key = routing_key
+        self.table = POSTGRES_QUEUE_TABLES[routing_key]
+        self.queue = QUEUE_TYPES[routing_key]
+        self.id_key = 'harvest_job_id' if self.table == 'harvest_job' \
+            else 'harvest_object_id'
+        self.timeout = get_visibility_timeout(routing_key)
+        self.listener = None
+    def consume(self, queue):
+        while True:
+            for message in self._next(1):
+                yield message
+    def consume_batch(self, queue, batch_size):
+        while True:
+            messages = self._next(batch_size)
+            if messages:
+                yield messages
+    def _next(self, count):
+        # Listen before looking at the queue, not to miss a notification
+        # sent in between
+        listener = self._listen()
+        messages = self._claim(count)
+        if messages:
+            return messages
+        if select.select([listener], [], [], DELAYED_POLL_INTERVAL)[0]:
+            listener.poll()
+            del listener.notifies[:]
+        return self._claim(count)
+    def _listen(self):
+        if self.listener is None or self.listener.closed:
+            import psycopg2.extensions
+            connection = model.meta.engine.raw_connection()
+            # Left in autocommit mode, so it is not returned to the pool
+            connection.detach()
+            self.listener = connection.connection
+            self.listener.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = self.listener.cursor()
+            cursor.execute('LISTEN "{0}"'.format(
+                get_queue_name(self.routing_key)))
+            cursor.close()
+        return self.listener
+    def _claim(self, count):
+        returning = 'id, queue_due'
+        if self.routing_key == 'harvest_object_id':
+            returning += ', harvest_source_id'
+        rows = model.Session.execute(
+            '''UPDATE {0} SET queue_due = now() + :timeout * interval '1 second'
+               WHERE id IN (
+                   SELECT id FROM {0}
+                   WHERE queue = :queue AND queue_due <= now()
+                   ORDER BY queue_due
+                   LIMIT :count
+                   FOR UPDATE SKIP LOCKED)
+               RETURNING {1}'''.format(self.table, returning),
+            {'timeout': self.timeout, 'queue': self.queue,
+             'count': count}).fetchall()
+        model.Session.commit()
+        messages = []
+        for row in rows:
+            body = {self.id_key: row[0]}
+            if self.routing_key == 'harvest_object_id':
+                body['harvest_source_id'] = row[2]
+            # The due time identifies this lease, so it is not acknowledged
+            # if the row was sent to a queue again in the meantime
+            messages.append((FakeMethod((row[0], row[1])), self,
+                             json.dumps(body)))
+        return messages
+    def basic_ack(self, delivery_tag):
+        self.basic_ack_many([delivery_tag])
+    def basic_ack_many(self, delivery_tags):
+        for id, due in delivery_tags:
+            model.Session.execute(
+                '''UPDATE {0} SET queue = NULL, queue_due = NULL
+                   WHERE id = :id AND queue = :queue AND queue_due = :due'''
+                .format(self.table),
+                {'id': id, 'queue': self.queue, 'due': due})
+        model.Session.commit()
+    def queue_purge(self, queue):
+        model.Session.execute(
+            'UPDATE {0} SET queue = NULL, queue_due = NULL '
+            'WHERE queue = :queue'.format(self.table), {'queue': self.queue})
+        model.Session.commit()
+    def basic_get(self, queue):
+        messages = self._claim(1)
+        if not messages:
+            return (None, None, None)
+        return messages[0]
+    def get_dead_letters(self, ids=None):
+        '''
+        Returns the bodies of the dead lettered messages of this queue, only
+        those of the given ids if any. Sending them to a queue takes them
+        out of the dead letter one.
+        '''
+        query = 'SELECT id FROM {0} WHERE queue = :queue'.format(self.table)
+        params = {'queue': self.queue + '.dead'}
+        if ids is not None:
+            query += ' AND id = ANY(:ids)'
+            params['ids'] = list(ids)
+        dead_ids = [id for (id,) in model.Session.execute(query, params)]
+        return [{self.id_key: id} for id in dead_ids]
+
 def get_consumer(queue_name, routing_key):
 
-    connection = get_connection()
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend == 'postgres':
+        return PostgresConsumer(routing_key)
+    if backend in ('amqp', 'ampq'):
+        # Each AMQP consumer blocks on its own connection
+        connection = get_connection('consumer:' + queue_name)
+    else:
+        connection = get_connection()
 
     if backend in ('amqp', 'ampq'):
         channel = connection.channel()
@@ -198,6 +1129,48 @@ def get_consumer(queue_name, routing_key):
         return RedisConsumer(connection, routing_key)
 
 
+def consume_batches(consumer, queue, batch_size, poll_interval=1):
+    '''
+    Yields lists of up to ``batch_size`` (method, header, body) messages
+    from the given consumer.
+
+    Redis and postgres consumers pop and lease each batch atomically. AMQP
+    channels fetch the messages of the batch one by one with ``basic_get``
+    (which ignores the prefetch count), and poll the queue every
+    ``poll_interval`` seconds while it is empty. So a message sent to an
+    empty queue waits up to ``poll_interval`` seconds to be consumed, in
+    exchange for a ``basic_get`` per idle second instead of a consumer
+    holding unacknowledged messages between batches.
+    '''
+    if hasattr(consumer, 'consume_batch'):
+        for batch in consumer.consume_batch(queue, batch_size):
+            yield batch
+        return
+
+    while True:
+        batch = []
+        while len(batch) < batch_size:
+            method, header, body = consumer.basic_get(queue=queue)
+            if method is None:
+                break
+            batch.append((method, header, body))
+        if batch:
+            yield batch
+        else:
+            time.sleep(poll_interval)
+
+
+def _ack_batch(channel, messages):
+    if not messages:
+        return
+    if hasattr(channel, 'basic_ack_many'):
+        channel.basic_ack_many([method.delivery_tag
+                                for method, header, body in messages])
+    else:
+        channel.basic_ack(delivery_tag=messages[-1][0].delivery_tag,
+                          multiple=True)
+
+
 def gather_callback(channel, method, header, body):
     try:
         id = json.loads(body)['harvest_job_id']
@@ -217,31 +1190,55 @@ def gather_callback(channel, method, header, body):
         channel.basic_ack(method.delivery_tag)
         return False
 
-    # Send the harvest job to the plugins that implement
-    # the Harvester interface, only if the source type
-    # matches
-    harvester_found = False
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == job.source.type:
-            harvester_found = True
-            # Get a list of harvest object ids from the plugin
-            job.gather_started = datetime.datetime.utcnow()
+    # Send the harvest job to the plugin that implements
+    # the Harvester interface for the source type
+    harvester = get_harvester(job.source.type)
+    if harvester:
+        # Get a list of harvest object ids from the plugin
+        job.gather_started = datetime.datetime.utcnow()
 
-            try:
-                harvest_object_ids = harvester.gather_stage(job)
-            except (Exception, KeyboardInterrupt):
-                channel.basic_ack(method.delivery_tag)
+        streamed = False
+        # Number of ids yielded by a streaming gather stage
+        gathered = [0]
+        def count_gathered(object_ids):
+            for object_id in object_ids:
+                gathered[0] += 1
+                yield object_id
+        try:
+            harvest_object_ids = harvester.gather_stage(job)
+            if harvest_object_ids is not None and \
+                    not isinstance(harvest_object_ids, list):
+                # The ids are sent while the gather stage goes on
+                streamed = True
+                sent = send_harvest_objects(
+                    job, count_gathered(harvest_object_ids))
+        except (Exception, KeyboardInterrupt), e:
+            channel.basic_ack(method.delivery_tag)
+            model.Session.rollback()
+            if gathered[0]:
+                # The objects already sent may have been fetched or
+                # imported by now, so they are kept
+                HarvestGatherError(
+                    message='Gather stage failed after sending %s objects: %r'
+                            % (gathered[0], e),
+                    job=job).save()
+            else:
                 harvest_objects = model.Session.query(HarvestObject).filter_by(
                     harvest_job_id=job.id
                 )
                 for harvest_object in harvest_objects:
                     model.Session.delete(harvest_object)
                 model.Session.commit()
-                raise
-            finally:
-                job.gather_finished = datetime.datetime.utcnow()
-                job.save()
+            raise
+        finally:
+            job.gather_finished = datetime.datetime.utcnow()
+            job.save()
 
+        if streamed:
+            log.debug('Sent {0} objects gathered by the plugin'.format(sent))
+            if not sent:
+                log.info('No harvest objects to fetch')
+        else:
             if not isinstance(harvest_object_ids, list):
                 log.error('Gather stage failed')
                 publisher.close()
@@ -256,12 +1253,8 @@ def gather_callback(channel, method, header, body):
 
             log.debug('Received from plugin gather_stage: {0} objects (first: {1} last: {2})'.format(
                         len(harvest_object_ids), harvest_object_ids[:1], harvest_object_ids[-1:]))
-            for id in harvest_object_ids:
-                # Send the id to the fetch queue
-                publisher.send({'harvest_object_id':id})
-            log.debug('Sent {0} objects to the fetch queue'.format(len(harvest_object_ids)))
-
-    if not harvester_found:
+            send_harvest_objects(job, harvest_object_ids)
+    else:
         msg = 'No harvester could be found for source type %s' % job.source.type
         err = HarvestGatherError(message=msg,job=job)
         err.save()
@@ -272,6 +1265,69 @@ def gather_callback(channel, method, header, body):
     channel.basic_ack(method.delivery_tag)
 
 
+def send_harvest_objects(job, harvest_object_ids):
+    '''
+    Sends the ids of the gathered harvest objects to the fetch queue, or to
+    the import queue if enabled and they already have their content. The
+    ids can be any iterable, eg a generator returned by a streaming gather
+    stage, and are sent in chunks as they come. If the iterable raises an
+    error, the ids it yielded before are sent before the error is raised.
+
+    Returns the number of harvest objects sent.
+    '''
+    chunk_size = get_publish_chunk_size()
+    chunk = []
+    total = 0
+    try:
+        for object_id in harvest_object_ids:
+            chunk.append(object_id)
+            if len(chunk) >= chunk_size:
+                total += _send_harvest_objects_chunk(job, chunk)
+                chunk = []
+    except:
+        # These objects are kept, like the ones already sent
+        if chunk:
+            _send_harvest_objects_chunk(job, chunk)
+        raise
+    if chunk:
+        total += _send_harvest_objects_chunk(job, chunk)
+    return total
+
+def _send_harvest_objects_chunk(job, chunk):
+    total = len(chunk)
+    if is_import_queue_enabled():
+        # Objects whose content was stored on the gather stage can skip
+        # the fetch queue
+        fetched_ids = get_fetched_object_ids(chunk)
+        if fetched_ids:
+            sent = get_import_publisher().send_many(
+                {'harvest_object_id': id} for id in chunk
+                if id in fetched_ids)
+            log.debug('Sent {0} objects to the import queue'.format(sent))
+            chunk = [id for id in chunk if id not in fetched_ids]
+
+    sent = get_fetch_publisher().send_many(
+        ({'harvest_object_id': id, 'harvest_source_id': job.source.id}
+         for id in chunk),
+        source_id=job.source.id, weight=job.source.weight)
+    log.debug('Sent {0} objects to the fetch queue'.format(sent))
+    # Queues the chunk on the postgres backend
+    model.Session.commit()
+    return total
+
+def get_fetched_object_ids(harvest_object_ids):
+    '''
+    Returns the set of ids of the given harvest objects that already have
+    their content stored.
+    '''
+    fetched_ids = set()
+    for chunk in _chunks(harvest_object_ids, get_publish_chunk_size()):
+        query = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.id.in_(chunk)) \
+            .filter(HarvestObject.content != None)
+        fetched_ids.update(id for (id,) in query)
+    return fetched_ids
+
 def fetch_callback(channel, method, header, body):
     try:
         id = json.loads(body)['harvest_object_id']
@@ -288,62 +1344,466 @@ def fetch_callback(channel, method, header, body):
         channel.basic_ack(method.delivery_tag)
         return False
 
+    # Committed along with the start of the next stage
     obj.retry_times += 1
-    obj.save()
 
-    if obj.retry_times >= 5:
-        obj.state = "ERROR"
-        obj.save()
-        log.error('Too many consecutive retries for object {0}'.format(obj.id))
+    if obj.retry_times >= get_max_retries():
+        dead_letter(obj, 'harvest_object_id',
+                    'Too many consecutive retries for object {0}'.format(obj.id))
         channel.basic_ack(method.delivery_tag)
         return False
 
-    # Send the harvest object to the plugins that implement
-    # the Harvester interface, only if the source type
-    # matches
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == obj.source.type:
-            fetch_and_import_stages(harvester, obj)
+    # Send the harvest object to the plugin that implements
+    # the Harvester interface for the source type
+    harvester = get_harvester(obj.source.type)
+    if harvester:
+        fetch_and_import_stages(harvester, obj)
 
     model.Session.remove()
     channel.basic_ack(method.delivery_tag)
 
+def fetch_batch_callback(channel, messages):
+    '''
+    Batch version of ``fetch_callback``, used by the fetch consumer when run
+    with ``--batch-size``.
+
+    All the harvest objects in the batch are loaded and have their retry
+    count updated with a single query each, and the whole batch is
+    acknowledged at once after being handed to the harvesters.
+    '''
+    ids = []
+    for method, header, body in messages:
+        try:
+            ids.append(json.loads(body)['harvest_object_id'])
+        except KeyError:
+            log.error('No harvest object id received')
+    log.info('Received {0} harvest object ids'.format(len(ids)))
+
+    if ids:
+        model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)) \
+            .update({'retry_times': HarvestObject.retry_times + 1},
+                    synchronize_session=False)
+        model.Session.commit()
+        objects = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)) \
+            .all()
+    else:
+        objects = []
+
+    objects_by_id = dict((obj.id, obj) for obj in objects)
+    objects_by_type = {}
+    for id in ids:
+        obj = objects_by_id.get(id)
+        if not obj:
+            log.error('Harvest object does not exist: %s' % id)
+            continue
+        if obj.retry_times >= get_max_retries():
+            dead_letter(obj, 'harvest_object_id',
+                        'Too many consecutive retries for object {0}'.format(obj.id))
+            continue
+        objects_by_type.setdefault(obj.source.type, []).append(obj)
+
+    # Send each group of harvest objects to the plugin that implements
+    # the Harvester interface for their source type
+    for source_type, harvester_objects in objects_by_type.iteritems():
+        harvester = get_harvester(source_type)
+        if not harvester:
+            continue
+        if hasattr(harvester, 'fetch_stage_batch'):
+            fetch_and_import_batch(harvester, harvester_objects)
+        else:
+            for obj in harvester_objects:
+                fetch_and_import_stages(harvester, obj)
+
+    model.Session.remove()
+    _ack_batch(channel, messages)
+
+def import_callback(channel, method, header, body):
+    '''
+    Runs the import stage of a harvest object already fetched by the fetch
+    consumer, when the import queue is enabled.
+    '''
+    try:
+        id = json.loads(body)['harvest_object_id']
+        log.info('Received harvest object id to import: %s' % id)
+    except KeyError:
+        log.error('No harvest object id received')
+        channel.basic_ack(method.delivery_tag)
+        return False
+
+    obj = HarvestObject.get(id)
+    if not obj:
+        log.error('Harvest object does not exist: %s' % id)
+        channel.basic_ack(method.delivery_tag)
+        return False
+
+    if obj.state in ('COMPLETE', 'ERROR'):
+        log.info('Harvest object {0} was already imported'.format(obj.id))
+        channel.basic_ack(method.delivery_tag)
+        return False
+
+    # Committed along with the start of the next stage
+    obj.retry_times += 1
+
+    if obj.retry_times >= get_max_retries():
+        dead_letter(obj, 'harvest_import_object_id',
+                    'Too many consecutive retries for object {0}'.format(obj.id))
+        channel.basic_ack(method.delivery_tag)
+        return False
+
+    harvester = get_harvester(obj.source.type)
+    if harvester:
+        try:
+            import_stage(harvester, obj)
+        except RetryLater, e:
+            retry_later(obj, 'harvest_import_object_id', str(e))
+        set_report_status(obj)
+
+    model.Session.remove()
+    channel.basic_ack(method.delivery_tag)
+
+def import_batch_callback(channel, messages):
+    '''
+    Batch version of ``import_callback``, used by the import consumer when
+    run with ``--batch-size``.
+    '''
+    ids = []
+    for method, header, body in messages:
+        try:
+            ids.append(json.loads(body)['harvest_object_id'])
+        except KeyError:
+            log.error('No harvest object id received')
+    log.info('Received {0} harvest object ids to import'.format(len(ids)))
+
+    if ids:
+        objects = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)) \
+            .all()
+    else:
+        objects = []
+
+    objects_by_id = dict((obj.id, obj) for obj in objects)
+    objects_by_type = {}
+    for id in ids:
+        obj = objects_by_id.get(id)
+        if not obj:
+            log.error('Harvest object does not exist: %s' % id)
+            continue
+        if obj.state in ('COMPLETE', 'ERROR'):
+            log.info('Harvest object {0} was already imported'.format(obj.id))
+            continue
+        # Committed along with the start of the next stage
+        obj.retry_times += 1
+        if obj.retry_times >= get_max_retries():
+            dead_letter(obj, 'harvest_import_object_id',
+                        'Too many consecutive retries for object {0}'.format(obj.id))
+            continue
+        objects_by_type.setdefault(obj.source.type, []).append(obj)
+
+    for source_type, harvester_objects in objects_by_type.iteritems():
+        harvester = get_harvester(source_type)
+        if not harvester:
+            continue
+        import_stages(harvester, harvester_objects)
+        for obj in harvester_objects:
+            set_report_status(obj)
+
+    model.Session.remove()
+    _ack_batch(channel, messages)
+
 def fetch_and_import_stages(harvester, obj):
-    obj.fetch_started = datetime.datetime.utcnow()
-    obj.state = "FETCH"
-    obj.save()
+    try:
+        success_fetch = fetch_stage(harvester, obj)
+        if success_fetch and is_import_queue_enabled():
+            obj.add()
+            # The import consumer takes it from here
+            commit_and_send(lambda: get_import_publisher().send(
+                {'harvest_object_id': obj.id}))
+            return
+        if success_fetch:
+            import_stage(harvester, obj)
+    except RetryLater, e:
+        # Without an import queue, the import is retried from the fetch
+        # queue too
+        retry_later(obj, 'harvest_object_id', str(e))
+    set_report_status(obj)
+
+def fetch_and_import_batch(harvester, objs):
+    '''
+    Batch version of ``fetch_and_import_stages`` for harvesters that
+    implement ``fetch_stage_batch``, which fetches all the objects in a
+    single call. The state of the objects is updated with a commit before
+    and after the fetch stage.
+    '''
+    for obj in objs:
+        obj.start_fetch(commit=False)
+    model.Session.commit()
+
+    results = harvester.fetch_stage_batch(objs)
+
+    fetched = []
+    for obj in objs:
+        result = results.get(obj.id)
+        if isinstance(result, RetryLater):
+            retry_later(obj, 'harvest_object_id', str(result))
+            continue
+        obj.finish_fetch(result)
+        obj.add()
+        if obj.state != "ERROR":
+            fetched.append(obj)
+
+    if is_import_queue_enabled():
+        # The import consumer takes it from here
+        commit_and_send(lambda: get_import_publisher().send_many(
+            {'harvest_object_id': obj.id} for obj in fetched))
+    else:
+        model.Session.commit()
+        import_stages(harvester, fetched, 'harvest_object_id')
+    for obj in objs:
+        # Objects sent to the import queue get it once imported
+        if obj.state != "FETCH":
+            set_report_status(obj)
+
+def fetch_stage(harvester, obj):
+    obj.start_fetch()
     success_fetch = harvester.fetch_stage(obj)
-    obj.fetch_finished = datetime.datetime.utcnow()
-    obj.save()
-    if success_fetch:
-        # If no errors where found, call the import method
-        obj.import_started = datetime.datetime.utcnow()
-        obj.state = "IMPORT"
-        obj.save()
-        success_import = harvester.import_stage(obj)
-        obj.import_finished = datetime.datetime.utcnow()
-        if success_import:
-            obj.state = "COMPLETE"
+    obj.finish_fetch(success_fetch)
+    return success_fetch
+
+def import_stage(harvester, obj):
+    obj.start_import()
+    success_import = harvester.import_stage(obj)
+    obj.finish_import(success_import)
+    return success_import
+
+def import_stages(harvester, objs, routing_key='harvest_import_object_id'):
+    '''
+    Runs the import stage of several harvest objects, at once if the
+    harvester implements ``import_stage_batch``. The objects that have to
+    be retried later are sent back to the queue of the given routing key.
+    '''
+    if not hasattr(harvester, 'import_stage_batch'):
+        for obj in objs:
+            try:
+                import_stage(harvester, obj)
+            except RetryLater, e:
+                retry_later(obj, routing_key, str(e))
+        return
+    if not objs:
+        return
+    for obj in objs:
+        obj.start_import(commit=False)
+    model.Session.commit()
+
+    results = harvester.import_stage_batch(objs)
+
+    for obj in objs:
+        result = results.get(obj.id)
+        if isinstance(result, RetryLater):
+            retry_later(obj, routing_key, str(result))
         else:
-            obj.state = "ERROR"
-        obj.save()
-    else:
-        obj.state = "ERROR"
-        obj.save()
-    if obj.report_status:
+            obj.finish_import(result)
+
+def get_retry_body(obj, routing_key):
+    '''
+    Returns the message that sends the harvest object to the queue of the
+    given routing key.
+    '''
+    if routing_key == 'harvest_object_id':
+        return {'harvest_object_id': obj.id,
+                'harvest_source_id': obj.harvest_source_id}
+    return {'harvest_object_id': obj.id}
+
+def retry_later(obj, routing_key, message):
+    '''
+    Sends the harvest object back to the queue of the given routing key
+    after a delay that grows with its retries (see ``get_retry_delay``), or
+    dead letters it if it has run out of retries.
+    '''
+    if obj.retry_times + 1 >= get_max_retries():
+        dead_letter(obj, routing_key, message)
         return
-    if obj.state == 'ERROR':
-        obj.report_status = 'errored'
-    elif obj.current == False:
-        obj.report_status = 'deleted'
-    elif len(model.Session.query(HarvestObject)
-           .filter_by(package_id = obj.package_id)
-           .limit(2)
-           .all()) == 2:
-        obj.report_status = 'updated'
-    else:
-        obj.report_status = 'added'
-    obj.save()
+    delay, max_delay = get_retry_delay(obj.retry_times)
+    obj.state = u'WAITING'
+    obj.add()
+    commit_and_send(lambda: get_publisher(routing_key).send_later(
+        get_retry_body(obj, routing_key), delay, max_delay))
+    log.info('Harvest object {0} will be retried in {1:.0f} seconds: {2}'
+             .format(obj.id, delay, message))
+
+def dead_letter(obj, routing_key, message):
+    '''
+    Marks the harvest object as errored, recording why, and sends it to the
+    dead letter queue of the given routing key, from where it can be
+    replayed with ``replay_dead_letters``.
+    '''
+    log.error(message)
+    stage = 'Import' if routing_key == 'harvest_import_object_id' else 'Fetch'
+    HarvestObjectError(message=message, object=obj, stage=stage).save()
+    obj.state = u'ERROR'
+    obj.add()
+    commit_and_send(lambda: get_publisher(routing_key).send_dead_letter(
+        get_retry_body(obj, routing_key)))
+
+# Removes the given values (ARGV) from the dead letter list (KEYS[1]),
+# rewriting it in a single pass
+REDIS_REMOVE_DEAD_LETTERS_SCRIPT = '''
+local removed = {}
+for i, value in ipairs(ARGV) do
+    removed[value] = (removed[value] or 0) + 1
+end
+local kept = {}
+for i, value in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
+    if removed[value] and removed[value] > 0 then
+        removed[value] = removed[value] - 1
+    else
+        table.insert(kept, value)
+    end
+end
+redis.call('del', KEYS[1])
+for i = 1, #kept, 1000 do
+    redis.call('rpush', KEYS[1], unpack(kept, i, math.min(i + 999, #kept)))
+end
+return #ARGV
+'''
+
+def _take_dead_letters(routing_key, ids=None, handle=None):
+    '''
+    Returns the bodies of the dead lettered messages of a queue, only
+    those of the given harvest object ids if any.
+
+    If ``handle`` is given, it is called with the bodies, and they are
+    only removed from the dead letter queue once it has returned, so they
+    are not lost if it fails.
+    '''
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend == 'postgres':
+        # Sending them to a queue takes them out of the dead letter one
+        bodies = PostgresConsumer(routing_key).get_dead_letters(ids)
+        if handle and bodies:
+            handle(bodies)
+        return bodies
+    selected = lambda body: ids is None or body['harvest_object_id'] in ids
+    bodies = []
+    if backend == 'redis':
+        redis = get_connection()
+        key = get_dead_letter_key(routing_key)
+        values = []
+        for value in redis.lrange(key, 0, -1):
+            body = json.loads(value)
+            if selected(body):
+                bodies.append(body)
+                values.append(value)
+        if handle and bodies:
+            handle(bodies)
+            # Messages dead lettered meanwhile are kept
+            redis.register_script(REDIS_REMOVE_DEAD_LETTERS_SCRIPT)(
+                keys=[key], args=values)
+        return bodies
+
+    # Take all the messages, so the ones put back are not taken again
+    channel = get_connection().channel()
+    queue = get_dead_letter_queue_name(routing_key)
+    channel.queue_declare(queue=queue, durable=True)
+    messages = []
+    try:
+        while True:
+            method, header, value = channel.basic_get(queue=queue)
+            if method is None:
+                break
+            messages.append((method, json.loads(value)))
+        bodies = [body for method, body in messages if selected(body)]
+        if handle and bodies:
+            handle(bodies)
+        for method, body in messages:
+            if handle and selected(body):
+                channel.basic_ack(method.delivery_tag)
+            else:
+                channel.basic_reject(method.delivery_tag, requeue=True)
+    finally:
+        # Messages not acknowledged are put back in the queue
+        channel.close()
+    return bodies
+
+def get_dead_letters(routing_key):
+    '''
+    Returns the ids of the harvest objects in the dead letter queue of the
+    given routing key.
+    '''
+    return [body['harvest_object_id']
+            for body in _take_dead_letters(routing_key)]
+
+def replay_dead_letters(routing_key, ids=None):
+    '''
+    Sends the harvest objects in the dead letter queue of the given routing
+    key back to their queue (only the given ids, if any), with their retry
+    count reset.
+
+    Returns the number of harvest objects sent.
+    '''
+    def replay(bodies):
+        replayed_ids = list(set(body['harvest_object_id'] for body in bodies))
+        for chunk in _chunks(replayed_ids, get_publish_chunk_size()):
+            model.Session.query(HarvestObject) \
+                .filter(HarvestObject.id.in_(chunk)) \
+                .update({'retry_times': 0, 'state': u'WAITING'},
+                        synchronize_session=False)
+        commit_and_send(lambda: get_publisher(routing_key).send_many(bodies))
+
+    bodies = _take_dead_letters(routing_key, ids, handle=replay)
+    if not bodies:
+        return 0
+    log.info('Replayed {0} dead lettered objects to {1}'.format(
+        len(bodies), routing_key))
+    return len(bodies)
+
+def set_report_status(obj):
+    '''
+    Sets the report status of a finished harvest object, and commits all
+    its pending changes. Objects waiting to be retried get it once
+    finished.
+    '''
+    if obj.state == u'WAITING':
+        return
+    if not obj.report_status:
+        if obj.state == 'ERROR':
+            obj.report_status = 'errored'
+        elif obj.current == False:
+            obj.report_status = 'deleted'
+        elif is_known_package(obj):
+            obj.report_status = 'updated'
+        else:
+            obj.report_status = 'added'
+    obj.finish()
+
+def is_known_package(obj):
+    '''
+    Whether the package of the harvest object was already harvested by
+    another harvest object, of a previous job of the same source or of this
+    job.
+
+    The packages harvested by previous jobs of the source are loaded once
+    per job and kept in memory, along with the ones reported by this
+    process for the job, so no query is made per object.
+    '''
+    if not obj.package_id:
+        return False
+    known_package_ids = _known_package_ids.get(obj.harvest_job_id)
+    if known_package_ids is None:
+        if len(_known_package_ids) >= KNOWN_PACKAGES_JOBS:
+            _known_package_ids.clear()
+        query = model.Session.query(HarvestObject.package_id).distinct() \
+            .filter(HarvestObject.harvest_source_id == obj.harvest_source_id) \
+            .filter(HarvestObject.harvest_job_id != obj.harvest_job_id) \
+            .filter(HarvestObject.package_id != None)
+        known_package_ids = set(package_id for (package_id,) in query)
+        _known_package_ids[obj.harvest_job_id] = known_package_ids
+    if obj.package_id in known_package_ids:
+        return True
+    # Another object of this job for the same package is an update
+    known_package_ids.add(obj.package_id)
+    return False
 
 def get_gather_consumer():
     consumer = get_consumer(get_gather_queue_name(), 'harvest_job_id')
@@ -355,12 +1815,20 @@ def get_fetch_consumer():
     log.debug('Fetch queue consumer registered')
     return consumer
 
+def get_import_consumer():
+    consumer = get_consumer(get_import_queue_name(), 'harvest_import_object_id')
+    log.debug('Import queue consumer registered')
+    return consumer
+
 def get_gather_publisher():
     return get_publisher('harvest_job_id')
 
 def get_fetch_publisher():
     return get_publisher('harvest_object_id')
 
+def get_import_publisher():
+    return get_publisher('harvest_import_object_id')
+
 # Get a publisher for the fetch queue
 #fetch_publisher = get_fetch_publisher()
 
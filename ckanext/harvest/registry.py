@@ -0,0 +1,75 @@
+'''
+Registry of the loaded harvester plugins, keyed by the source type they
+handle (the name returned by their info() method).
+
+It is built the first time it is needed and cleared when the plugins are
+configured again, so the consumers and actions don't need to go through
+all the plugins calling info() on each of them every time.
+'''
+import copy
+import logging
+import threading
+
+from ckan.plugins import PluginImplementations
+
+from ckanext.harvest.interfaces import IHarvester
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_harvesters = None
+_infos = None
+
+
+def _load():
+    global _harvesters, _infos
+    with _lock:
+        if _harvesters is not None:
+            return _harvesters, _infos
+        harvesters = {}
+        infos = []
+        for harvester in PluginImplementations(IHarvester):
+            info = harvester.info()
+            if not info or 'name' not in info:
+                log.error('Harvester %r does not provide the harvester name in the info response' % str(harvester))
+                continue
+            if info['name'] in harvesters:
+                # Same as looping over the plugins, the first one wins
+                continue
+            harvesters[info['name']] = harvester
+            infos.append(info)
+        _harvesters, _infos = harvesters, infos
+        return harvesters, infos
+
+
+def reset():
+    '''
+    Clears the registry, so it is built again from the loaded plugins
+    next time it is used.
+    '''
+    global _harvesters, _infos
+    with _lock:
+        _harvesters = None
+        _infos = None
+
+
+def get_harvester(source_type):
+    '''
+    Returns the harvester plugin for the given source type, or None if no
+    loaded plugin handles it.
+    '''
+    return _load()[0].get(source_type)
+
+
+def get_harvester_types():
+    '''
+    Returns the source types handled by the loaded harvester plugins.
+    '''
+    return [info['name'] for info in _load()[1]]
+
+
+def get_harvesters_info():
+    '''
+    Returns a copy of the info dict of each loaded harvester plugin.
+    '''
+    return copy.deepcopy(_load()[1])
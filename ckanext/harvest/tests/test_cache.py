@@ -0,0 +1,32 @@
+import time
+
+from ckanext.harvest.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_and_set(self):
+        cache = LRUCache(max_size=10, ttl=60)
+        assert cache.get('a') is None
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        stats = cache.stats()
+        assert stats['hits'] == 1, stats
+        assert stats['misses'] == 1, stats
+        assert stats['hit_rate'] == 0.5, stats
+
+    def test_least_recently_used_are_dropped(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_entries_expire(self):
+        cache = LRUCache(max_size=10, ttl=0.1)
+        cache.set('a', 1)
+        time.sleep(0.2)
+        assert cache.get('a', 'expired') == 'expired'
@@ -0,0 +1,203 @@
+import datetime
+import json
+import urllib
+
+import ckan.logic as logic
+from ckan import model
+
+import ckanext.harvest.model as harvest_model
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestSource
+from ckanext.harvest.harvesters.ckanharvester import CKANHarvester, \
+                                                    ContentFetchError
+
+
+class MockCKANHarvester(CKANHarvester):
+    '''
+    CKAN harvester whose remote instance is a dict of responses, keyed by
+    the action they answer, or of functions returning them for each url
+    '''
+    responses = {}
+
+    def _get_content(self, url, cache=False):
+        for action, response in self.responses.items():
+            if '/action/%s' % action in url:
+                if callable(response):
+                    response = response(url)
+                return json.dumps(response)
+        raise ContentFetchError('Not found: %s' % url, code=404)
+
+
+class TestCKANHarvester(object):
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _create_source(self, config=None):
+        user = logic.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})['name']
+        self.context = {'model': model, 'session': model.Session,
+                        'user': user, 'api_version': 3, 'ignore_auth': True}
+        data_dict = {
+            'title': 'Remote CKAN',
+            'name': 'remote-ckan',
+            'url': 'http://remote.test',
+            'source_type': 'ckan',
+        }
+        if config:
+            data_dict['config'] = json.dumps(config)
+        return logic.get_action('harvest_source_create')(self.context, data_dict)
+
+    def _create_job(self, source):
+        job = logic.get_action('harvest_job_create')(
+            self.context, {'source_id': source['id']})
+        return HarvestJob.get(job['id'])
+
+    def _harvested_package(self, job, name, guid=None):
+        package = model.Package(name=name)
+        model.Session.add(package)
+        model.Session.flush()
+        HarvestObject(guid=guid or name, job=job, package_id=package.id,
+                      current=True, state=u'COMPLETE').save()
+        return package.id
+
+    def test_incremental_gather_detects_deletions(self):
+        source = self._create_source()
+        previous_job = self._create_job(source)
+        kept_id = self._harvested_package(previous_job, 'kept')
+        gone_id = self._harvested_package(previous_job, 'gone')
+        previous_job.gather_finished = datetime.datetime.utcnow()
+        previous_job.status = u'Finished'
+        previous_job.save()
+
+        # Nothing modified since the previous job, but one package deleted
+        harvester = MockCKANHarvester()
+        harvester.responses = {
+            'package_search': {'result': {'count': 0, 'results': []}},
+            'package_list': {'result': ['kept']},
+        }
+        job = self._create_job(source)
+        object_ids = list(harvester.gather_stage(job))
+
+        assert len(object_ids) == 1, object_ids
+        obj = HarvestObject.get(object_ids[0])
+        assert obj.guid == 'gone'
+
+        # package_show returns a 404, so it is deleted locally
+        assert harvester.fetch_stage(obj) is True
+        assert obj.report_status == 'deleted'
+        assert model.Package.get(gone_id).state == 'deleted'
+        assert model.Package.get(kept_id).state == 'active'
+
+    def test_deletion_candidates_still_on_the_remote_are_kept(self):
+        source = self._create_source()
+        previous_job = self._create_job(source)
+        # Harvested by id with the revision API
+        package_id = self._harvested_package(previous_job, 'remote-id')
+        previous_job.gather_finished = datetime.datetime.utcnow()
+        previous_job.status = u'Finished'
+        previous_job.save()
+
+        harvester = MockCKANHarvester()
+        harvester.responses = {
+            'package_search': {'result': {'count': 0, 'results': []}},
+            'package_list': {'result': ['remote-name']},
+            'package_show': {'result': {'id': 'remote-id', 'name': 'remote-name'}},
+        }
+        job = self._create_job(source)
+        object_ids = list(harvester.gather_stage(job))
+        obj = HarvestObject.get(object_ids[0])
+
+        assert harvester.fetch_stage(obj) is True
+        assert obj.report_status != 'deleted'
+        assert model.Package.get(package_id).state == 'active'
+
+    def test_packages_harvested_by_id_are_matched_by_name(self):
+        source = self._create_source()
+        previous_job = self._create_job(source)
+        # Harvested with the revision API, whose guids are the remote ids
+        self._harvested_package(previous_job, 'by-id', guid='remote-id')
+        previous_job.gather_finished = datetime.datetime.utcnow()
+        previous_job.status = u'Finished'
+        previous_job.save()
+
+        harvester = MockCKANHarvester()
+        harvester.responses = {
+            'package_search': {'result': {'count': 0, 'results': []}},
+            'package_list': {'result': ['by-id']},
+        }
+        job = self._create_job(source)
+        object_ids = list(harvester.gather_stage(job))
+        assert object_ids == [], object_ids
+
+    def test_source_context_follows_source_edits(self):
+        source = self._create_source()
+        job = self._create_job(source)
+        harvester = CKANHarvester()
+        assert harvester._get_source_context(job.id).config == {}
+
+        # Edited from another process, which can't clear the cache of this one
+        harvest_source = HarvestSource.get(source['id'])
+        harvest_source.config = u'{"api_key": "key"}'
+        harvest_source.save()
+
+        assert harvester._get_source_context(job.id).config == {'api_key': 'key'}
+
+    def test_search_gather_streams_each_page(self):
+        source = self._create_source({'gather_with_search': True,
+                                      'search_rows': 2})
+        pages = [
+            [{'name': 'a', 'metadata_modified': '2015-01-01T00:00:00'},
+             {'name': 'b', 'metadata_modified': '2015-01-02T00:00:00'}],
+            [{'name': 'c', 'metadata_modified': '2015-01-03T00:00:00'}],
+        ]
+        # Packages matching each request, with the metadata_modified of the
+        # previous page as lower bound
+        counts = [3, 2]
+        requested = []
+
+        def search(url):
+            requested.append(url)
+            page = len(requested) - 1
+            return {'result': {'count': counts[page], 'results': pages[page]}}
+
+        harvester = MockCKANHarvester()
+        harvester.responses = {'package_search': search}
+        object_ids = harvester.gather_stage(self._create_job(source))
+
+        # The objects of the first page are ready to be sent to the fetch
+        # queue before the next page is requested
+        assert not isinstance(object_ids, list)
+        first_page = [object_ids.next(), object_ids.next()]
+        assert len(requested) == 1, requested
+        assert sorted(HarvestObject.get(id).guid for id in first_page) == ['a', 'b']
+
+        rest = list(object_ids)
+        assert len(requested) == 2, requested
+        assert [HarvestObject.get(id).guid for id in rest] == ['c']
+        assert HarvestObject.get(rest[0]).content
+
+    def test_search_gather_pages_past_capped_rows(self):
+        # The remote instance returns 2 rows per page, fewer than requested
+        source = self._create_source({'gather_with_search': True,
+                                      'search_rows': 1000})
+        packages = [{'name': name, 'metadata_modified': '2015-01-0%dT00:00:00' % day}
+                    for day, name in enumerate('abcde', 1)]
+
+        def search(url):
+            since = '2015-01-00T00:00:00'
+            if 'fq=' in url:
+                since = urllib.unquote(url.split('fq=')[1]).split('[')[1].split('Z')[0]
+            start = int(url.split('start=')[1].split('&')[0])
+            matching = [p for p in packages if p['metadata_modified'] >= since]
+            return {'result': {'count': len(matching),
+                               'results': matching[start:start + 2]}}
+
+        harvester = MockCKANHarvester()
+        harvester.responses = {'package_search': search}
+        object_ids = list(harvester.gather_stage(self._create_job(source)))
+        assert sorted(HarvestObject.get(id).guid for id in object_ids) == \
+            list('abcde'), object_ids
@@ -0,0 +1,166 @@
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+from pylons import config
+
+from ckanext.harvest import httpclient
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    throttled = 0
+    errors = 0
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self._respond(302, '', [('Location', '/plain')])
+        elif self.path == '/gzip':
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write('compressed')
+            f.close()
+            self._respond(200, buf.getvalue(), [('Content-Encoding', 'gzip')])
+        elif self.path == '/plain':
+            self._respond(200, 'plain')
+        elif self.path == '/throttled':
+            MockHandler.throttled += 1
+            if MockHandler.throttled == 1:
+                self._respond(429, 'slow down', [('Retry-After', '0')])
+            else:
+                self._respond(200, 'plain')
+        elif self.path == '/error':
+            MockHandler.errors += 1
+            self._respond(502, 'bad gateway')
+        elif self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self._respond(304, '')
+            else:
+                self._respond(200, 'tagged', [('ETag', '"v1"')])
+        else:
+            self._respond(404, 'not found')
+
+    def _respond(self, status, body, headers=[]):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestHttpClient(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = MockServer(('127.0.0.1', 0), MockHandler)
+        cls.url = 'http://127.0.0.1:%s' % cls.server.server_port
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        httpclient.connection_pool.close_all()
+        cls.server.shutdown()
+
+    def test_get(self):
+        assert_equal(httpclient.get(self.url + '/plain'), 'plain')
+
+    def test_gzip(self):
+        assert_equal(httpclient.get(self.url + '/gzip'), 'compressed')
+
+    def test_redirect(self):
+        assert_equal(httpclient.get(self.url + '/redirect'), 'plain')
+
+    def test_http_error(self):
+        with assert_raises(urllib2.HTTPError) as cm:
+            httpclient.get(self.url + '/missing')
+        assert_equal(cm.exception.code, 404)
+
+    def test_connections_are_reused(self):
+        httpclient.get(self.url + '/plain')
+        stats = httpclient.get_stats()
+        httpclient.get(self.url + '/plain')
+        new_stats = httpclient.get_stats()
+        assert_equal(new_stats['hits'], stats['hits'] + 1)
+        assert_equal(new_stats['misses'], stats['misses'])
+
+    def test_response_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        config['ckanext.harvest.http_cache_path'] = os.path.join(cache_dir, 'http.db')
+        try:
+            url = self.url + '/etag'
+            assert_equal(httpclient.get(url, stats_key='job', use_cache=True), 'tagged')
+            assert_equal(httpclient.get(url, stats_key='job', use_cache=True), 'tagged')
+            assert_equal(httpclient.get_cache_stats('job'),
+                         {'hits': 1, 'misses': 1, 'bytes_saved': len('tagged')})
+
+            # Not served to requests with other credentials
+            assert_equal(httpclient.get(url, headers={'Authorization': 'key'},
+                                        stats_key='auth', use_cache=True), 'tagged')
+            assert_equal(httpclient.get_cache_stats('auth')['misses'], 1)
+            # Nor to requests not using the cache
+            assert_equal(httpclient.get(url, stats_key='nocache'), 'tagged')
+            assert_equal(httpclient.get_cache_stats('nocache')['misses'], 0)
+
+            size, = httpclient.get_response_cache()._connection().execute(
+                'SELECT total FROM size').fetchone()
+            assert_equal(size, 2 * len('tagged'))
+        finally:
+            del config['ckanext.harvest.http_cache_path']
+            shutil.rmtree(cache_dir)
+
+    def test_throttled_requests_are_retried(self):
+        limiter = httpclient.get_limiter('127.0.0.1:%s' % self.server.server_port)
+        # Halving the rate again right after an earlier test's error
+        limiter.last_decrease = 0
+        rate = limiter.rate
+        throttled = limiter.stats['throttled']
+        assert_equal(httpclient.get(self.url + '/throttled'), 'plain')
+        state = httpclient.get_limiter_state(self.url)
+        assert_equal(state['throttled'], throttled + 1)
+        assert state['rate'] < rate, state
+
+    def test_server_errors_slow_down_without_retrying(self):
+        throttled = httpclient.get_limiter_state(self.url)['throttled']
+        assert_raises(urllib2.HTTPError, httpclient.get, self.url + '/error')
+        assert_equal(MockHandler.errors, 1)
+        assert_equal(httpclient.get_limiter_state(self.url)['throttled'],
+                     throttled + 1)
+
+
+class TestHostLimiter(object):
+
+    def test_aimd(self):
+        limiter = httpclient.HostLimiter(rate=10, max_rate=100, max_concurrency=4)
+        for i in range(20):
+            limiter.acquire()
+            limiter.release()
+        assert limiter.rate > 10
+        assert_equal(int(limiter.concurrency), 4)
+        rate = limiter.rate
+        limiter.acquire()
+        limiter.release(overloaded=True)
+        assert_equal(limiter.rate, rate / 2)
+        assert_equal(int(limiter.concurrency), 2)
+
+    def test_retry_after_pauses_the_host(self):
+        limiter = httpclient.HostLimiter()
+        limiter.acquire()
+        limiter.release(overloaded=True, retry_after=30)
+        assert limiter.get_state()['paused_for'] > 25
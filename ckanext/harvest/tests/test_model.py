@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from ckanext.harvest.model import make_content_hash
+
+
+class TestContentHash(object):
+
+    def test_json_is_normalised(self):
+        assert make_content_hash('{"a": 1, "b": [1, 2]}') == \
+            make_content_hash('{"b":[1,2],"a":1}')
+
+    def test_changes_with_content(self):
+        assert make_content_hash('{"a": 1}') != make_content_hash('{"a": 2}')
+
+    def test_changes_with_extra_values(self):
+        assert make_content_hash('{"a": 1}', '{}') != \
+            make_content_hash('{"a": 1}', '{"default_tags": ["x"]}')
+
+    def test_non_json_content(self):
+        assert make_content_hash(u'<xml>é</xml>') == \
+            make_content_hash(u'<xml>é</xml>')
+        assert make_content_hash(None) == make_content_hash('')
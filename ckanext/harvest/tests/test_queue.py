@@ -2,10 +2,14 @@ import ckanext.harvest.model as harvest_model
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 from ckanext.harvest.interfaces import IHarvester
 import ckanext.harvest.queue as queue
+import ckanext.harvest.registry as registry
 from ckan.plugins.core import SingletonPlugin, implements
 import json
+import select
 import ckan.logic as logic
 from ckan import model
+from ckan.lib.base import config
+from nose.plugins.skip import SkipTest
 
 
 class TestHarvester(SingletonPlugin):
@@ -25,6 +29,22 @@ class TestHarvester(SingletonPlugin):
             obj3.save() # this will commit both
             return [obj.id, obj2.id, obj3.id]
 
+        if harvest_job.source.url.startswith('stream_test'):
+            def stream():
+                for guid in ('test_stream1', 'test_stream2'):
+                    obj = HarvestObject(guid=guid, job=harvest_job)
+                    obj.save()
+                    yield obj.id
+            return stream()
+
+        if harvest_job.source.url.startswith('stream_error_test'):
+            def stream_error():
+                obj = HarvestObject(guid='test_stream_sent', job=harvest_job)
+                obj.save()
+                yield obj.id
+                raise ValueError('Remote server went away')
+            return stream_error()
+
         return []
 
     def fetch_stage(self, harvest_object):
@@ -277,3 +297,530 @@ class TestHarvestQueue(object):
         assert harvest_source_dict['status']['last_job']['stats'] == {'updated': 2, 'deleted': 1}
         assert harvest_source_dict['status']['total_datasets'] == 2
         assert harvest_source_dict['status']['job_count'] == 2
+
+    def test_02_import_queue(self):
+        consumer_fetch = queue.get_consumer('ckan.harvest.test.fetch', 'harvest_object_id')
+        consumer_import = queue.get_consumer('ckan.harvest.test.import', 'harvest_import_object_id')
+        consumer_fetch.queue_purge(queue='ckan.harvest.test.fetch')
+        consumer_import.queue_purge(queue='ckan.harvest.test.import')
+
+        user = logic.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name']
+
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'api_version': 3, 'ignore_auth': True}
+
+        harvest_source = logic.get_action('harvest_source_create')(
+            context,
+            {'title': 'Test Import Queue Source',
+             'name': 'test-import-queue-source',
+             'url': 'import_queue_test',
+             'source_type': 'test'}
+        )
+        harvest_job = logic.get_action('harvest_job_create')(
+            context,
+            {'source_id': harvest_source['id']}
+        )
+
+        obj = HarvestObject(guid='test_import_queue',
+                            job=harvest_model.HarvestJob.get(harvest_job['id']))
+        obj.save()
+        obj_id = obj.id
+
+        config['ckan.harvest.mq.import_queue'] = 'true'
+        try:
+            queue.get_fetch_publisher().send({'harvest_object_id': obj_id})
+            reply = consumer_fetch.basic_get(queue='ckan.harvest.test.fetch')
+            queue.fetch_callback(consumer_fetch, *reply)
+
+            # fetched, but not imported yet
+            obj = HarvestObject.get(obj_id)
+            assert obj.state == 'FETCH', obj.state
+            assert obj.fetch_finished != None
+            assert obj.import_started == None
+
+            reply = consumer_import.basic_get(queue='ckan.harvest.test.import')
+            assert json.loads(reply[2]) == {'harvest_object_id': obj_id}, reply
+            queue.import_callback(consumer_import, *reply)
+        finally:
+            config['ckan.harvest.mq.import_queue'] = 'false'
+
+        obj = HarvestObject.get(obj_id)
+        assert obj.state == 'COMPLETE', obj.state
+        assert obj.report_status == 'added', obj.report_status
+        assert model.Package.get('test_import_queue')
+
+    def test_03_streaming_gather(self):
+        consumer = queue.get_consumer('ckan.harvest.test.gather', 'harvest_job_id')
+        consumer_fetch = queue.get_consumer('ckan.harvest.test.fetch', 'harvest_object_id')
+        consumer.queue_purge(queue='ckan.harvest.test.gather')
+        consumer_fetch.queue_purge(queue='ckan.harvest.test.fetch')
+
+        user = logic.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name']
+
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'api_version': 3, 'ignore_auth': True}
+
+        harvest_source = logic.get_action('harvest_source_create')(
+            context,
+            {'title': 'Test Streaming Source',
+             'name': 'test-streaming-source',
+             'url': 'stream_test',
+             'source_type': 'test'}
+        )
+        harvest_job = logic.get_action('harvest_job_create')(
+            context,
+            {'source_id': harvest_source['id']}
+        )
+        logic.get_action('harvest_jobs_run')(
+            context,
+            {'source_id': harvest_source['id']}
+        )
+
+        reply = consumer.basic_get(queue='ckan.harvest.gather')
+        queue.gather_callback(consumer, *reply)
+
+        objects = model.Session.query(HarvestObject) \
+            .filter_by(harvest_job_id=harvest_job['id']).all()
+        assert len(objects) == 2, objects
+        assert harvest_model.HarvestJob.get(harvest_job['id']).gather_finished
+
+        received = []
+        for i in range(2):
+            reply = consumer_fetch.basic_get(queue='ckan.harvest.fetch')
+            received.append(json.loads(reply[2])['harvest_object_id'])
+        assert sorted(received) == sorted(obj.id for obj in objects), received
+
+    def test_04_streaming_gather_error_keeps_sent_objects(self):
+        consumer = queue.get_consumer('ckan.harvest.test.gather', 'harvest_job_id')
+        consumer_fetch = queue.get_consumer('ckan.harvest.test.fetch', 'harvest_object_id')
+        consumer.queue_purge(queue='ckan.harvest.test.gather')
+        consumer_fetch.queue_purge(queue='ckan.harvest.test.fetch')
+
+        user = logic.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name']
+
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'api_version': 3, 'ignore_auth': True}
+
+        harvest_source = logic.get_action('harvest_source_create')(
+            context,
+            {'title': 'Test Streaming Error Source',
+             'name': 'test-streaming-error-source',
+             'url': 'stream_error_test',
+             'source_type': 'test'}
+        )
+        harvest_job = logic.get_action('harvest_job_create')(
+            context,
+            {'source_id': harvest_source['id']}
+        )
+        logic.get_action('harvest_jobs_run')(
+            context,
+            {'source_id': harvest_source['id']}
+        )
+
+        reply = consumer.basic_get(queue='ckan.harvest.gather')
+        try:
+            queue.gather_callback(consumer, *reply)
+        except ValueError:
+            pass
+        else:
+            assert False, 'The gather error was not raised'
+
+        # The object sent before the error is kept, and still queued
+        objects = model.Session.query(HarvestObject) \
+            .filter_by(harvest_job_id=harvest_job['id']).all()
+        assert [obj.guid for obj in objects] == ['test_stream_sent'], objects
+        reply = consumer_fetch.basic_get(queue='ckan.harvest.fetch')
+        assert json.loads(reply[2])['harvest_object_id'] == objects[0].id
+
+        errors = model.Session.query(harvest_model.HarvestGatherError) \
+            .filter_by(harvest_job_id=harvest_job['id']).all()
+        assert len(errors) == 1, errors
+        assert 'Remote server went away' in errors[0].message
+
+
+class TestRegistry(object):
+
+    def test_get_harvester(self):
+        registry.reset()
+        harvester = registry.get_harvester('test')
+        assert isinstance(harvester, TestHarvester), harvester
+        assert registry.get_harvester('unknown') is None
+        assert 'test' in registry.get_harvester_types()
+
+    def test_harvesters_info_is_copied(self):
+        info = [i for i in registry.get_harvesters_info() if i['name'] == 'test'][0]
+        info['title'] = 'changed'
+        info = [i for i in registry.get_harvesters_info() if i['name'] == 'test'][0]
+        assert info['title'] == 'test', info
+
+
+class TestPublisher(object):
+
+    def test_send_many(self):
+        if config.get('ckan.harvest.mq.type') == 'postgres':
+            raise SkipTest('Only the harvest queues are supported on PostgreSQL')
+
+        consumer = queue.get_consumer('ckan.harvest.test.send_many', 'test_send_many')
+        consumer.queue_purge(queue='ckan.harvest.test.send_many')
+
+        publisher = queue.get_publisher('test_send_many')
+        bodies = [{'test_send_many': str(i)} for i in range(5)]
+        sent = publisher.send_many(iter(bodies), chunk_size=2)
+        publisher.close()
+
+        assert sent == 5, sent
+
+        received = []
+        for i in range(5):
+            reply = consumer.basic_get(queue='ckan.harvest.test.send_many')
+            received.append(json.loads(reply[2]))
+
+        assert received == bodies, received
+
+
+    def test_send_drops_duplicates(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Duplicates are only dropped on the Redis backend')
+
+        consumer = queue.get_consumer('ckan.harvest.test.dedupe', 'test_dedupe')
+        consumer.queue_purge(queue='ckan.harvest.test.dedupe')
+
+        publisher = queue.get_publisher('test_dedupe')
+        publisher.send({'test_dedupe': '1'})
+        queued = publisher.send_many([{'test_dedupe': '1'},
+                                      {'test_dedupe': '2'},
+                                      {'test_dedupe': '2'}])
+        assert queued == 1, queued
+
+        assert consumer.basic_get(queue='ckan.harvest.test.dedupe')[2] == json.dumps({'test_dedupe': '1'})
+        assert consumer.basic_get(queue='ckan.harvest.test.dedupe')[2] == json.dumps({'test_dedupe': '2'})
+        assert consumer.basic_get(queue='ckan.harvest.test.dedupe')[2] is None
+
+        # Once taken from the queue, messages can be queued again
+        assert publisher.send({'test_dedupe': '1'}) == 1
+
+    def test_publishers_are_pooled(self):
+        if config.get('ckan.harvest.mq.type') == 'postgres':
+            raise SkipTest('There are no broker connections on PostgreSQL')
+
+        stats = queue.get_connection_stats()
+
+        publisher = queue.get_publisher('test_pool')
+        publisher.close()
+        assert queue.get_publisher('test_pool') is publisher
+
+        new_stats = queue.get_connection_stats()
+        assert new_stats['reused'] > stats['reused'], new_stats
+
+    def test_publisher_reconnects(self):
+        if config.get('ckan.harvest.mq.type', queue.MQ_TYPE) not in ('amqp', 'ampq'):
+            raise SkipTest('Only AMQP connections are dropped silently')
+
+        consumer = queue.get_consumer('ckan.harvest.test.reconnect', 'test_reconnect')
+        consumer.queue_purge(queue='ckan.harvest.test.reconnect')
+        publisher = queue.get_publisher('test_reconnect')
+        stats = queue.get_connection_stats()
+
+        # Drop the socket underneath, the connection still reports it is open
+        publisher.connection.socket.close()
+        queue.get_publisher('test_reconnect').send({'test_reconnect': '1'})
+
+        assert queue.get_connection_stats()['reconnected'] > stats['reconnected']
+        reply = consumer.basic_get(queue='ckan.harvest.test.reconnect')
+        assert json.loads(reply[2]) == {'test_reconnect': '1'}, reply
+
+
+class TestConsumer(object):
+
+    def test_consume_batches(self):
+        if config.get('ckan.harvest.mq.type') == 'postgres':
+            raise SkipTest('Only the harvest queues are supported on PostgreSQL')
+
+        consumer = queue.get_consumer('ckan.harvest.test.batch', 'test_batch')
+        consumer.queue_purge(queue='ckan.harvest.test.batch')
+
+        publisher = queue.get_publisher('test_batch')
+        bodies = [{'test_batch': str(i)} for i in range(3)]
+        publisher.send_many(bodies)
+        publisher.close()
+
+        batches = queue.consume_batches(consumer, 'ckan.harvest.test.batch', 5)
+        messages = batches.next()
+
+        assert [json.loads(body) for method, header, body in messages] == bodies
+
+        queue._ack_batch(consumer, messages)
+
+    def test_resubmit_expired_leases(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Leases are only tracked on the Redis backend')
+
+        consumer = queue.get_consumer('ckan.harvest.test.fetch', 'harvest_object_id')
+        consumer.queue_purge(queue='ckan.harvest.test.fetch')
+
+        expired = json.dumps({'harvest_object_id': 'expired'})
+        running = json.dumps({'harvest_object_id': 'running'})
+        consumer.redis.zadd(consumer.lease_key, 0, expired)
+        consumer.lease(running)
+
+        queue.resubmit_jobs()
+
+        assert consumer.redis.zrange(consumer.lease_key, 0, -1) == [running]
+        reply = consumer.basic_get(queue='ckan.harvest.test.fetch')
+        assert reply[2] == expired, reply
+        reply = consumer.basic_get(queue='ckan.harvest.test.fetch')
+        assert reply[2] is None, reply
+
+    def test_fair_fetch_queue(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Fair queues are only supported on the Redis backend')
+
+        config['ckan.harvest.mq.fair_fetch_queue'] = 'true'
+        try:
+            redis = queue.get_connection()
+            redis.flushall()
+            publisher = queue.RedisPublisher(redis, 'harvest_object_id')
+            consumer = queue.RedisConsumer(redis, 'harvest_object_id')
+
+            for source_id, count, weight in (('a', 4, 2), ('b', 2, 1)):
+                publisher.send_many(
+                    [{'harvest_object_id': '%s%s' % (source_id, i),
+                      'harvest_source_id': source_id} for i in range(count)],
+                    source_id=source_id, weight=weight)
+
+            received = []
+            for i in range(6):
+                reply = consumer.basic_get(queue='ckan.harvest.fetch')
+                received.append(json.loads(reply[2])['harvest_object_id'])
+
+            # the source with weight 2 gets two turns for each one of the other
+            assert received == ['a0', 'a1', 'b0', 'a2', 'a3', 'b1'], received
+            assert consumer.basic_get(queue='ckan.harvest.fetch')[2] is None
+        finally:
+            config['ckan.harvest.mq.fair_fetch_queue'] = 'false'
+
+    def test_resubmit_without_source_on_fair_queue(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Fair queues are only supported on the Redis backend')
+
+        config['ckan.harvest.mq.fair_fetch_queue'] = 'true'
+        try:
+            redis = queue.get_connection()
+            redis.flushall()
+            consumer = queue.RedisConsumer(redis, 'harvest_object_id')
+            no_source = json.dumps({'harvest_object_id': 'a', 'harvest_source_id': None})
+            redis.zadd(consumer.lease_key, 0, no_source)
+
+            queue.resubmit_jobs()
+
+            # Served from the queue of messages without a source
+            assert consumer._next(5) == [no_source]
+        finally:
+            config['ckan.harvest.mq.fair_fetch_queue'] = 'false'
+
+
+class TestRetries(object):
+
+    def test_retry_delay(self):
+        config['ckan.harvest.mq.retry_delay'] = '10'
+        config['ckan.harvest.mq.max_retry_delay'] = '60'
+        try:
+            for retry_times, expected in ((1, 10), (2, 20), (3, 40), (4, 60), (9, 60)):
+                delay, max_delay = queue.get_retry_delay(retry_times)
+                assert max_delay == expected, (retry_times, max_delay)
+                assert expected / 2 <= delay <= expected, (retry_times, delay)
+        finally:
+            del config['ckan.harvest.mq.retry_delay']
+            del config['ckan.harvest.mq.max_retry_delay']
+
+    def test_delayed_messages(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Delayed messages are checked by the consumers on Redis only')
+
+        redis = queue.get_connection()
+        redis.flushall()
+        publisher = queue.RedisPublisher(redis, 'harvest_object_id')
+        consumer = queue.RedisConsumer(redis, 'harvest_object_id')
+
+        publisher.send_later({'harvest_object_id': 'now'}, 0, 10)
+        publisher.send_later({'harvest_object_id': 'later'}, 60, 60)
+
+        assert consumer._next(5) == [json.dumps({'harvest_object_id': 'now'})]
+        assert redis.zcard(queue.get_delayed_key('harvest_object_id')) == 1
+
+    def test_replay_dead_letters(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Dead letters are only inspected without consuming them on Redis')
+
+        redis = queue.get_connection()
+        redis.flushall()
+        publisher = queue.get_publisher('harvest_object_id')
+        for id in ('a', 'b', 'c'):
+            publisher.send_dead_letter({'harvest_object_id': id,
+                                        'harvest_source_id': 'source'})
+
+        assert queue.get_dead_letters('harvest_object_id') == ['a', 'b', 'c']
+        assert queue.replay_dead_letters('harvest_object_id', ['a', 'c']) == 2
+        assert queue.get_dead_letters('harvest_object_id') == ['b']
+
+        consumer = queue.get_consumer('ckan.harvest.fetch', 'harvest_object_id')
+        replayed = [json.loads(consumer.basic_get(queue='ckan.harvest.fetch')[2])['harvest_object_id']
+                    for i in range(2)]
+        assert replayed == ['a', 'c'], replayed
+
+    def test_failed_replay_keeps_dead_letters(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            raise SkipTest('Dead letters are only inspected without consuming them on Redis')
+
+        redis = queue.get_connection()
+        redis.flushall()
+        publisher = queue.get_publisher('harvest_object_id')
+        for id in ('a', 'b'):
+            publisher.send_dead_letter({'harvest_object_id': id,
+                                        'harvest_source_id': 'source'})
+
+        def fail(send):
+            raise ValueError('Unable to send')
+        commit_and_send = queue.commit_and_send
+        queue.commit_and_send = fail
+        try:
+            queue.replay_dead_letters('harvest_object_id')
+        except ValueError:
+            pass
+        finally:
+            queue.commit_and_send = commit_and_send
+        assert queue.get_dead_letters('harvest_object_id') == ['a', 'b']
+
+
+class TestPostgresQueue(object):
+    '''
+    Uses the postgres backend directly, whatever the configured one, as
+    long as the tests database is PostgreSQL 9.5 or later.
+    '''
+    @classmethod
+    def setup_class(cls):
+        if model.meta.engine.dialect.name != 'postgresql' or int(
+                model.Session.execute('SHOW server_version_num').scalar()) < 90500:
+            raise SkipTest('The tests database does not support SKIP LOCKED')
+        harvest_model.setup()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _create_objects(self, count):
+        source = harvest_model.HarvestSource(url=u'http://test-queue', type=u'test')
+        source.save()
+        job = harvest_model.HarvestJob(source=source)
+        job.save()
+        objects = [HarvestObject(guid=unicode(i), job=job) for i in range(count)]
+        for obj in objects:
+            obj.save()
+        return [obj.id for obj in objects]
+
+    def test_claimed_objects_are_skipped(self):
+        ids = self._create_objects(3)
+        queue.PostgresPublisher('harvest_object_id').send_many(
+            {'harvest_object_id': id} for id in ids)
+        model.Session.commit()
+
+        consumer = queue.PostgresConsumer('harvest_object_id')
+        other_consumer = queue.PostgresConsumer('harvest_object_id')
+        first = consumer._claim(2)
+        second = other_consumer._claim(2)
+        claimed = [json.loads(body)['harvest_object_id']
+                   for method, header, body in first + second]
+        assert sorted(claimed) == sorted(ids), claimed
+
+        consumer.basic_ack_many([method.delivery_tag for method, header, body in first])
+        other_consumer.basic_ack_many([method.delivery_tag for method, header, body in second])
+        assert model.Session.query(HarvestObject) \
+            .filter(HarvestObject.queue != None).count() == 0
+
+    def test_rows_locked_by_another_transaction_are_skipped(self):
+        ids = self._create_objects(3)
+        queue.PostgresPublisher('harvest_object_id').send_many(
+            {'harvest_object_id': id} for id in ids)
+        model.Session.commit()
+
+        # Another consumer in the middle of claiming the first object
+        connection = model.meta.engine.connect()
+        transaction = connection.begin()
+        try:
+            connection.execute('SELECT id FROM harvest_object WHERE id = %s '
+                               'FOR UPDATE', ids[0])
+
+            consumer = queue.PostgresConsumer('harvest_object_id')
+            claimed = [json.loads(body)['harvest_object_id']
+                       for method, header, body in consumer._claim(3)]
+            assert sorted(claimed) == sorted(ids[1:]), claimed
+        finally:
+            transaction.rollback()
+            connection.close()
+
+        claimed = [json.loads(body)['harvest_object_id']
+                   for method, header, body in consumer._claim(3)]
+        assert claimed == ids[:1], claimed
+
+    def test_consumers_are_notified_on_commit(self):
+        id = self._create_objects(1)[0]
+        consumer = queue.PostgresConsumer('harvest_object_id')
+        listener = consumer._listen()
+
+        queue.PostgresPublisher('harvest_object_id').send({'harvest_object_id': id})
+        assert not select.select([listener], [], [], 0.5)[0]
+        listener.poll()
+        assert not listener.notifies
+
+        model.Session.commit()
+        assert select.select([listener], [], [], 5)[0]
+        listener.poll()
+        assert [notify.channel for notify in listener.notifies] == \
+            [queue.get_queue_name('harvest_object_id')]
+        listener.close()
+
+    def test_sending_is_rolled_back_with_the_session(self):
+        id = self._create_objects(1)[0]
+        queue.PostgresPublisher('harvest_object_id').send({'harvest_object_id': id})
+        model.Session.rollback()
+
+        consumer = queue.PostgresConsumer('harvest_object_id')
+        assert consumer.basic_get(queue='ckan.harvest.fetch')[2] is None
+
+    def test_expired_leases_are_claimed_again(self):
+        id = self._create_objects(1)[0]
+        queue.PostgresPublisher('harvest_object_id').send({'harvest_object_id': id})
+        model.Session.commit()
+
+        consumer = queue.PostgresConsumer('harvest_object_id')
+        method, header, body = consumer.basic_get(queue='ckan.harvest.fetch')
+        assert json.loads(body)['harvest_object_id'] == id
+        assert consumer.basic_get(queue='ckan.harvest.fetch')[2] is None
+
+        model.Session.execute("UPDATE harvest_object SET queue_due = now() - interval '1 second'")
+        model.Session.commit()
+        reply = consumer.basic_get(queue='ckan.harvest.fetch')
+        assert json.loads(reply[2])['harvest_object_id'] == id
+
+        # The first lease can no longer be acknowledged
+        consumer.basic_ack(method.delivery_tag)
+        assert HarvestObject.get(id).queue == u'fetch'
+
+    def test_sending_to_another_queue(self):
+        id = self._create_objects(1)[0]
+        queue.PostgresPublisher('harvest_object_id').send({'harvest_object_id': id})
+        model.Session.commit()
+
+        consumer = queue.PostgresConsumer('harvest_object_id')
+        method, header, body = consumer.basic_get(queue='ckan.harvest.fetch')
+        queue.PostgresPublisher('harvest_import_object_id').send({'harvest_object_id': id})
+        model.Session.commit()
+        consumer.basic_ack(method.delivery_tag)
+
+        model.Session.remove()
+        assert HarvestObject.get(id).queue == u'import'